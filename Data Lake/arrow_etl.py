@@ -0,0 +1,307 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pj
+import pyarrow.parquet as pq
+from pyarrow import fs as pafs
+
+from manifest import write_manifest
+from settings import open_event_filter, parse_args, print_plan, save_merged_event_filter, settings_from_args
+from storage import filesystem_for
+from table_log import SnapshotTable, vacuum_tables
+
+
+# schemas of the JSON sources as spark infers them, so both engines see the same column types
+SONG_DATA_SCHEMA = pa.schema([
+    ('artist_id', pa.string()),
+    ('artist_latitude', pa.float64()),
+    ('artist_location', pa.string()),
+    ('artist_longitude', pa.float64()),
+    ('artist_name', pa.string()),
+    ('duration', pa.float64()),
+    ('num_songs', pa.int64()),
+    ('song_id', pa.string()),
+    ('title', pa.string()),
+    ('year', pa.int64()),
+])
+
+LOG_DATA_SCHEMA = pa.schema([
+    ('artist', pa.string()),
+    ('auth', pa.string()),
+    ('firstName', pa.string()),
+    ('gender', pa.string()),
+    ('itemInSession', pa.int64()),
+    ('lastName', pa.string()),
+    ('length', pa.float64()),
+    ('level', pa.string()),
+    ('location', pa.string()),
+    ('method', pa.string()),
+    ('page', pa.string()),
+    ('registration', pa.float64()),
+    ('sessionId', pa.int64()),
+    ('song', pa.string()),
+    ('status', pa.int64()),
+    ('ts', pa.int64()),
+    ('userAgent', pa.string()),
+    ('userId', pa.string()),
+])
+
+# schemas of the output tables, identical to the ones written by etl.py
+SONGS_SCHEMA = pa.schema([
+    ('song_id', pa.string()),
+    ('title', pa.string()),
+    ('artist_id', pa.string()),
+    ('year', pa.int64()),
+    ('duration', pa.float64()),
+])
+
+ARTISTS_SCHEMA = pa.schema([
+    ('artist_id', pa.string()),
+    ('name', pa.string()),
+    ('location', pa.string()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+])
+
+USERS_SCHEMA = pa.schema([
+    ('user_id', pa.int32()),
+    ('first_name', pa.string()),
+    ('last_name', pa.string()),
+    ('gender', pa.string()),
+    ('level', pa.string()),
+])
+
+TIME_SCHEMA = pa.schema([
+    ('start_time', pa.timestamp('us')),
+    ('hour', pa.int32()),
+    ('day', pa.int32()),
+    ('week', pa.int32()),
+    ('month', pa.int32()),
+    ('year', pa.int32()),
+    ('weekday', pa.string()),
+])
+
+SONGPLAYS_SCHEMA = pa.schema([
+    ('songplay_id', pa.int64()),
+    ('start_time', pa.timestamp('us')),
+    ('user_id', pa.int32()),
+    ('level', pa.string()),
+    ('song_id', pa.string()),
+    ('artist_id', pa.string()),
+    ('session_id', pa.int64()),
+    ('location', pa.string()),
+    ('user_agent', pa.string()),
+    ('year', pa.int32()),
+    ('month', pa.int32()),
+])
+
+NULLABLE_INTEGERS = {pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}
+
+# log columns of the event fingerprint, see event_filter.py
+EVENT_KEY = ['userId', 'sessionId', 'itemInSession', 'ts']
+
+
+def read_json_dir(fs, root, schema, max_workers=16):
+    '''
+    Description : Read every .json file below a directory into one arrow table with a fixed schema
+    Arguments :
+        - fs : pyarrow filesystem
+        - root : directory to read
+        - schema : explicit schema of the records, unknown fields are ignored
+        - max_workers : number of files read concurrently
+    Returns :
+        - pyarrow table
+    '''
+    selector = pafs.FileSelector(root, recursive=True, allow_not_found=True)
+    paths = sorted(info.path for info in fs.get_file_info(selector)
+                   if info.type == pafs.FileType.File and info.path.endswith('.json'))
+    options = pj.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+
+    def read(path):
+        with fs.open_input_stream(path) as stream:
+            return pj.read_json(stream, parse_options=options)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        tables = list(pool.map(read, paths))
+    if not tables:
+        return schema.empty_table()
+    return pa.concat_tables(tables)
+
+
+def write_table(df, schema, path, partition_cols, settings):
+    '''
+    Description : Write a dataframe in overwrite mode as hive partitioned parquet, laid out like spark does,
+                  or as a new version of a SnapshotTable when the table log is enabled
+    Arguments :
+        - df : pandas dataframe
+        - schema : arrow schema of the table, including the partition columns
+        - path : output path of the table
+        - partition_cols : list of partition columns
+        - settings : settings returned by load_settings, a manifest is written when manifests are enabled
+    Returns :
+        - number of rows written
+    '''
+    table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    if settings['table_log'] == 'true':
+        SnapshotTable(path, settings).write_arrow(table, partition_cols)
+        return table.num_rows
+
+    fs, root = filesystem_for(path, settings)
+    fs.create_dir(root, recursive=True)
+    fs.delete_dir_contents(root)
+
+    pq.write_to_dataset(table, root, partition_cols=partition_cols or None, filesystem=fs,
+                        use_deprecated_int96_timestamps=True)
+    with fs.open_output_stream('{}/_SUCCESS'.format(root)):
+        pass
+    if settings['manifests'] == 'true':
+        write_manifest(path, settings)
+    return table.num_rows
+
+
+def process_song_data(input_data, output_data, settings):
+    '''
+    Description :
+        - Read all the song dataset files(.json format) into one arrow table
+        - Extract songs_table and write it partitioned by year and artist
+        - Extract artists_table and write it
+    Arguments :
+        - input_data : source file path
+        - output_data : output file path
+        - settings : settings returned by load_settings
+    Returns :
+        - dict of table name -> rows written
+    '''
+    fs, root = filesystem_for(input_data, settings)
+    df = read_json_dir(fs, '{}/song_data'.format(root), SONG_DATA_SCHEMA) \
+        .to_pandas(types_mapper=NULLABLE_INTEGERS.get)
+
+    songs_table = df[['song_id', 'title', 'artist_id', 'year', 'duration']] \
+        .dropna(subset=['song_id']).drop_duplicates()
+
+    artists_table = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']] \
+        .rename(columns={'artist_name': 'name', 'artist_location': 'location',
+                         'artist_latitude': 'latitude', 'artist_longitude': 'longitude'}) \
+        .dropna(subset=['artist_id']).drop_duplicates()
+
+    return {
+        'song_data': len(df),
+        'songs': write_table(songs_table, SONGS_SCHEMA, "{}/songs/songs_table.parquet".format(output_data),
+                             ['year', 'artist_id'], settings),
+        'artists': write_table(artists_table, ARTISTS_SCHEMA, "{}/songs/artists_table.parquet".format(output_data),
+                               None, settings),
+    }
+
+
+def process_log_data(input_data, output_data, settings):
+    '''
+    Description :
+        - Read all the log dataset files(.json format) and keep the NextSong events, with an event filter
+          configured also drop repeated events
+        - Extract users_table and write it
+        - Derive the time columns from ts, extract time_table and write it partitioned by year and month
+        - Join the events with the song dataset on title, artist name and duration to create songplays_table
+        - Write songplays_table partitioned by year and month
+        - With an event filter configured, replace it with a filter of the events of the written songplays,
+          saving it merged with the previous one while the tables are replaced
+    Arguments :
+        - input_data : source file path
+        - output_data : output file path
+        - settings : settings returned by load_settings
+    Returns :
+        - dict of table name -> rows written
+    '''
+    fs, root = filesystem_for(input_data, settings)
+    df = read_json_dir(fs, '{}/log_data'.format(root), LOG_DATA_SCHEMA) \
+        .to_pandas(types_mapper=NULLABLE_INTEGERS.get)
+    log_rows = len(df)
+    df['user_id'] = pd.to_numeric(df['userId'], errors='coerce').astype('Int32')
+    df = df[df['page'] == 'NextSong']
+    event_filter = open_event_filter(settings, new=True)
+    if event_filter is not None:
+        df = df.drop_duplicates(subset=EVENT_KEY)
+        event_filter.add_events(df[EVENT_KEY].itertuples(index=False, name=None))
+        save_merged_event_filter(event_filter, settings)
+
+    users_table = df[['user_id', 'firstName', 'lastName', 'gender', 'level']] \
+        .rename(columns={'firstName': 'first_name', 'lastName': 'last_name'}) \
+        .dropna(subset=['user_id']).drop_duplicates()
+
+    start_time = pd.to_datetime(df['ts'].astype('int64'), unit='ms')
+    df = df.assign(start_time=start_time,
+                   year=start_time.dt.year.astype('int32'),
+                   month=start_time.dt.month.astype('int32'))
+
+    time_table = pd.DataFrame({
+        'start_time': start_time,
+        'hour': start_time.dt.hour.astype('int32'),
+        'day': start_time.dt.day.astype('int32'),
+        'week': start_time.dt.isocalendar().week.astype('int32'),
+        'month': start_time.dt.month.astype('int32'),
+        'year': start_time.dt.year.astype('int32'),
+        'weekday': start_time.dt.strftime('%a'),
+    }).drop_duplicates()
+
+    song_df = read_json_dir(fs, '{}/song_data'.format(root), SONG_DATA_SCHEMA) \
+        .select(['title', 'artist_name', 'duration', 'song_id', 'artist_id']) \
+        .to_pandas().dropna(subset=['title', 'artist_name', 'duration'])
+
+    df = df.sort_values('ts', kind='stable').reset_index(drop=True)
+    df['songplay_id'] = df.index.astype('int64')
+    songplays_table = df.merge(song_df, how='left',
+                               left_on=['song', 'artist', 'length'],
+                               right_on=['title', 'artist_name', 'duration']) \
+        .rename(columns={'sessionId': 'session_id', 'userAgent': 'user_agent'})
+
+    rows = {
+        'log_data': log_rows,
+        'users': write_table(users_table, USERS_SCHEMA, "{}/songs/users_table.parquet".format(output_data),
+                             None, settings),
+        'time': write_table(time_table, TIME_SCHEMA, "{}/songs/time_table.parquet".format(output_data),
+                            ['year', 'month'], settings),
+        'songplays': write_table(songplays_table, SONGPLAYS_SCHEMA,
+                                 "{}/songs/songplays_table.parquet".format(output_data), ['year', 'month'], settings),
+    }
+    if event_filter is not None:
+        event_filter.save()
+    return rows
+
+
+def run(settings):
+    '''
+    Description : Run the song and log data transforms with the arrow engine and print the row counts, then
+                  vacuum the snapshot tables when the table log is enabled
+    Arguments :
+        - settings : settings returned by load_settings
+    Returns :
+        - dict of table name -> rows written
+    '''
+    if settings['rollups'] == 'true' or settings['metrics_report']:
+        print('rollups and metrics reports need the spark engine, skipping them')
+
+    start = time.perf_counter()
+    rows = process_song_data(settings['input_data'], settings['output_data'], settings)
+    rows.update(process_log_data(settings['input_data'], settings['output_data'], settings))
+    if settings['table_log'] == 'true':
+        vacuum_tables(settings['output_data'], settings)
+    print('arrow engine finished in {:.2f}s : {}'.format(time.perf_counter() - start, rows))
+    return rows
+
+
+def main(argv=None):
+    '''
+    Description : Entry point for hosts without spark, takes the same options as etl.py
+    '''
+    args = parse_args(argv)
+    args.engine = 'arrow'
+    settings = settings_from_args(args)
+    if args.dry_run:
+        print_plan(settings)
+        return
+    run(settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import sys
+import time
+from collections import Counter
+
+import pyarrow.parquet as pq
+
+from settings import load_settings
+from table_log import live_dataset
+
+
+TABLES = ['songs_table', 'artists_table', 'users_table', 'time_table', 'songplays_table']
+
+# columns whose values depend on the engine's partitioning and are left out of the row comparison
+ENGINE_SPECIFIC_COLUMNS = {'songplays_table': ['songplay_id']}
+
+
+def run_spark(settings):
+    '''
+    Description : Run etl.py with a local spark session
+    Returns :
+        - (startup seconds, processing seconds)
+    '''
+    start = time.perf_counter()
+    import etl
+    spark = etl.create_spark_session(settings)
+    started = time.perf_counter()
+    etl.process_song_data(spark, settings['input_data'], settings['output_data'])
+    etl.process_log_data(spark, settings['input_data'], settings['output_data'])
+    finished = time.perf_counter()
+    spark.stop()
+    return started - start, finished - started
+
+
+def run_arrow(settings):
+    '''
+    Description : Run arrow_etl.py on the same input
+    Returns :
+        - (startup seconds, processing seconds, input rows)
+    '''
+    start = time.perf_counter()
+    import arrow_etl
+    started = time.perf_counter()
+    rows = arrow_etl.process_song_data(settings['input_data'], settings['output_data'], settings)
+    rows.update(arrow_etl.process_log_data(settings['input_data'], settings['output_data'], settings))
+    finished = time.perf_counter()
+    return started - start, finished - started, rows['song_data'] + rows['log_data']
+
+
+def file_schema(path, settings):
+    '''
+    Description : Names and types of the data columns of a table, read from its first live parquet file. Nullability
+                  is left out, spark writes songplay_id (monotonically_increasing_id) as required and arrow as
+                  optional although both hold the same values
+    Returns :
+        - list of (name, type) tuples
+    '''
+    dataset = live_dataset(path, settings)
+    return [(field.name, str(field.type)) for field in pq.read_schema(dataset.files[0], filesystem=dataset.filesystem)]
+
+
+def table_rows(path, drop_columns, settings):
+    '''
+    Description : Multiset of the rows of a table, partition columns included, of its latest version when
+                  it is a snapshot table
+    '''
+    table = live_dataset(path, settings).to_table()
+    table = table.select(sorted(name for name in table.column_names if name not in drop_columns))
+    return table.column_names, Counter(tuple(sorted(row.items())) for row in table.to_pylist())
+
+
+def compare_outputs(spark_settings, arrow_settings):
+    '''
+    Description : Compare schema, partition layout and rows of every table written by both engines
+    Arguments :
+        - spark_settings, arrow_settings : settings of the two runs, their output_data is compared
+    Returns :
+        - list of differences, empty when both outputs agree
+    '''
+    differences = []
+    for table in TABLES:
+        spark_path = '{}/songs/{}.parquet'.format(spark_settings['output_data'], table)
+        arrow_path = '{}/songs/{}.parquet'.format(arrow_settings['output_data'], table)
+
+        spark_schema, arrow_schema = file_schema(spark_path, spark_settings), file_schema(arrow_path, arrow_settings)
+        if spark_schema != arrow_schema:
+            differences.append('{} schema differs :\n  spark {}\n  arrow {}'.format(
+                table, spark_schema, arrow_schema))
+
+        drop_columns = ENGINE_SPECIFIC_COLUMNS.get(table, [])
+        spark_columns, spark_rows = table_rows(spark_path, drop_columns, spark_settings)
+        arrow_columns, arrow_rows = table_rows(arrow_path, drop_columns, arrow_settings)
+        if spark_columns != arrow_columns:
+            differences.append('{} partition layout differs : {} vs {}'.format(table, spark_columns, arrow_columns))
+        elif spark_rows != arrow_rows:
+            differences.append('{} rows differ : {} only in spark, {} only in arrow'.format(
+                table, sum((spark_rows - arrow_rows).values()), sum((arrow_rows - spark_rows).values())))
+    return differences
+
+
+def main(argv=None):
+    '''
+    Description :
+        - Run the spark and arrow engines of the Data Lake ETL on the same input, by default the
+          sample data of the local profile
+        - Print startup time, processing time and throughput of both engines
+        - Check both outputs for identical schemas, partitioning and rows, exit with 1 when they differ
+        - Needs pyspark and java, the parity of the engines is unverified until this has passed on such a host
+    '''
+    parser = argparse.ArgumentParser(description='Compare the spark and arrow engines of the Data Lake ETL')
+    parser.add_argument('--config', default='dl.cfg')
+    parser.add_argument('--profile', default='local')
+    parser.add_argument('--input', dest='input_data')
+    parser.add_argument('--output', default='output/compare')
+    args = parser.parse_args(argv)
+
+    spark_settings = load_settings(args.config, args.profile, {
+        'input_data': args.input_data, 'output_data': '{}/spark'.format(args.output)})
+    arrow_settings = load_settings(args.config, args.profile, {
+        'input_data': args.input_data, 'output_data': '{}/arrow'.format(args.output), 'engine': 'arrow'})
+
+    arrow_startup, arrow_seconds, input_rows = run_arrow(arrow_settings)
+    spark_startup, spark_seconds = run_spark(spark_settings)
+
+    print('{:<8}{:>12}{:>14}{:>16}'.format('engine', 'startup s', 'processing s', 'input rows/s'))
+    for name, startup, seconds in (('spark', spark_startup, spark_seconds), ('arrow', arrow_startup, arrow_seconds)):
+        print('{:<8}{:>12.2f}{:>14.2f}{:>16.0f}'.format(name, startup, seconds, input_rows / seconds if seconds else 0))
+
+    differences = compare_outputs(spark_settings, arrow_settings)
+    for difference in differences:
+        print(difference)
+    print('outputs {}'.format('differ' if differences else 'match'))
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import configparser
 from datetime import datetime
 import os
 from pyspark.sql import functions as F
@@ -7,27 +6,137 @@ from pyspark.sql.functions import udf, col
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
 from pyspark.sql.types import *
 
+from manifest import write_manifest
+from metrics import NullMetrics, StageMetrics
+from rollups import build_rollups
+from settings import (DEFAULT_SETTINGS, EVENT_FILTER_MODULE, open_event_filter, parse_args, print_plan,
+                      save_merged_event_filter, settings_from_args)
+from table_log import SnapshotTable, vacuum_tables
 
-config = configparser.ConfigParser()
-config.read('dl.cfg') # Read config file for connecting to aws services
+# log columns of the event fingerprint, see event_filter.py
+EVENT_KEY = ['userId', 'sessionId', 'itemInSession', 'ts']
 
-os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-
-def create_spark_session():
+def create_spark_session(settings=None):
     '''
-    - Description : Create or get spark session
+    - Description : Create or get spark session configured from the settings
+        - s3 and mock_s3 backends load the hadoop-aws package, mock_s3 points s3a at a local endpoint
+        - shuffle partitions, adaptive query execution and memory come from the settings
+    - Arguments : settings returned by load_settings, defaults are used when None
     - Returns : spark session
     '''
-    spark = SparkSession \
-        .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+    settings = settings or DEFAULT_SETTINGS
+    builder = SparkSession.builder.appName('sparkify-data-lake')
+
+    if settings['master']:
+        builder = builder.master(settings['master'])
+
+    if settings['backend'] != 'local':
+        builder = builder.config("spark.jars.packages", settings['hadoop_aws_package'])
+
+    if settings['backend'] == 'mock_s3':
+        builder = builder \
+            .config("spark.hadoop.fs.s3a.endpoint", settings['s3_endpoint']) \
+            .config("spark.hadoop.fs.s3a.path.style.access", "true") \
+            .config("spark.hadoop.fs.s3a.connection.ssl.enabled", "false") \
+            .config("spark.hadoop.fs.s3a.access.key", os.environ.get('AWS_ACCESS_KEY_ID', 'mock')) \
+            .config("spark.hadoop.fs.s3a.secret.key", os.environ.get('AWS_SECRET_ACCESS_KEY', 'mock'))
+
+    builder = builder \
+        .config("spark.sql.shuffle.partitions", settings['shuffle_partitions']) \
+        .config("spark.sql.adaptive.enabled", settings['adaptive_enabled'])
+
+    if settings['driver_memory']:
+        builder = builder.config("spark.driver.memory", settings['driver_memory'])
+    if settings['executor_memory']:
+        builder = builder.config("spark.executor.memory", settings['executor_memory'])
+
+    spark = builder.getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def write_parquet(df, path, partition_by=None, metrics=None, stage_name=None, dynamic_partitions=False, settings=None,
+                  mode='overwrite'):
+    '''
+    Description : Write a dataframe to parquet files in overwrite mode, or append mode, as one instrumented stage
+        - With the table log enabled the dataframe is committed as a new version of a SnapshotTable instead,
+          readers keep seeing the previous version until the commit
+    Arguments :
+        - df : spark dataframe to write
+        - path : output path of the table
+        - partition_by : list of partition columns
+        - metrics : StageMetrics collecting the run report, nothing is recorded when None
+        - stage_name : name of the stage in the run report
+        - dynamic_partitions : only overwrite the partitions present in df and keep the others
+        - settings : settings returned by load_settings, a manifest is written when manifests are enabled
+        - mode : overwrite, or append to add the rows of a streaming micro-batch
+    Returns :
+        - None
+    '''
+    metrics = metrics or NullMetrics()
+    table_log = settings and settings['table_log'] == 'true'
+    with metrics.stage(stage_name or 'write_{}'.format(os.path.basename(path.rstrip('/'))), output_path=path) as stage:
+        # in a metrics run the dataframe is counted from the cache of the stage that built it, or computed here
+        df = stage.output(df)
+        if table_log:
+            SnapshotTable(path, settings).write_spark(df, partition_by, mode, replace_partitions=dynamic_partitions)
+        else:
+            writer = df.write
+            if partition_by:
+                writer = writer.partitionBy(*partition_by)
+            if dynamic_partitions:
+                writer = writer.option('partitionOverwriteMode', 'dynamic')
+            writer.mode(mode).parquet(path)
+
+    # the commits of the table log carry the same file entries, a manifest would list the files of older versions
+    if settings and settings['manifests'] == 'true' and not table_log:
+        with metrics.stage('manifest_{}'.format(os.path.basename(path.rstrip('/')))):
+            write_manifest(path, settings)
+
+
+def ship_event_filter(spark):
+    '''
+    Description : Make event_filter.py importable on the executors, once per spark session
+    '''
+    spark.sparkContext.addPyFile(EVENT_FILTER_MODULE)
+
+
+def seen_events(broadcast):
+    '''
+    Description : Whether the broadcast EventFilter has seen the event of a row of log data
+    Arguments :
+        - broadcast : spark broadcast of an EventFilter
+    Returns :
+        - boolean column
+    '''
+    seen = udf(lambda *event: broadcast.value.has_event(*event), BooleanType())
+    return seen(*EVENT_KEY)
+
+
+def build_event_filter(df, event_filter):
+    '''
+    Description : Add the events of a dataframe to an EventFilter, a filter of the same size is built
+                  per partition on the executors and merged into it on the driver one partition at a time
+    Arguments :
+        - df : dataframe of log data with the EVENT_KEY columns
+        - event_filter : EventFilter to add the events to
+    Returns :
+        - event_filter
+    '''
+    num_bits, num_hashes = event_filter.num_bits, event_filter.num_hashes
+
+    def partial_filter(rows):
+        from event_filter import EventFilter
+        partial = EventFilter(num_bits, num_hashes)
+        partial.add_events(rows)
+        yield partial
+
+    for partial in df.select(*EVENT_KEY).rdd.mapPartitions(partial_filter).toLocalIterator():
+        event_filter.merge(partial)
+    return event_filter
+
+
+def process_song_data(spark, input_data, output_data, metrics=None, settings=None):
     '''
     Description : 
         - Create song_data spark object from all the song dataset files(.json format) present in S3
@@ -40,71 +149,115 @@ def process_song_data(spark, input_data, output_data):
         - spark : spark session
         - input_data : source file path
         - output_data : output file path
+        - metrics : StageMetrics collecting the run report, nothing is recorded when None
+        - settings : settings returned by load_settings, enables the table manifests
     Returns : 
         - None
     '''
+    metrics = metrics or NullMetrics()
+
     # get filepath to song data file
     song_data =os.path.join(input_data, "song_data/*/*/*/*.json")
     
     # read song data file
-    df = spark.read.json(song_data)
+    with metrics.stage('read_song_data') as stage:
+        df = spark.read.json(song_data)
+        stage.output(df)
 
     # extract columns to create songs table
-    songs_table = df.select('song_id','title','artist_id','year','duration').where(col('song_id').isNotNull()).dropDuplicates()
+    with metrics.stage('extract_songs') as stage:
+        songs_table = df.select('song_id','title','artist_id','year','duration').where(col('song_id').isNotNull())
+        stage.input(df)
+        stage.output(songs_table)
+
+    with metrics.stage('dedup_songs') as stage:
+        stage.input(songs_table)
+        songs_table = songs_table.dropDuplicates()
+        stage.output(songs_table)
     
     # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy("year","artist_id").mode('overwrite').parquet("{}/songs/songs_table.parquet".format(output_data))
+    write_parquet(songs_table, "{}/songs/songs_table.parquet".format(output_data), ["year","artist_id"], metrics, 'write_songs', settings=settings)
 
     # extract columns to create artists table
-    artists_table = df.select('artist_id',
-                          col('artist_name').alias('name'),
-                          col('artist_location').alias('location'),
-                          col('artist_latitude').alias('latitude'),
-                          col('artist_longitude').alias('longitude')).where(col('artist_id').isNotNull()).dropDuplicates()
+    with metrics.stage('extract_artists') as stage:
+        artists_table = df.select('artist_id',
+                              col('artist_name').alias('name'),
+                              col('artist_location').alias('location'),
+                              col('artist_latitude').alias('latitude'),
+                              col('artist_longitude').alias('longitude')).where(col('artist_id').isNotNull())
+        stage.input(df)
+        stage.output(artists_table)
+
+    with metrics.stage('dedup_artists') as stage:
+        stage.input(artists_table)
+        artists_table = artists_table.dropDuplicates()
+        stage.output(artists_table)
     
     # write artists table to parquet files
-    artists_table.write.mode('overwrite').parquet("{}/songs/artists_table.parquet".format(output_data))
+    write_parquet(artists_table, "{}/songs/artists_table.parquet".format(output_data), None, metrics, 'write_artists', settings=settings)
 
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, input_data, output_data, metrics=None, settings=None):
     '''
     Description : 
         - Create log_data spark object from all the user log dataset files(.json format) present in S3
         - Create spark dataframe from all files
-        - Filter the dataframe by 'NextPage' page
+        - Filter the dataframe by 'NextPage' page, with an event filter configured also drop repeated events
         - Extract columns for users_table from dataframe and write to parquet file in S3
         - Create timestamp and datetime columns from original timestamp column from source
         - Extract columns to create time_table and write to parquet file format partitioned by year and month in S3
         - Create song_df dataframe from song dataset to get song and artist informations for the song being listened by user
         - Extract user information from user log dataframe and join with song dataframe to create songplays_table.
         - Write songplay_table file to parquet file format partitioned by year and month in S3
+        - With an event filter configured, replace it with a filter of the events of the written songplays,
+          which replace the earlier ones
     
     Arguments : 
         - spark : spark session 
         - input_data :  source file path
         - output_data : output file path
+        - metrics : StageMetrics collecting the run report, nothing is recorded when None
+        - settings : settings returned by load_settings, enables the table manifests
     Returns : 
-        - None 
+        - songplays_table dataframe
     '''
+    metrics = metrics or NullMetrics()
+    event_filter = open_event_filter(settings, new=True) if settings else None
+
     # get filepath to log data file
     log_data =os.path.join(input_data, "log_data/*/*/*.json")
 
     # read log data file
-    df = spark.read.json(log_data)
-    df = df.withColumn('user_id', df.userId.cast(IntegerType()))
+    with metrics.stage('read_log_data') as stage:
+        df = spark.read.json(log_data)
+        df = df.withColumn('user_id', df.userId.cast(IntegerType()))
+        stage.output(df)
     
     # filter by actions for song plays
-    df = df.filter(df.page == "NextSong")
+    with metrics.stage('filter_song_plays') as stage:
+        stage.input(df)
+        df = df.filter(df.page == "NextSong")
+        if event_filter is not None:
+            df = df.dropDuplicates(EVENT_KEY)
+        stage.output(df)
 
     # extract columns for users table    
-    users_table = df.select('user_id',
-                         col('firstName').alias('first_name'),
-                         col('lastName').alias('last_name'),
-                         col('gender').alias('gender'),
-                         'level').where(col('user_id').isNotNull()).dropDuplicates()
+    with metrics.stage('extract_users') as stage:
+        users_table = df.select('user_id',
+                             col('firstName').alias('first_name'),
+                             col('lastName').alias('last_name'),
+                             col('gender').alias('gender'),
+                             'level').where(col('user_id').isNotNull())
+        stage.input(df)
+        stage.output(users_table)
+
+    with metrics.stage('dedup_users') as stage:
+        stage.input(users_table)
+        users_table = users_table.dropDuplicates()
+        stage.output(users_table)
     
     # write users table to parquet files
-    users_table.write.mode('overwrite').parquet("{}/songs/users_table.parquet".format(output_data))
+    write_parquet(users_table, "{}/songs/users_table.parquet".format(output_data), None, metrics, 'write_users', settings=settings)
 
     # create timestamp column from original timestamp column
     get_timestamp = udf(lambda x : datetime.utcfromtimestamp(int(x)/1000.0), TimestampType())
@@ -115,59 +268,141 @@ def process_log_data(spark, input_data, output_data):
     df = df.withColumn('date', get_datetime(df.ts))
     
     # extract columns to create time table
-    time_table = df.select(col('timestamp').alias('start_time'),
-                           hour('timestamp').alias('hour'),
-                           dayofmonth('date').alias('day'),
-                           weekofyear('date').alias('week'),
-                           month('date').alias('month'),
-                           year('date').alias('year'),
-                           date_format('date','E').alias('weekday')).dropDuplicates()                           
+    with metrics.stage('extract_time') as stage:
+        time_table = df.select(col('timestamp').alias('start_time'),
+                               hour('timestamp').alias('hour'),
+                               dayofmonth('date').alias('day'),
+                               weekofyear('date').alias('week'),
+                               month('date').alias('month'),
+                               year('date').alias('year'),
+                               date_format('date','E').alias('weekday'))
+        stage.input(df)
+        stage.output(time_table)
+
+    with metrics.stage('dedup_time') as stage:
+        stage.input(time_table)
+        time_table = time_table.dropDuplicates()
+        stage.output(time_table)
     
     # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy("year","month").mode('overwrite').parquet("{}/songs/time_table.parquet".format(output_data))
+    write_parquet(time_table, "{}/songs/time_table.parquet".format(output_data), ["year","month"], metrics, 'write_time', settings=settings)
 
     # read in song data to use for songplays table
-    song_df = spark.read.json(os.path.join(input_data, 'song_data', '*', '*', '*'))
+    with metrics.stage('read_song_lookup') as stage:
+        song_df = spark.read.json(os.path.join(input_data, 'song_data', '*', '*', '*'))
+        stage.output(song_df)
 
     # extract columns from joined song and log datasets to create songplays table 
-    df = df.orderBy('timestamp')
-    df = df.withColumn('songplay_id',F.monotonically_increasing_id()) #generating serial id for songplay table
-    songplays_table = df.join(song_df, 
-                              (df['song'] == song_df['title']) & 
-                              (df['length'] == song_df['duration']) & 
-                              (df['artist'] == song_df['artist_name']),'left_outer').select(
-    df.songplay_id,
-    df.timestamp.alias('start_time'),
-    df.user_id,
-    df.level,
-    song_df.song_id,
-    song_df.artist_id,
-    df.sessionId.alias('session_id'),
-    df.location,
-    df.userAgent.alias('user_agent'),
-    year('date').alias('year'),
-    month('date').alias('month'))
+    with metrics.stage('join_songplays') as stage:
+        df = df.orderBy('timestamp')
+        df = df.withColumn('songplay_id',F.monotonically_increasing_id()) #generating serial id for songplay table
+        songplays_table = df.join(song_df, 
+                                  (df['song'] == song_df['title']) & 
+                                  (df['length'] == song_df['duration']) & 
+                                  (df['artist'] == song_df['artist_name']),'left_outer').select(
+        df.songplay_id,
+        df.timestamp.alias('start_time'),
+        df.user_id,
+        df.level,
+        song_df.song_id,
+        song_df.artist_id,
+        df.sessionId.alias('session_id'),
+        df.location,
+        df.userAgent.alias('user_agent'),
+        year('date').alias('year'),
+        month('date').alias('month'))
+        stage.input(df)
+        stage.output(songplays_table)
+
+    if event_filter is not None:
+        with metrics.stage('build_event_filter') as stage:
+            stage.input(df)
+            ship_event_filter(spark)
+            save_merged_event_filter(build_event_filter(df, event_filter), settings)
 
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy("year","month").mode('overwrite').parquet("{}/songs/songplays_table.parquet".format(output_data))
+    write_parquet(songplays_table, "{}/songs/songplays_table.parquet".format(output_data), ["year","month"], metrics, 'write_songplays', settings=settings)
 
+    if event_filter is not None:
+        event_filter.save()
 
-def main():
+    return songplays_table
+
+
+def process_rollups(songplays_table, output_data, metrics=None, settings=None):
     '''
     Description : 
-        - Call function to create spark session
-        - Call process_song_data,process_log_data functions to do ETL process to load into S3 bucket
+        - Aggregate the songplays of the current run into the rollup tables of rollups.py
+          (plays per hour, user level, artist and location, with distinct user sketches)
+        - Write each rollup partitioned by day, only the days present in this run are replaced
+    Arguments : 
+        - songplays_table : songplays dataframe returned by process_log_data
+        - output_data : output file path
+        - metrics : StageMetrics collecting the run report, nothing is recorded when None
+        - settings : settings returned by load_settings, enables the table manifests
+    Returns : 
+        - None 
+    '''
+    for name, rollup in build_rollups(songplays_table).items():
+        write_parquet(rollup, "{}/rollups/{}.parquet".format(output_data, name), ["day"], metrics,
+                      'write_{}'.format(name), dynamic_partitions=True, settings=settings)
+
+
+def main(argv=None):
+    '''
+    Description : 
+        - Load settings from config file, profile and command line
+        - Print the inputs and outputs of the run and stop with --dry-run
+        - Call run to do the ETL process
     Arguments :
+        - argv : list of command line arguments, sys.argv is used when None
+    Returns :
         - None
+    '''
+    args = parse_args(argv)
+    settings = settings_from_args(args)
+    if args.dry_run:
+        print_plan(settings)
+        return
+    run(settings)
+
+
+def run(settings):
+    '''
+    Description : 
+        - Hand over to the arrow engine of arrow_etl.py when it is selected
+        - Call function to create spark session
+        - Call process_song_data,process_log_data functions to do ETL process to load into the output storage
+        - Materialize the day partitioned rollups when enabled
+        - Vacuum the snapshot tables when the table log is enabled, deleting the files the overwrites replaced
+        - Write the stage metrics run report when a report path is set
+    Arguments :
+        - settings : settings returned by load_settings
     Returns :
         - None
     '''
-    spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://sparkify-out/"
+    if settings['engine'] == 'arrow':
+        import arrow_etl
+        arrow_etl.run(settings)
+        return
+
+    spark = create_spark_session(settings)
+    input_data = settings['input_data']
+    output_data = settings['output_data']
+    metrics = StageMetrics(spark) if settings['metrics_report'] else None
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    process_song_data(spark, input_data, output_data, metrics, settings)    
+    songplays_table = process_log_data(spark, input_data, output_data, metrics, settings)
+
+    if settings['rollups'] == 'true':
+        process_rollups(songplays_table, output_data, metrics, settings)
+
+    if settings['table_log'] == 'true':
+        vacuum_tables(output_data, settings)
+
+    if metrics:
+        metrics.write_report(settings['metrics_report'])
+        metrics.release()
 
 
 if __name__ == "__main__":
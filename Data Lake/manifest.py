@@ -0,0 +1,284 @@
+import json
+from datetime import date, datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs as pafs
+
+from storage import filesystem_for
+
+
+MANIFEST_FILE = '_manifest.json'
+
+# columns whose min/max are recorded per file, partition columns are always recorded
+STATS_COLUMNS = {
+    'songs_table': ['song_id', 'title'],
+    'artists_table': ['artist_id', 'name'],
+    'users_table': ['user_id', 'level'],
+    'time_table': ['start_time'],
+    'songplays_table': ['start_time', 'user_id', 'song_id'],
+}
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _partition_value(value):
+    '''
+    Description : Type a hive partition directory value the way spark infers it
+    '''
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return None if value == '__HIVE_DEFAULT_PARTITION__' else value
+
+
+def _column_stats(parquet_file, path, fs, column):
+    '''
+    Description : min, max and null count of a column in one parquet file
+        - Merges the row group statistics of the footer
+        - Reads the column itself when the footer has no usable statistics, e.g. INT96 timestamps
+    '''
+    metadata = parquet_file.metadata
+    names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+    if column not in names:
+        return None
+    index = names.index(column)
+
+    minimum = maximum = None
+    nulls = 0
+    for group in range(metadata.num_row_groups):
+        stats = metadata.row_group(group).column(index).statistics
+        if stats is None or not stats.has_min_max:
+            with fs.open_input_file(path) as f:
+                values = pq.read_table(f, columns=[column]).column(column)
+            min_max = pc.min_max(values)
+            return {'min': _json_value(min_max['min'].as_py()), 'max': _json_value(min_max['max'].as_py()),
+                    'null_count': values.null_count}
+        minimum = stats.min if minimum is None else min(minimum, stats.min)
+        maximum = stats.max if maximum is None else max(maximum, stats.max)
+        nulls += stats.null_count or 0
+    return {'min': _json_value(minimum), 'max': _json_value(maximum), 'null_count': nulls}
+
+
+def table_name(root):
+    '''
+    Description : Name of a table from its output path, e.g. songplays_table for .../songplays_table.parquet
+    '''
+    return root.rstrip('/').split('/')[-1].replace('.parquet', '')
+
+
+def file_entry(fs, root, relative, size, stats_columns):
+    '''
+    Description : Manifest entry of one parquet file, read from its path and footer
+    Arguments :
+        - fs : pyarrow filesystem
+        - root : path of the table on fs
+        - relative : path of the file relative to root, hive partition directories included
+        - size : size of the file in bytes
+        - stats_columns : columns to record min/max of
+    Returns :
+        - dict of path, partition values, rows, bytes and stats
+    '''
+    path = '{}/{}'.format(root, relative)
+    partition = dict(part.split('=', 1) for part in relative.split('/')[:-1] if '=' in part)
+    partition = {key: _partition_value(value) for key, value in partition.items()}
+
+    with fs.open_input_file(path) as f:
+        parquet_file = pq.ParquetFile(f)
+        stats = {}
+        for column in stats_columns:
+            if column in partition:
+                continue
+            column_stats = _column_stats(parquet_file, path, fs, column)
+            if column_stats is not None:
+                stats[column] = column_stats
+        rows = parquet_file.metadata.num_rows
+    return {'path': relative, 'partition': partition, 'rows': rows, 'bytes': size, 'stats': stats}
+
+
+def write_manifest(table_path, settings, stats_columns=None):
+    '''
+    Description :
+        - List the parquet files of a table and read their footers
+        - Record per file the partition values, row count, size and min/max of the stats columns
+        - Reuse the entries of the previous manifest for files that did not change
+        - Write the manifest as _manifest.json next to the data, spark and pyarrow skip files starting with _
+    Arguments :
+        - table_path : output path of the table
+        - settings : settings returned by load_settings
+        - stats_columns : columns to record min/max of, taken from STATS_COLUMNS when None
+    Returns :
+        - manifest dict
+    '''
+    fs, root = filesystem_for(table_path, settings)
+    table = table_name(root)
+    if stats_columns is None:
+        stats_columns = STATS_COLUMNS.get(table, [])
+
+    previous = {}
+    try:
+        previous = {entry['path']: entry for entry in _load(fs, root)['files']}
+    except (FileNotFoundError, OSError, ValueError):
+        pass
+
+    selector = pafs.FileSelector(root, recursive=True)
+    infos = [info for info in fs.get_file_info(selector)
+             if info.type == pafs.FileType.File and info.path.endswith('.parquet')
+             and not any(part.startswith(('_', '.')) for part in info.path[len(root):].split('/'))]
+
+    entries = []
+    for info in sorted(infos, key=lambda info: info.path):
+        relative = info.path[len(root):].lstrip('/')
+        if relative in previous and previous[relative]['bytes'] == info.size:
+            entries.append(previous[relative])
+            continue
+
+        entries.append(file_entry(fs, root, relative, info.size, stats_columns))
+
+    manifest = {
+        'table': table,
+        'created_at': datetime.utcnow().isoformat(),
+        'partition_columns': list(entries[0]['partition']) if entries else [],
+        'stats_columns': stats_columns,
+        'rows': sum(entry['rows'] for entry in entries),
+        'files': entries,
+    }
+    with fs.open_output_stream('{}/{}'.format(root, MANIFEST_FILE)) as f:
+        f.write(json.dumps(manifest, indent=1).encode('utf-8'))
+    return manifest
+
+
+def _load(fs, root):
+    with fs.open_input_stream('{}/{}'.format(root, MANIFEST_FILE)) as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def load_manifest(table_path, settings):
+    '''
+    Description : Read the manifest of a table
+    Returns :
+        - manifest dict
+    '''
+    fs, root = filesystem_for(table_path, settings)
+    return _load(fs, root)
+
+
+def _may_contain(entry, column, predicate):
+    '''
+    Description : Whether a file can hold rows matching the predicate on one column
+        - predicate is a single value for point lookups or a (low, high) tuple for inclusive ranges,
+          None leaves that side of the range open
+        - Files without statistics for the column are always kept
+    '''
+    if column in entry['partition']:
+        minimum = maximum = entry['partition'][column]
+    elif column in entry['stats']:
+        minimum, maximum = entry['stats'][column]['min'], entry['stats'][column]['max']
+    else:
+        return True
+    if minimum is None or maximum is None:
+        return True
+
+    low, high = predicate if isinstance(predicate, tuple) else (predicate, predicate)
+    low, high = _json_value(low), _json_value(high)
+    try:
+        if low is not None and maximum < low:
+            return False
+        if high is not None and minimum > high:
+            return False
+    except TypeError:
+        return True
+    return True
+
+
+def prune_files(table_path, predicates, settings):
+    '''
+    Description : Files of a table that may hold rows matching all predicates, decided from the manifest only
+    Arguments :
+        - table_path : output path of the table
+        - predicates : dict of column -> value or (low, high) tuple,
+                       e.g. {'user_id': 26, 'start_time': (datetime(2018, 11, 12), datetime(2018, 11, 13))}
+        - settings : settings returned by load_settings
+    Returns :
+        - list of file paths relative to the table path
+    '''
+    manifest = load_manifest(table_path, settings)
+    return [entry['path'] for entry in manifest['files']
+            if all(_may_contain(entry, column, predicate) for column, predicate in predicates.items())]
+
+
+def _filter_expression(predicates):
+    expression = None
+    for column, predicate in predicates.items():
+        low, high = predicate if isinstance(predicate, tuple) else (predicate, predicate)
+        for condition in ((ds.field(column) >= low) if low is not None else None,
+                          (ds.field(column) <= high) if high is not None else None):
+            if condition is not None:
+                expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _schema_file(table_path, settings):
+    '''
+    Description : One file of the table, read for its schema when a lookup prunes every file, None for a table
+                  without files
+    '''
+    files = load_manifest(table_path, settings)['files']
+    return files[0]['path'] if files else None
+
+
+def read_table(table_path, predicates, settings, columns=None):
+    '''
+    Description : Point or range lookup on a table opening only the files kept by prune_files
+    Arguments :
+        - table_path : output path of the table
+        - predicates : see prune_files
+        - settings : settings returned by load_settings
+        - columns : list of columns to read, all when None
+    Returns :
+        - pyarrow table of the matching rows, empty with the table's schema when every file is pruned
+    '''
+    fs, root = filesystem_for(table_path, settings)
+    files = ['{}/{}'.format(root, path) for path in prune_files(table_path, predicates, settings)]
+    if not files:
+        schema_file = _schema_file(table_path, settings)
+        if schema_file is None:
+            return pa.schema([]).empty_table()
+        dataset = ds.dataset(['{}/{}'.format(root, schema_file)], filesystem=fs, format='parquet',
+                             partitioning='hive', partition_base_dir=root)
+        table = dataset.schema.empty_table()
+        return table.select(columns) if columns is not None else table
+    dataset = ds.dataset(files, filesystem=fs, format='parquet',
+                         partitioning='hive', partition_base_dir=root)
+    return dataset.to_table(columns=columns, filter=_filter_expression(predicates))
+
+
+def read_spark(spark, table_path, predicates, settings):
+    '''
+    Description : Same lookup as read_table returning a spark dataframe over the kept files only, empty with the
+                  table's schema when every file is pruned
+    '''
+    files = ['{}/{}'.format(table_path.rstrip('/'), path) for path in prune_files(table_path, predicates, settings)]
+    if not files:
+        schema_file = _schema_file(table_path, settings)
+        if schema_file is None:
+            from pyspark.sql.types import StructType
+            return spark.createDataFrame([], StructType([]))
+        return spark.read.option('basePath', table_path).parquet(
+            '{}/{}'.format(table_path.rstrip('/'), schema_file)).limit(0)
+    df = spark.read.option('basePath', table_path).parquet(*files)
+    for column, predicate in predicates.items():
+        low, high = predicate if isinstance(predicate, tuple) else (predicate, predicate)
+        if low is not None:
+            df = df.where(df[column] >= low)
+        if high is not None:
+            df = df.where(df[column] <= high)
+    return df
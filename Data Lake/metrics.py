@@ -0,0 +1,228 @@
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from pyspark.sql import functions as F
+
+
+class StageRecord:
+    '''
+    Description :
+        - Holds the measurements of one logical stage of the ETL job
+        - input and output register the dataframes of the stage, without a StageMetrics they are left as they are
+    '''
+
+    def __init__(self, name, output_path=None, metrics=None):
+        self.name = name
+        self.output_path = output_path
+        self.stage_metrics = metrics
+        self.output_df = None
+        self.metrics = {'stage': name, 'output_path': output_path}
+
+    def input(self, df):
+        if self.stage_metrics is not None:
+            self.metrics['input_rows'] = self.stage_metrics.materialize(df)
+        return df
+
+    def output(self, df):
+        self.output_df = df
+        if self.stage_metrics is not None:
+            self.metrics['output_rows'] = self.stage_metrics.materialize(df)
+        return df
+
+
+class StageMetrics:
+    '''
+    Description :
+        - Wraps each logical stage of the ETL job (read, extract, dedup, join, write)
+        - Runs every stage under its own spark job group so that the jobs and stages reported by
+          the spark status API can be attributed to it
+        - Materializes the dataframes a stage registers inside its timed block, persisted and counted under
+          its job group, so the lazy extract and dedup stages are billed the work and shuffle of their plans
+          and the later stages read them from the cache instead of recomputing them
+        - Captures wall time, input/output row counts, bytes written, shuffle read/write and
+          the row distribution over the output partitions
+        - Writes everything to a JSON run report
+    '''
+
+    def __init__(self, spark, measure_skew=True):
+        self.spark = spark
+        self.sc = spark.sparkContext
+        self.measure_skew = measure_skew
+        self.records = []
+        # persisted dataframes and their row counts by id, the list keeps the ids from being reused
+        self.persisted = []
+        self.rows = {}
+        self.started_at = datetime.utcnow()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, output_path=None):
+        '''
+        Description : Time the wrapped block as stage `name`, its registered dataframes are materialized within
+                      it and their partition skew is measured afterwards
+        Arguments :
+            - name : stage name, also used as spark job group
+            - output_path : path written by the stage, its size is recorded as bytes written
+        Returns :
+            - StageRecord to register the input and output dataframes on
+        '''
+        record = StageRecord(name, output_path, self)
+        self.sc.setJobGroup(name, name)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.metrics['wall_time_s'] = round(time.perf_counter() - start, 3)
+            self.sc.setJobGroup('{}:metrics'.format(name), 'metrics of {}'.format(name))
+            self._measure(record)
+            self.sc.setLocalProperty('spark.jobGroup.id', None)
+            self.records.append(record)
+
+    def materialize(self, df):
+        '''
+        Description : Persist and count a dataframe, once, in the job group of the current stage
+        Returns :
+            - row count
+        '''
+        if id(df) not in self.rows:
+            df.persist()
+            self.persisted.append(df)
+            self.rows[id(df)] = df.count()
+        return self.rows[id(df)]
+
+    def release(self):
+        '''
+        Description : Unpersist the dataframes materialized by the stages, at the end of the run
+        '''
+        for df in self.persisted:
+            df.unpersist()
+        self.persisted = []
+        self.rows = {}
+
+    def _measure(self, record):
+        if self.measure_skew and record.output_df is not None:
+            record.metrics['partition_skew'] = partition_skew(record.output_df)
+        if record.output_path:
+            record.metrics['bytes_written'] = self._path_size(record.output_path)
+
+    def _path_size(self, path):
+        jvm = self.spark._jvm
+        hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+        fs = hadoop_path.getFileSystem(self.sc._jsc.hadoopConfiguration())
+        if not fs.exists(hadoop_path):
+            return 0
+        return fs.getContentSummary(hadoop_path).getLength()
+
+    def _task_metrics(self, job_group):
+        '''
+        Description : Sum the task metrics of all stages run by the jobs of a job group
+            - Reads the REST status API of the spark UI which carries the shuffle and output byte counts
+            - Falls back to task counts of the status tracker when the UI is disabled
+        Arguments :
+            - job_group : spark job group of the stage
+        Returns :
+            - dict of summed metrics
+        '''
+        totals = {'jobs': 0, 'spark_stages': 0, 'tasks': 0, 'shuffle_read_bytes': 0,
+                  'shuffle_write_bytes': 0, 'output_bytes': 0, 'executor_run_time_ms': 0}
+        url = self.sc.uiWebUrl
+        if url:
+            try:
+                api = '{}/api/v1/applications/{}'.format(url, self.sc.applicationId)
+                jobs = [job for job in _get_json(api + '/jobs') if job.get('jobGroup') == job_group]
+                totals['jobs'] = len(jobs)
+                for stage_id in sorted({stage_id for job in jobs for stage_id in job['stageIds']}):
+                    for attempt in _get_json('{}/stages/{}'.format(api, stage_id)):
+                        if attempt.get('status') == 'SKIPPED':
+                            continue
+                        totals['spark_stages'] += 1
+                        totals['tasks'] += attempt.get('numCompleteTasks', 0)
+                        totals['shuffle_read_bytes'] += attempt.get('shuffleReadBytes', 0)
+                        totals['shuffle_write_bytes'] += attempt.get('shuffleWriteBytes', 0)
+                        totals['output_bytes'] += attempt.get('outputBytes', 0)
+                        totals['executor_run_time_ms'] += attempt.get('executorRunTime', 0)
+                return totals
+            except (URLError, ValueError, KeyError):
+                pass
+
+        tracker = self.sc.statusTracker()
+        for job_id in tracker.getJobIdsForGroup(job_group):
+            job = tracker.getJobInfo(job_id)
+            if job is None:
+                continue
+            totals['jobs'] += 1
+            for stage_id in job.stageIds:
+                stage = tracker.getStageInfo(stage_id)
+                if stage is not None:
+                    totals['spark_stages'] += 1
+                    totals['tasks'] += stage.numCompletedTasks
+        return totals
+
+    def report(self):
+        '''
+        Description : Build the run report, the task metrics are read at the end of the run
+            so that the listener bus has caught up with every finished job
+        Returns :
+            - dict of run level and per stage metrics
+        '''
+        stages = []
+        for record in self.records:
+            metrics = dict(record.metrics)
+            metrics.update(self._task_metrics(record.name))
+            stages.append(metrics)
+        return {
+            'application_id': self.sc.applicationId,
+            'started_at': self.started_at.isoformat(),
+            'wall_time_s': round(time.perf_counter() - self.start, 3),
+            'spark_conf': {key: self.sc.getConf().get(key) for key in (
+                'spark.master', 'spark.sql.shuffle.partitions', 'spark.sql.adaptive.enabled',
+                'spark.driver.memory', 'spark.executor.memory')},
+            'stages': stages,
+        }
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NullMetrics:
+    '''
+    Description : Stand-in for StageMetrics when no run report is requested, records nothing
+    '''
+
+    @contextmanager
+    def stage(self, name, output_path=None):
+        yield StageRecord(name, output_path)
+
+    def write_report(self, path):
+        pass
+
+
+def partition_skew(df):
+    '''
+    Description : Row distribution over the partitions of a dataframe
+    Arguments :
+        - df : spark dataframe
+    Returns :
+        - dict with partition count, min/max/mean rows and max to mean ratio
+    '''
+    counts = [row['count'] for row in df.groupBy(F.spark_partition_id()).count().collect()]
+    if not counts:
+        return {'partitions': 0, 'min_rows': 0, 'max_rows': 0, 'mean_rows': 0, 'skew': 0}
+    mean = sum(counts) / len(counts)
+    return {
+        'partitions': len(counts),
+        'min_rows': min(counts),
+        'max_rows': max(counts),
+        'mean_rows': round(mean, 1),
+        'skew': round(max(counts) / mean, 2) if mean else 0,
+    }
+
+
+def _get_json(url):
+    with urlopen(url, timeout=10) as response:
+        return json.loads(response.read().decode('utf-8'))
@@ -0,0 +1,124 @@
+from pyspark.sql import functions as F
+
+
+# number of register index bits of the HyperLogLog sketches, 2^10 registers give ~3% standard error
+HLL_PRECISION = 10
+
+# rollup name : dimension columns, every rollup is additionally grouped and partitioned by day
+ROLLUPS = {
+    'plays_by_hour': ['hour'],
+    'plays_by_level': ['level'],
+    'plays_by_artist': ['artist_id'],
+    'plays_by_location': ['location'],
+}
+
+
+def hll_registers(user_col, precision=HLL_PRECISION):
+    '''
+    Description : Register index and rank of a HyperLogLog sketch for every row
+        - The 32 bit murmur3 hash of the value is split into `precision` index bits and the remaining bits
+        - The rank is the position of the first set bit of the remaining bits
+    Arguments :
+        - user_col : column to count distinct values of
+        - precision : number of register index bits
+    Returns :
+        - (index column, rank column)
+    '''
+    width = 32 - precision
+    hashed = F.hash(user_col).cast('long').bitwiseAND(F.lit(0xFFFFFFFF))
+    index = hashed.bitwiseAND(F.lit((1 << precision) - 1))
+    remaining = F.shiftRight(hashed, precision)
+    rank = F.when(remaining == 0, F.lit(width + 1)) \
+        .otherwise(F.lit(width + 1) - F.length(F.bin(remaining)))
+    return index.cast('int'), rank.cast('int')
+
+
+def hll_sketch_agg(df, group_cols, user_col='user_id', precision=HLL_PRECISION):
+    '''
+    Description : Aggregate a sparse HyperLogLog sketch (register index -> max rank map) per group
+    Arguments :
+        - df : spark dataframe
+        - group_cols : list of grouping columns
+        - user_col : column to count distinct values of
+        - precision : number of register index bits
+    Returns :
+        - dataframe of group_cols and a user_sketch map column
+    '''
+    index, rank = hll_registers(F.col(user_col), precision)
+    registers = df.where(F.col(user_col).isNotNull()) \
+        .select(*group_cols, index.alias('register'), rank.alias('rank')) \
+        .groupBy(*group_cols, 'register').agg(F.max('rank').alias('rank'))
+    return registers.groupBy(*group_cols).agg(
+        F.map_from_entries(F.collect_list(F.struct('register', 'rank'))).alias('user_sketch'))
+
+
+def hll_estimate(df, group_cols, sketch_col='user_sketch', precision=HLL_PRECISION):
+    '''
+    Description : Merge sketches over every row of a group and estimate the distinct count
+        - Sketches are merged by taking the max rank per register, so sketches of different days,
+          hours or levels can be combined without going back to the fact table
+        - Uses linear counting for small cardinalities
+    Arguments :
+        - df : dataframe with a sketch column, e.g. a rollup table
+        - group_cols : list of columns to merge the sketches over, [] merges all rows
+        - sketch_col : name of the sketch column
+        - precision : number of register index bits
+    Returns :
+        - dataframe of group_cols and approx_distinct_users
+    '''
+    m = 1 << precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+    merged = df.select(*group_cols, F.explode(sketch_col).alias('register', 'rank')) \
+        .groupBy(*group_cols, 'register').agg(F.max('rank').alias('rank'))
+    stats = merged.groupBy(*group_cols).agg(
+        F.count('*').alias('filled'),
+        F.sum(F.pow(F.lit(2.0), -F.col('rank'))).alias('harmonic'))
+    empty = F.lit(m) - F.col('filled')
+    raw = F.lit(alpha * m * m) / (F.col('harmonic') + empty)
+    estimate = F.when((raw <= 2.5 * m) & (empty > 0), F.lit(m) * F.log(F.lit(float(m)) / empty)) \
+        .otherwise(raw)
+    return stats.select(*group_cols, F.round(estimate).cast('long').alias('approx_distinct_users'))
+
+
+def build_rollups(songplays_table):
+    '''
+    Description :
+        - Derive a day column from start_time of the songplays fact table
+        - Aggregate plays, sessions and a distinct user sketch per day and rollup dimension
+    Arguments :
+        - songplays_table : songplays dataframe of the current run
+    Returns :
+        - dict of rollup name -> dataframe, to be written partitioned by day
+    '''
+    plays = songplays_table.withColumn('day', F.to_date('start_time')) \
+        .withColumn('hour', F.hour('start_time'))
+
+    rollups = {}
+    for name, dims in ROLLUPS.items():
+        group_cols = ['day'] + dims
+        counts = plays.groupBy(*group_cols).agg(
+            F.count('*').alias('plays'),
+            F.countDistinct('session_id').alias('sessions'))
+        sketches = hll_sketch_agg(plays, group_cols)
+        rollups[name] = counts.join(sketches, group_cols, 'left_outer')
+    return rollups
+
+
+def distinct_users(spark, output_data, rollup, group_cols=None, start_day=None, end_day=None):
+    '''
+    Description : Approximate distinct users over a day range from a rollup table without scanning songplays
+    Arguments :
+        - spark : spark session
+        - output_data : output file path of the ETL job
+        - rollup : rollup name, key of ROLLUPS
+        - group_cols : columns to report per, e.g. ['level'], [] for one total
+        - start_day, end_day : inclusive day range as 'YYYY-MM-DD', open when None
+    Returns :
+        - dataframe of group_cols and approx_distinct_users
+    '''
+    df = spark.read.parquet("{}/rollups/{}.parquet".format(output_data, rollup))
+    if start_day:
+        df = df.where(F.col('day') >= start_day)
+    if end_day:
+        df = df.where(F.col('day') <= end_day)
+    return hll_estimate(df, group_cols or [])
@@ -0,0 +1,235 @@
+import argparse
+import configparser
+import os
+import sys
+
+
+STORAGE_BACKENDS = ('s3', 'mock_s3', 'local')
+ENGINES = ('spark', 'arrow')
+
+DEFAULT_SETTINGS = {
+    'engine': 'spark',
+    'backend': 's3',
+    'input_data': 's3a://udacity-dend/',
+    'output_data': 's3a://sparkify-out/',
+    's3_endpoint': '',
+    'master': '',
+    'hadoop_aws_package': 'org.apache.hadoop:hadoop-aws:2.7.0',
+    'shuffle_partitions': '200',
+    'adaptive_enabled': 'true',
+    'driver_memory': '',
+    'executor_memory': '',
+    'metrics_report': '',
+    'rollups': 'false',
+    'manifests': 'false',
+    'table_log': 'false',
+    'event_filter': '',
+    'event_filter_capacity': '1000000',
+    'event_filter_error_rate': '0.001',
+    'checkpoint': '',
+    'trigger_seconds': '10',
+    'watermark': '1 day',
+    'song_refresh_seconds': '600',
+    'max_files_per_trigger': '100',
+    'available_now': 'false',
+}
+
+
+# tables written by a run and their partition columns, relative to the output data path
+OUTPUT_TABLES = {
+    'songs/songs_table.parquet': ['year', 'artist_id'],
+    'songs/artists_table.parquet': [],
+    'songs/users_table.parquet': [],
+    'songs/time_table.parquet': ['year', 'month'],
+    'songs/songplays_table.parquet': ['year', 'month'],
+}
+
+# tables appended to by streaming.py, songs and artists are loaded by the batch job
+STREAM_TABLES = ('songs/users_table.parquet', 'songs/time_table.parquet', 'songs/songplays_table.parquet')
+
+# event_filter.py is shared with the Postgres ETL and lives at the repository root
+EVENT_FILTER_MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'event_filter.py')
+
+
+def load_settings(config_path='dl.cfg', profile=None, overrides=None):
+    '''
+    Description :
+        - Read the config file for storage and spark settings
+        - Apply the settings of the selected profile section on top of STORAGE, SPARK, ETL and STREAM
+        - Apply command line overrides last
+        - Export AWS credentials to the environment when they are set
+    Arguments :
+        - config_path : path of the config file
+        - profile : name of the profile section, e.g. local
+        - overrides : dict of settings given on the command line, None values are ignored
+    Returns :
+        - dict of settings
+    '''
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    settings = dict(DEFAULT_SETTINGS)
+    for section in ('STORAGE', 'SPARK', 'ETL', 'STREAM'):
+        if config.has_section(section):
+            settings.update(config[section])
+
+    if profile:
+        if not config.has_section(profile):
+            raise ValueError("Profile '{}' not found in {}".format(profile, config_path))
+        settings.update(config[profile])
+
+    settings.update({key: value for key, value in (overrides or {}).items() if value is not None})
+
+    if settings['backend'] not in STORAGE_BACKENDS:
+        raise ValueError("Unknown storage backend '{}'".format(settings['backend']))
+    if settings['engine'] not in ENGINES:
+        raise ValueError("Unknown engine '{}'".format(settings['engine']))
+
+    if config.has_section('AWS'):
+        for key in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            if config['AWS'].get(key):
+                os.environ[key] = config['AWS'][key]
+
+    return settings
+
+
+def parse_args(argv=None):
+    '''
+    Description : Parse command line options, every option overrides the matching config setting
+    Arguments :
+        - argv : list of arguments, sys.argv is used when None
+    Returns :
+        - argparse namespace
+    '''
+    parser = argparse.ArgumentParser(description='Sparkify Data Lake ETL')
+    parser.add_argument('--config', default='dl.cfg', help='path of the config file')
+    parser.add_argument('--profile', help='config section overriding STORAGE and SPARK, e.g. local')
+    parser.add_argument('--engine', choices=ENGINES,
+                        help='spark, or arrow for single node runs without a spark session')
+    parser.add_argument('--backend', choices=STORAGE_BACKENDS, help='storage backend')
+    parser.add_argument('--input', dest='input_data', help='input data URI')
+    parser.add_argument('--output', dest='output_data', help='output data URI')
+    parser.add_argument('--s3-endpoint', dest='s3_endpoint', help='endpoint of the mock_s3 backend')
+    parser.add_argument('--master', help='spark master, e.g. local[4]')
+    parser.add_argument('--shuffle-partitions', dest='shuffle_partitions', help='spark.sql.shuffle.partitions')
+    parser.add_argument('--adaptive', dest='adaptive_enabled', choices=('true', 'false'),
+                        help='spark.sql.adaptive.enabled')
+    parser.add_argument('--driver-memory', dest='driver_memory', help='spark.driver.memory')
+    parser.add_argument('--executor-memory', dest='executor_memory', help='spark.executor.memory')
+    parser.add_argument('--rollups', action='store_const', const='true',
+                        help='materialize the day partitioned rollup tables after process_log_data')
+    parser.add_argument('--manifests', action='store_const', const='true',
+                        help='write a _manifest.json with file level partition values and min/max per table')
+    parser.add_argument('--table-log', dest='table_log', action='store_const', const='true',
+                        help='write every table as a new version of a snapshot table with a commit log (table_log.py)')
+    parser.add_argument('--event-filter', dest='event_filter',
+                        help='local path of the filter of the loaded song play events, streaming.py skips the events '
+                             'already in songplays and the batch jobs drop repeated events and rebuild it')
+    parser.add_argument('--event-filter-capacity', dest='event_filter_capacity',
+                        help='events a new event filter is sized for')
+    parser.add_argument('--event-filter-error-rate', dest='event_filter_error_rate',
+                        help='false positive rate of a new event filter at capacity')
+    parser.add_argument('--checkpoint', help='checkpoint location of streaming.py, <output>/_checkpoints/log_data when unset')
+    parser.add_argument('--trigger-seconds', dest='trigger_seconds', help='micro-batch interval of streaming.py')
+    parser.add_argument('--watermark', help='event time delay after which streaming.py drops late events and '
+                                            'forgets them for deduplication, e.g. "1 day"')
+    parser.add_argument('--song-refresh-seconds', dest='song_refresh_seconds',
+                        help='seconds after which streaming.py re-reads the broadcast song dimension')
+    parser.add_argument('--max-files-per-trigger', dest='max_files_per_trigger',
+                        help='new log files read per micro-batch by streaming.py')
+    parser.add_argument('--available-now', dest='available_now', action='store_const', const='true',
+                        help='process the log files present at start in micro-batches and stop (streaming.py)')
+    parser.add_argument('--metrics-report', dest='metrics_report',
+                        help='write a JSON report of per stage timings, row counts, shuffle and skew to this path')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='print the inputs and outputs of the run without starting spark or touching storage')
+    return parser.parse_args(argv)
+
+
+def settings_from_args(args):
+    '''
+    Description : Settings of the config file and profile given on the command line, with the other options
+                  as overrides
+    Arguments :
+        - args : namespace returned by parse_args
+    Returns :
+        - dict of settings
+    '''
+    overrides = {key: value for key, value in vars(args).items() if key not in ('config', 'profile', 'dry_run')}
+    return load_settings(args.config, args.profile, overrides)
+
+
+def open_event_filter(settings, new=False):
+    '''
+    Description : The filter of the loaded song play events at the event_filter path, see event_filter.py
+    Arguments :
+        - settings : settings returned by load_settings
+        - new : an empty filter sized by event_filter_capacity and event_filter_error_rate instead of the saved one,
+                which it replaces once it is saved
+    Returns :
+        - EventFilter, None when event_filter is not set
+    '''
+    if not settings['event_filter']:
+        return None
+    if os.path.dirname(EVENT_FILTER_MODULE) not in sys.path:
+        sys.path.append(os.path.dirname(EVENT_FILTER_MODULE))
+    from event_filter import EventFilter
+    capacity, error_rate = int(settings['event_filter_capacity']), float(settings['event_filter_error_rate'])
+    if new:
+        return EventFilter.for_capacity(capacity, error_rate, settings['event_filter'])
+    return EventFilter.open(settings['event_filter'], capacity, error_rate)
+
+
+def save_merged_event_filter(event_filter, settings):
+    '''
+    Description : Save the saved event filter merged with event_filter, before a batch job replaces the songplays
+                  the saved filter describes with those of event_filter, so that until the job saves event_filter
+                  the filter knows the events of both. Filters of another size are left as they are
+    Arguments :
+        - event_filter : EventFilter of the songplays about to be written
+        - settings : settings returned by load_settings
+    Returns :
+        - None
+    '''
+    saved = open_event_filter(settings)
+    if (saved.num_bits, saved.num_hashes) == (event_filter.num_bits, event_filter.num_hashes):
+        saved.merge(event_filter).save()
+
+
+def stream_checkpoint(settings):
+    '''
+    Description : Checkpoint location of streaming.py, <output>/_checkpoints/log_data when checkpoint is unset
+    '''
+    return settings['checkpoint'] or '{}/_checkpoints/log_data'.format(settings['output_data'].rstrip('/'))
+
+
+def print_plan(settings, streaming=False):
+    '''
+    Description : Print the engine, the inputs and the output tables of a run, a --dry-run of etl.py
+                  or of streaming.py
+    Arguments :
+        - settings : settings returned by load_settings
+        - streaming : plan of streaming.py, which appends users, time and songplays from log_data
+    Returns :
+        - None
+    '''
+    print('engine {}, backend {}'.format('spark streaming' if streaming else settings['engine'], settings['backend']))
+    for source in ('song_data/*/*/*/*.json', 'log_data/*/*/*.json'):
+        print('read  {}'.format(os.path.join(settings['input_data'], source)))
+    tables = dict(OUTPUT_TABLES)
+    if streaming:
+        tables = {table: partition_by for table, partition_by in tables.items() if table in STREAM_TABLES}
+    elif settings['rollups'] == 'true':
+        tables.update(('rollups/{}.parquet'.format(name), ['day'])
+                      for name in ('plays_by_hour', 'plays_by_level', 'plays_by_artist', 'plays_by_location'))
+    for table, partition_by in tables.items():
+        print('write {}/{}{}'.format(settings['output_data'].rstrip('/'), table,
+                                     ' partitioned by {}'.format(', '.join(partition_by)) if partition_by else ''))
+    keys = ['master', 'shuffle_partitions', 'adaptive_enabled', 'manifests', 'table_log', 'event_filter']
+    if streaming:
+        print('checkpoint = {}'.format(stream_checkpoint(settings)))
+        keys += ['trigger_seconds', 'available_now', 'watermark', 'max_files_per_trigger', 'song_refresh_seconds']
+    else:
+        keys.append('metrics_report')
+    for key in keys:
+        print('{} = {}'.format(key, settings[key]))
@@ -0,0 +1,22 @@
+import os
+
+from pyarrow import fs as pafs
+
+
+def filesystem_for(uri, settings):
+    '''
+    Description : Resolve a data URI of the settings to a pyarrow filesystem and a path on it
+    Arguments :
+        - uri : s3a://, s3:// or local path
+        - settings : settings returned by load_settings
+    Returns :
+        - (filesystem, path)
+    '''
+    if uri.startswith(('s3a://', 's3://')):
+        path = uri.split('://', 1)[1].rstrip('/')
+        if settings['backend'] == 'mock_s3':
+            endpoint = settings['s3_endpoint']
+            scheme = 'https' if endpoint.startswith('https') else 'http'
+            return pafs.S3FileSystem(endpoint_override=endpoint.split('://')[-1], scheme=scheme), path
+        return pafs.S3FileSystem(), path
+    return pafs.LocalFileSystem(), os.path.abspath(uri)
@@ -0,0 +1,351 @@
+import os
+import time
+
+from settings import open_event_filter, parse_args, print_plan, settings_from_args, stream_checkpoint
+
+
+# pyspark and the modules that import it are imported by the functions using them, so that a --dry-run
+# does not need spark
+
+
+def log_data_schema():
+    '''
+    Description : Schema of the log_data files, a file stream cannot infer it and the batch job infers the same types
+    '''
+    from pyspark.sql.types import DoubleType, LongType, StringType, StructField, StructType
+    return StructType([
+        StructField('artist', StringType()),
+        StructField('auth', StringType()),
+        StructField('firstName', StringType()),
+        StructField('gender', StringType()),
+        StructField('itemInSession', LongType()),
+        StructField('lastName', StringType()),
+        StructField('length', DoubleType()),
+        StructField('level', StringType()),
+        StructField('location', StringType()),
+        StructField('method', StringType()),
+        StructField('page', StringType()),
+        StructField('registration', DoubleType()),
+        StructField('sessionId', LongType()),
+        StructField('song', StringType()),
+        StructField('status', LongType()),
+        StructField('ts', LongType()),
+        StructField('userAgent', StringType()),
+        StructField('userId', StringType()),
+    ])
+
+
+def song_data_schema():
+    '''
+    Description : Schema of the song_data files, see log_data_schema
+    '''
+    from pyspark.sql.types import DoubleType, LongType, StringType, StructField, StructType
+    return StructType([
+        StructField('artist_id', StringType()),
+        StructField('artist_latitude', DoubleType()),
+        StructField('artist_location', StringType()),
+        StructField('artist_longitude', DoubleType()),
+        StructField('artist_name', StringType()),
+        StructField('duration', DoubleType()),
+        StructField('num_songs', LongType()),
+        StructField('song_id', StringType()),
+        StructField('title', StringType()),
+        StructField('year', LongType()),
+    ])
+
+
+class SongDimension:
+    '''
+    Description :
+        - Song lookup of the songplays join, cached on the executors and joined with a broadcast hint
+        - Re-read from song_data once it is older than refresh_seconds, so songs added while the stream
+          runs are matched by the following micro-batches
+    '''
+
+    def __init__(self, spark, input_data, refresh_seconds):
+        self.spark = spark
+        self.song_data = os.path.join(input_data, 'song_data', '*', '*', '*', '*.json')
+        self.refresh_seconds = refresh_seconds
+        self.df = None
+        self.loaded_at = None
+
+    def get(self):
+        '''
+        Description : The song dimension, refreshed when it is stale
+        Returns :
+            - dataframe of title, artist_name, duration, song_id and artist_id marked for broadcast
+        '''
+        from pyspark.sql import functions as F
+        from pyspark.sql.functions import col
+
+        if self.df is None or time.time() - self.loaded_at >= self.refresh_seconds:
+            if self.df is not None:
+                self.df.unpersist()
+            self.df = self.spark.read.schema(song_data_schema()).json(self.song_data) \
+                .select('title', 'artist_name', 'duration', 'song_id', 'artist_id') \
+                .where(col('title').isNotNull() & col('artist_name').isNotNull() & col('duration').isNotNull()) \
+                .dropDuplicates(['title', 'artist_name', 'duration']) \
+                .cache()
+            self.df.count()
+            self.loaded_at = time.time()
+        return F.broadcast(self.df)
+
+
+def read_log_stream(spark, input_data, settings):
+    '''
+    Description :
+        - Watch the log_data directories for new .json files with the declared schema
+        - Keep the NextSong events and derive user_id and start_time like process_log_data
+        - Drop events replayed within the watermark, e.g. from a log file copied twice,
+          by their canonical key (userId, sessionId, itemInSession, ts)
+    Arguments :
+        - spark : spark session
+        - input_data : source file path
+        - settings : settings returned by load_settings
+    Returns :
+        - streaming dataframe of deduplicated song play events
+    '''
+    from pyspark.sql import functions as F
+    from pyspark.sql.types import IntegerType
+
+    df = spark.readStream.schema(log_data_schema()) \
+        .option('maxFilesPerTrigger', int(settings['max_files_per_trigger'])) \
+        .json(os.path.join(input_data, 'log_data/*/*/*.json'))
+
+    # process_log_data converts ts with utcfromtimestamp, whose naive UTC wall clock spark reads in the
+    # session time zone, to_utc_timestamp yields the same value without a python udf
+    session_zone = spark.conf.get('spark.sql.session.timeZone')
+    df = df.filter(df.page == 'NextSong') \
+        .withColumn('user_id', df.userId.cast(IntegerType())) \
+        .withColumn('start_time', F.to_utc_timestamp((df.ts / 1000).cast('timestamp'), session_zone))
+
+    return df.withWatermark('start_time', settings['watermark']) \
+        .dropDuplicates(['userId', 'sessionId', 'itemInSession', 'ts', 'start_time'])
+
+
+def read_output(spark, output_data, table, settings):
+    '''
+    Description : The rows of an output table appended so far, None before the first micro-batch
+    Arguments :
+        - spark : spark session
+        - output_data : output file path
+        - table : table name, e.g. songplays_table
+        - settings : settings returned by load_settings
+    Returns :
+        - dataframe, or None
+    '''
+    from pyspark.sql.utils import AnalysisException
+    from table_log import SnapshotTable
+
+    path = "{}/songs/{}.parquet".format(output_data, table)
+    if settings['table_log'] == 'true':
+        snapshot = SnapshotTable(path, settings).snapshot()
+        return snapshot.to_spark(spark, path) if snapshot.files else None
+    try:
+        return spark.read.parquet(path)
+    except AnalysisException:
+        return None
+
+
+def loaded_events(df, broadcast, output_data, settings):
+    '''
+    Description :
+        - Find the events of a micro-batch that are already in songplays, e.g. from a log file copied under
+          another name or replayed after the watermark
+        - Only the events the broadcast event filter has seen are looked up, in the year and month partitions
+          of songplays and by songplay_id, user_id, session_id and start_time
+    Arguments :
+        - df : dataframe of the micro-batch with songplay_id and date
+        - broadcast : spark broadcast of the EventFilter
+        - output_data : output file path
+        - settings : settings returned by load_settings
+    Returns :
+        - dataframe of the songplay_id of the loaded events, None when there are none
+    '''
+    from pyspark.sql import functions as F
+    from pyspark.sql.functions import col
+    from etl import seen_events
+
+    keys = ['songplay_id', 'user_id', 'session_id', 'start_time', 'year', 'month']
+    seen = df.where(seen_events(broadcast)).select(
+        'songplay_id', 'user_id', col('sessionId').alias('session_id'), 'start_time',
+        F.year('date').alias('year'), F.month('date').alias('month'))
+    if seen.rdd.isEmpty():
+        return None
+    songplays = read_output(df.sparkSession, output_data, 'songplays_table', settings)
+    if songplays is None:
+        return None
+    return seen.join(songplays.select(*keys), keys, 'left_semi').select('songplay_id')
+
+
+def new_rows(df, output_data, table, settings):
+    '''
+    Description : The rows of a dimension that are not in the output table yet, compared on every column with
+                  null-safe equality. Keeps users and time free of duplicates across micro-batches and when a
+                  micro-batch is processed again after its writes
+    Arguments :
+        - df : dataframe of the dimension rows of a micro-batch
+        - output_data : output file path
+        - table : table name of the dimension
+        - settings : settings returned by load_settings
+    Returns :
+        - dataframe
+    '''
+    existing = read_output(df.sparkSession, output_data, table, settings)
+    if existing is None:
+        return df
+    existing = existing.select(*df.columns)
+    condition = None
+    for column in df.columns:
+        equal = df[column].eqNullSafe(existing[column])
+        condition = equal if condition is None else condition & equal
+    return df.join(existing, condition, 'left_anti')
+
+
+def process_batch(df, batch_id, songs, output_data, settings, event_filter=None):
+    '''
+    Description :
+        - Derive users, time and songplays from one micro-batch of events like process_log_data
+        - With an event filter, drop the events already in songplays first, see loaded_events, and add the
+          others to the filter. It is saved before the tables are appended to, a micro-batch failing
+          afterwards runs again and its events are then checked against songplays
+        - Join the events with the broadcast song dimension on title, artist name and duration
+        - Append the tables to the parquet layout of the batch job, users and time are deduplicated
+          within the micro-batch and against the rows already appended, see new_rows. Songplays already
+          appended are dropped by songplay_id, year and month, a replayed micro-batch does not duplicate them
+          when the event filter is off
+        - songplay_id is the xxhash64 of the event key, the same event gets the same id in every batch and run
+    Arguments :
+        - df : dataframe of the micro-batch
+        - batch_id : id of the micro-batch
+        - songs : SongDimension
+        - output_data : output file path
+        - settings : settings returned by load_settings
+        - event_filter : EventFilter of the loaded events, or None to load every event
+    Returns :
+        - None
+    '''
+    from pyspark.sql import functions as F
+    from pyspark.sql.functions import col
+    from etl import build_event_filter, write_parquet
+
+    if df.rdd.isEmpty():
+        return
+    events = df.withColumn('date', F.to_date('start_time')) \
+        .withColumn('songplay_id', F.xxhash64('userId', 'sessionId', 'itemInSession', 'ts')) \
+        .persist()
+    df = events
+    if event_filter is not None:
+        broadcast = df.sparkSession.sparkContext.broadcast(event_filter)
+        loaded = loaded_events(events, broadcast, output_data, settings)
+        if loaded is not None:
+            df = events.join(loaded, 'songplay_id', 'left_anti').persist()
+        build_event_filter(df, event_filter).save()
+        broadcast.unpersist()
+
+    users_table = df.select('user_id',
+                            col('firstName').alias('first_name'),
+                            col('lastName').alias('last_name'),
+                            col('gender').alias('gender'),
+                            'level').where(col('user_id').isNotNull()).dropDuplicates()
+    users_table = new_rows(users_table, output_data, 'users_table', settings)
+    write_parquet(users_table, "{}/songs/users_table.parquet".format(output_data), None, settings=settings,
+                  mode='append')
+
+    time_table = df.select(col('start_time'),
+                           F.hour('start_time').alias('hour'),
+                           F.dayofmonth('date').alias('day'),
+                           F.weekofyear('date').alias('week'),
+                           F.month('date').alias('month'),
+                           F.year('date').alias('year'),
+                           F.date_format('date', 'E').alias('weekday')).dropDuplicates()
+    time_table = new_rows(time_table, output_data, 'time_table', settings)
+    write_parquet(time_table, "{}/songs/time_table.parquet".format(output_data), ["year", "month"],
+                  settings=settings, mode='append')
+
+    song_df = songs.get()
+    songplays_table = df.join(song_df,
+                              (df['song'] == song_df['title']) &
+                              (df['length'] == song_df['duration']) &
+                              (df['artist'] == song_df['artist_name']), 'left_outer').select(
+        df.songplay_id,
+        df.start_time,
+        df.user_id,
+        df.level,
+        song_df.song_id,
+        song_df.artist_id,
+        df.sessionId.alias('session_id'),
+        df.location,
+        df.userAgent.alias('user_agent'),
+        F.year('date').alias('year'),
+        F.month('date').alias('month'))
+    appended = read_output(df.sparkSession, output_data, 'songplays_table', settings)
+    if appended is not None:
+        keys = ['songplay_id', 'year', 'month']
+        songplays_table = songplays_table.join(appended.select(*keys), keys, 'left_anti') \
+            .select(*songplays_table.columns)
+    write_parquet(songplays_table, "{}/songs/songplays_table.parquet".format(output_data), ["year", "month"],
+                  settings=settings, mode='append')
+
+    df.unpersist()
+    events.unpersist()
+    print('micro-batch {} loaded'.format(batch_id))
+
+
+def start_stream(spark, settings):
+    '''
+    Description :
+        - Start the streaming query loading log_data into users, time and songplays with process_batch
+        - Progress is kept in the checkpoint location, a restarted query only reads files it has not committed,
+          a micro-batch interrupted between its writes and its commit is processed again
+        - With an event filter configured, events already in songplays are dropped across restarts and
+          beyond the watermark, see process_batch
+    Arguments :
+        - spark : spark session
+        - settings : settings returned by load_settings
+    Returns :
+        - streaming query
+    '''
+    from etl import ship_event_filter
+
+    input_data = settings['input_data']
+    output_data = settings['output_data']
+    checkpoint = stream_checkpoint(settings)
+    songs = SongDimension(spark, input_data, float(settings['song_refresh_seconds']))
+    event_filter = open_event_filter(settings)
+    if event_filter is not None:
+        ship_event_filter(spark)
+
+    writer = read_log_stream(spark, input_data, settings).writeStream \
+        .foreachBatch(lambda df, batch_id: process_batch(df, batch_id, songs, output_data, settings, event_filter)) \
+        .option('checkpointLocation', checkpoint)
+    if settings['available_now'] == 'true':
+        writer = writer.trigger(availableNow=True)
+    else:
+        writer = writer.trigger(processingTime='{} seconds'.format(settings['trigger_seconds']))
+    return writer.start()
+
+
+def main(argv=None):
+    '''
+    Description : Streaming variant of process_log_data, takes the same options as etl.py, e.g.
+                  `python streaming.py --profile local --available-now`
+        - songs and artists are still loaded by the batch job
+    '''
+    args = parse_args(argv)
+    settings = settings_from_args(args)
+    if args.dry_run:
+        print_plan(settings, streaming=True)
+        return
+
+    from etl import create_spark_session
+    spark = create_spark_session(settings)
+    query = start_stream(spark, settings)
+    try:
+        query.awaitTermination()
+    except KeyboardInterrupt:
+        query.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,547 @@
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs as pafs
+
+from manifest import STATS_COLUMNS, _filter_expression, _may_contain, file_entry, table_name
+from storage import filesystem_for
+
+
+# Snapshot tables keep every version of a table as an append-only log of commits next to the data:
+#   <table>/_log/00000000000000000003.json   files added and removed by version 3
+#   <table>/_log/00000000000000000010.checkpoint.json   full file list of version 10, written every
+#                                                       CHECKPOINT_INTERVAL versions
+#   <table>/_log/_last_checkpoint   version of the latest checkpoint
+#   <table>/_log/_last_vacuum   oldest version whose files vacuum kept
+#   <table>/year=2018/month=11/part-....parquet   data files, never overwritten in place
+# New files are written to _staging/<txn> first and moved next to the live files, they only become
+# visible once the commit naming them exists, a write whose commit conflicts deletes them again. A commit is published by creating its version file,
+# which fails when another writer took the version first, see SnapshotTable.commit.
+# Readers resolve the files of a version from the checkpoint and the commits after it, without
+# listing the data directories, so they never see a half written or half deleted table.
+
+LOG_DIR = '_log'
+STAGING_DIR = '_staging'
+LAST_CHECKPOINT = '_last_checkpoint'
+LAST_VACUUM = '_last_vacuum'
+CHECKPOINT_INTERVAL = 10
+
+
+class CommitConflict(Exception):
+    '''
+    Description : A concurrent commit changed files this commit depends on, the write has to be redone
+    '''
+
+
+def _version_file(version):
+    return '{:020d}.json'.format(version)
+
+
+def _checkpoint_file(version):
+    return '{:020d}.checkpoint.json'.format(version)
+
+
+class Snapshot:
+    '''
+    Description : Files of one version of a snapshot table, with the per file entries of manifest.file_entry
+    '''
+
+    def __init__(self, fs, root, version, timestamp, partition_columns, files):
+        self.fs = fs
+        self.root = root
+        self.version = version
+        self.timestamp = timestamp
+        self.partition_columns = partition_columns
+        self.files = files
+
+    @property
+    def rows(self):
+        return sum(entry['rows'] for entry in self.files.values())
+
+    def prune(self, predicates=None):
+        '''
+        Description : Files that may hold rows matching all predicates, see manifest.prune_files
+        Returns :
+            - list of file paths relative to the table path
+        '''
+        return sorted(path for path, entry in self.files.items()
+                      if all(_may_contain(entry, column, predicate) for column, predicate in (predicates or {}).items()))
+
+    def dataset(self, paths=None):
+        '''
+        Description : pyarrow dataset over files of this version, all of them when paths is None
+        '''
+        files = ['{}/{}'.format(self.root, path) for path in (sorted(self.files) if paths is None else paths)]
+        return ds.dataset(files, filesystem=self.fs, format='parquet',
+                          partitioning='hive', partition_base_dir=self.root)
+
+    def to_arrow(self, predicates=None, columns=None):
+        '''
+        Description : Read the rows of this version matching the predicates into a pyarrow table
+        Returns :
+            - pyarrow table, without rows when no file can match, with the schema of one file of the version
+              or without columns when the version has no files
+        '''
+        files = self.prune(predicates)
+        if not files:
+            if not self.files:
+                return pa.schema([]).empty_table()
+            table = self.dataset(sorted(self.files)[:1]).schema.empty_table()
+            return table.select(columns) if columns is not None else table
+        return self.dataset(files).to_table(columns=columns, filter=_filter_expression(predicates or {}))
+
+    def to_spark(self, spark, table_path, predicates=None):
+        '''
+        Description : Same read as to_arrow returning a spark dataframe over the files of this version
+        '''
+        files = ['{}/{}'.format(table_path.rstrip('/'), path) for path in self.prune(predicates)]
+        if not files:
+            if not self.files:
+                from pyspark.sql.types import StructType
+                return spark.createDataFrame([], StructType([]))
+            return spark.read.option('basePath', table_path).parquet(
+                '{}/{}'.format(table_path.rstrip('/'), sorted(self.files)[0])).limit(0)
+        df = spark.read.option('basePath', table_path).parquet(*files)
+        for column, predicate in (predicates or {}).items():
+            low, high = predicate if isinstance(predicate, tuple) else (predicate, predicate)
+            if low is not None:
+                df = df.where(df[column] >= low)
+            if high is not None:
+                df = df.where(df[column] <= high)
+        return df
+
+
+class SnapshotTable:
+    '''
+    Description : Table with atomic commits, snapshot isolated reads and time travel over a parquet directory
+    Arguments :
+        - table_path : output path of the table
+        - settings : settings returned by load_settings
+        - stats_columns : columns to record min/max of per file, taken from manifest.STATS_COLUMNS when None
+    '''
+
+    def __init__(self, table_path, settings, stats_columns=None):
+        self.table_path = table_path.rstrip('/')
+        self.fs, self.root = filesystem_for(table_path, settings)
+        self.log_root = '{}/{}'.format(self.root, LOG_DIR)
+        if stats_columns is None:
+            stats_columns = STATS_COLUMNS.get(table_name(self.root), [])
+        self.stats_columns = stats_columns
+
+    def _read_json(self, name):
+        try:
+            with self.fs.open_input_stream('{}/{}'.format(self.log_root, name)) as f:
+                return json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            return None
+        except OSError:
+            # pyarrow raises a plain OSError for missing objects on some filesystems
+            if self.fs.get_file_info('{}/{}'.format(self.log_root, name)).type == pafs.FileType.NotFound:
+                return None
+            raise
+
+    def _write_json(self, name, document):
+        '''
+        Description : Replace a file of the log that can be rebuilt from the commits, e.g. a checkpoint
+        '''
+        path = '{}/{}'.format(self.log_root, name)
+        temporary = '{}/.{}.{}.tmp'.format(self.log_root, name, uuid.uuid4().hex)
+        with self.fs.open_output_stream(temporary) as f:
+            f.write(json.dumps(document).encode('utf-8'))
+        self.fs.move(temporary, path)
+
+    def _create_json(self, name, document):
+        '''
+        Description : Create a file of the log only when it does not exist yet
+            - On local storage the file is written under a temporary name and hard linked to its final name,
+              the link fails when the name is taken and readers never see a partial file
+            - Object stores have no atomic create in pyarrow, the check before the write narrows but does
+              not close the race, concurrent writers there need a conditional put or an external lock
+        Returns :
+            - True when the file was created, False when it already existed
+        '''
+        path = '{}/{}'.format(self.log_root, name)
+        temporary = '{}/.{}.{}.tmp'.format(self.log_root, name, uuid.uuid4().hex)
+        data = json.dumps(document).encode('utf-8')
+        if isinstance(self.fs, pafs.LocalFileSystem):
+            with open(temporary, 'wb') as f:
+                f.write(data)
+            try:
+                os.link(temporary, path)
+                return True
+            except FileExistsError:
+                return False
+            finally:
+                os.remove(temporary)
+
+        if self.fs.get_file_info(path).type != pafs.FileType.NotFound:
+            return False
+        with self.fs.open_output_stream(path) as f:
+            f.write(data)
+        return True
+
+    def commit_info(self, version):
+        '''
+        Description : The commit of a version, None when the version does not exist
+        '''
+        return self._read_json(_version_file(version))
+
+    def _replay(self, version=None):
+        '''
+        Description : Apply the commits after the closest checkpoint up to version, the latest when None
+        Returns :
+            - (version, timestamp, partition columns, dict of path -> file entry), version is -1 for an empty log
+        '''
+        state = None
+        pointer = self._read_json(LAST_CHECKPOINT)
+        if pointer is not None:
+            start = pointer['version']
+            if version is not None and start > version:
+                start = version - version % CHECKPOINT_INTERVAL
+            state = self._read_json(_checkpoint_file(start))
+        if state is None:
+            state = {'version': -1, 'timestamp': None, 'partition_columns': [], 'files': []}
+
+        current = state['version']
+        timestamp = state['timestamp']
+        partition_columns = state['partition_columns']
+        files = {entry['path']: entry for entry in state['files']}
+        while version is None or current < version:
+            commit = self.commit_info(current + 1)
+            if commit is None:
+                break
+            for path in commit['remove']:
+                files.pop(path, None)
+            for entry in commit['add']:
+                files[entry['path']] = entry
+            current, timestamp = commit['version'], commit['timestamp']
+            partition_columns = commit['partition_columns']
+
+        if version is not None and current != version:
+            raise ValueError("Version {} of {} not found, latest is {}".format(version, self.table_path, current))
+        return current, timestamp, partition_columns, files
+
+    def version(self):
+        '''
+        Description : Latest committed version, -1 for a table without commits
+        '''
+        return self._replay()[0]
+
+    def snapshot(self, version=None, timestamp=None):
+        '''
+        Description : Files of the latest version, of the given version or of the last version committed
+                      at or before the given timestamp. Versions older than the ones vacuum kept raise
+                      ValueError, their files may be deleted
+        Arguments :
+            - version : version to read, the latest when None
+            - timestamp : datetime or ISO string, used when version is None
+        Returns :
+            - Snapshot
+        '''
+        if version is None and timestamp is not None:
+            timestamp = timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
+            versions = [commit['version'] for commit in self.history() if commit['timestamp'] <= timestamp]
+            if not versions:
+                raise ValueError("No version of {} committed at or before {}".format(self.table_path, timestamp))
+            version = max(versions)
+        if version is not None:
+            vacuumed = self._read_json(LAST_VACUUM)
+            if vacuumed is not None and version < vacuumed['version']:
+                raise ValueError("Version {} of {} was vacuumed, the oldest version left is {}".format(
+                    version, self.table_path, vacuumed['version']))
+        current, committed_at, partition_columns, files = self._replay(version)
+        return Snapshot(self.fs, self.root, current, committed_at, partition_columns, files)
+
+    def history(self):
+        '''
+        Description : Version, timestamp, operation and file counts of every commit, oldest first
+        '''
+        commits = []
+        version = 0
+        while True:
+            commit = self.commit_info(version)
+            if commit is None:
+                return commits
+            commits.append({'version': commit['version'], 'timestamp': commit['timestamp'],
+                            'operation': commit['operation'],
+                            'added': len(commit['add']), 'removed': len(commit['remove'])})
+            version += 1
+
+    def _conflicts(self, commit, winners):
+        '''
+        Description : Whether commits published since the read version invalidate a commit
+            - Appends never conflict, they only add new files
+            - Removing a file another commit removed too means both rewrote the same data
+            - Replacing partitions conflicts with files another commit added to them,
+              a full overwrite replaces every partition
+        '''
+        if not commit['remove'] and not commit['replace_partitions']:
+            return False
+        removed = set(commit['remove'])
+        for winner in winners:
+            if removed & set(winner['remove']):
+                return True
+            for entry in winner['add']:
+                if commit['replace_partitions'] == 'all' or \
+                        _partition_key(entry['partition']) in commit['replace_partitions']:
+                    return True
+        return False
+
+    def commit(self, read_version, add, remove, operation, partition_columns, replace_partitions=None,
+               max_attempts=10):
+        '''
+        Description :
+            - Publish the next version after read_version adding and removing files
+            - When another writer published the version first, check its changes with _conflicts and retry
+              at the following version, or raise CommitConflict
+            - Write a checkpoint every CHECKPOINT_INTERVAL versions
+        Arguments :
+            - read_version : version the write was planned on, -1 for an empty table
+            - add : list of file entries of the new files
+            - remove : list of paths of files of read_version the commit removes
+            - operation : name recorded in the history, e.g. overwrite or append
+            - partition_columns : partition columns of the table
+            - replace_partitions : 'all', or list of partition value dicts the commit replaces, None for appends
+            - max_attempts : commits tried before giving up
+        Returns :
+            - committed version
+        '''
+        commit = {
+            'operation': operation,
+            'read_version': read_version,
+            'txn': uuid.uuid4().hex,
+            'partition_columns': partition_columns,
+            'replace_partitions': replace_partitions if replace_partitions in (None, 'all')
+            else sorted({_partition_key(partition) for partition in replace_partitions}),
+            'add': add,
+            'remove': remove,
+        }
+        self.fs.create_dir(self.log_root, recursive=True)
+        version = read_version + 1
+        for _ in range(max_attempts):
+            commit.update(version=version, timestamp=datetime.utcnow().isoformat())
+            if self._create_json(_version_file(version), commit):
+                if version and version % CHECKPOINT_INTERVAL == 0:
+                    self.checkpoint(version)
+                return version
+
+            winners = []
+            while True:
+                winner = self.commit_info(version)
+                if winner is None:
+                    break
+                winners.append(winner)
+                version += 1
+            if self._conflicts(commit, winners):
+                raise CommitConflict("{} of {} planned on version {} conflicts with version {}".format(
+                    operation, self.table_path, read_version, winners[-1]['version']))
+        raise CommitConflict("Could not commit {} to {} after {} attempts".format(
+            operation, self.table_path, max_attempts))
+
+    def checkpoint(self, version):
+        '''
+        Description : Write the full file list of a version so readers replay at most CHECKPOINT_INTERVAL commits
+        '''
+        current, timestamp, partition_columns, files = self._replay(version)
+        self._write_json(_checkpoint_file(current), {
+            'version': current, 'timestamp': timestamp, 'partition_columns': partition_columns,
+            'files': list(files.values())})
+        pointer = self._read_json(LAST_CHECKPOINT)
+        if pointer is None or pointer['version'] < current:
+            self._write_json(LAST_CHECKPOINT, {'version': current})
+
+    def _publish_staged(self, txn):
+        '''
+        Description : Move the parquet files of a staging directory next to the live files of the table
+        Returns :
+            - list of file entries of the moved files
+        '''
+        staging = '{}/{}/{}'.format(self.root, STAGING_DIR, txn)
+        selector = pafs.FileSelector(staging, recursive=True, allow_not_found=True)
+        entries = []
+        for info in sorted(self.fs.get_file_info(selector), key=lambda info: info.path):
+            relative = info.path[len(staging):].lstrip('/')
+            if info.type != pafs.FileType.File or not relative.endswith('.parquet') \
+                    or any(part.startswith(('_', '.')) for part in relative.split('/')):
+                continue
+            parent = '/'.join(relative.split('/')[:-1])
+            if parent:
+                self.fs.create_dir('{}/{}'.format(self.root, parent), recursive=True)
+            self.fs.move(info.path, '{}/{}'.format(self.root, relative))
+            entries.append(file_entry(self.fs, self.root, relative, info.size, self.stats_columns))
+        self.fs.delete_dir(staging)
+        return entries
+
+    def _commit_staged(self, txn, read, partition_columns, mode, replace_partitions):
+        '''
+        Description : Publish the staged files and commit them, the published files are deleted again when the
+                      commit conflicts, no version refers to them and vacuum only deletes files of some version
+        '''
+        added = self._publish_staged(txn)
+        if mode == 'append':
+            remove, replace = [], None
+        elif replace_partitions:
+            replace = [dict(partition) for partition in {_partition_key(entry['partition']) for entry in added}]
+            keys = {_partition_key(partition) for partition in replace}
+            remove = [path for path, entry in read.files.items() if _partition_key(entry['partition']) in keys]
+        else:
+            remove, replace = list(read.files), 'all'
+        operation = 'append' if mode == 'append' else 'replace_partitions' if replace_partitions else 'overwrite'
+        try:
+            return self.commit(read.version, added, remove, operation, partition_columns, replace)
+        except CommitConflict:
+            for entry in added:
+                self.fs.delete_file('{}/{}'.format(self.root, entry['path']))
+            raise
+
+    def write_spark(self, df, partition_by=None, mode='overwrite', replace_partitions=False):
+        '''
+        Description : Write a spark dataframe as a new version of the table
+        Arguments :
+            - df : spark dataframe to write
+            - partition_by : list of partition columns
+            - mode : overwrite or append
+            - replace_partitions : with overwrite, only replace the partitions present in df
+        Returns :
+            - committed version
+        '''
+        _check_mode(mode)
+        read = self.snapshot()
+        txn = uuid.uuid4().hex
+        writer = df.write
+        if partition_by:
+            writer = writer.partitionBy(*partition_by)
+        writer.mode('overwrite').parquet('{}/{}/{}'.format(self.table_path, STAGING_DIR, txn))
+        return self._commit_staged(txn, read, list(partition_by or []), mode, replace_partitions)
+
+    def write_arrow(self, table, partition_cols=None, mode='overwrite', replace_partitions=False):
+        '''
+        Description : Write a pyarrow table as a new version of the table, laid out like spark does
+        Arguments : see write_spark
+        Returns :
+            - committed version
+        '''
+        _check_mode(mode)
+        read = self.snapshot()
+        txn = uuid.uuid4().hex
+        pq.write_to_dataset(table, '{}/{}/{}'.format(self.root, STAGING_DIR, txn), partition_cols=partition_cols or None,
+                            filesystem=self.fs, basename_template='part-' + txn + '-{i}.parquet',
+                            use_deprecated_int96_timestamps=True)
+        return self._commit_staged(txn, read, list(partition_cols or []), mode, replace_partitions)
+
+    def vacuum(self, retain_versions=CHECKPOINT_INTERVAL, staging_retention_seconds=3600):
+        '''
+        Description :
+            - Delete the data files no version of the last retain_versions versions refers to,
+              time travel to older versions is no longer possible afterwards. The oldest kept version is
+              recorded first, snapshot refuses older versions instead of failing on their deleted files
+            - Delete staging directories of writes that died before committing, and data files no commit
+              added, published by writes that died before their commit, once they are older than
+              staging_retention_seconds
+        Returns :
+            - list of deleted file paths relative to the table path
+        '''
+        latest = self.version()
+        if latest < 0:
+            return []
+        oldest = max(latest - retain_versions + 1, 0)
+        live = set(self._replay(oldest)[3])
+        ever_added = set()
+        for version in range(latest + 1):
+            commit = self.commit_info(version)
+            ever_added.update(entry['path'] for entry in commit['add'])
+            if version > oldest:
+                live.update(entry['path'] for entry in commit['add'])
+
+        orphans = []
+        selector = pafs.FileSelector(self.root, recursive=True, allow_not_found=True)
+        for info in self.fs.get_file_info(selector):
+            relative = info.path[len(self.root):].lstrip('/')
+            if info.type != pafs.FileType.File or not relative.endswith('.parquet') or relative in ever_added \
+                    or any(part.startswith(('_', '.')) for part in relative.split('/')):
+                continue
+            if info.mtime is not None and time.time() - info.mtime.timestamp() > staging_retention_seconds:
+                orphans.append(relative)
+
+        vacuumed = self._read_json(LAST_VACUUM)
+        if vacuumed is None or vacuumed['version'] < oldest:
+            self._write_json(LAST_VACUUM, {'version': oldest})
+
+        deleted = []
+        for path in sorted(ever_added - live) + sorted(orphans):
+            try:
+                self.fs.delete_file('{}/{}'.format(self.root, path))
+                deleted.append(path)
+            except FileNotFoundError:
+                pass
+
+        selector = pafs.FileSelector('{}/{}'.format(self.root, STAGING_DIR), allow_not_found=True)
+        for info in self.fs.get_file_info(selector):
+            if info.mtime is not None and time.time() - info.mtime.timestamp() > staging_retention_seconds:
+                self.fs.delete_dir(info.path)
+        return deleted
+
+
+def _check_mode(mode):
+    if mode not in ('overwrite', 'append'):
+        raise ValueError("Unknown write mode '{}', use overwrite or append".format(mode))
+
+
+def _partition_key(partition):
+    return tuple(sorted(partition.items()))
+
+
+def read_table(table_path, settings, version=None, timestamp=None, predicates=None, columns=None):
+    '''
+    Description : Read one version of a snapshot table with pyarrow, the latest when version and timestamp are None
+    Arguments :
+        - table_path : output path of the table
+        - settings : settings returned by load_settings
+        - version, timestamp : see SnapshotTable.snapshot
+        - predicates : see manifest.prune_files
+        - columns : list of columns to read, all when None
+    Returns :
+        - pyarrow table, see Snapshot.to_arrow
+    '''
+    return SnapshotTable(table_path, settings).snapshot(version, timestamp).to_arrow(predicates, columns)
+
+
+def read_spark(spark, table_path, settings, version=None, timestamp=None, predicates=None):
+    '''
+    Description : Same read as read_table returning a spark dataframe
+    '''
+    return SnapshotTable(table_path, settings).snapshot(version, timestamp).to_spark(spark, table_path, predicates)
+
+
+def live_dataset(table_path, settings):
+    '''
+    Description : pyarrow dataset over the files of the latest version of a snapshot table, or over the
+                  directory of a table written without the table log, whose listing is the live files
+    '''
+    table = SnapshotTable(table_path, settings)
+    if table.version() >= 0:
+        return table.snapshot().dataset()
+    return ds.dataset(table.root, filesystem=table.fs, format='parquet', partitioning='hive')
+
+
+def vacuum_tables(output_data, settings, retain_versions=CHECKPOINT_INTERVAL):
+    '''
+    Description : Vacuum every snapshot table of an output path, run after the jobs writing them
+    Returns :
+        - dict of table name -> number of deleted files
+    '''
+    fs, root = filesystem_for('{}/songs'.format(output_data.rstrip('/')), settings)
+    deleted = {}
+    for info in fs.get_file_info(pafs.FileSelector(root, allow_not_found=True)):
+        if info.type != pafs.FileType.Directory or info.base_name.startswith(('_', '.')):
+            continue
+        if fs.get_file_info('{}/{}'.format(info.path, LOG_DIR)).type == pafs.FileType.Directory:
+            table_path = '{}/songs/{}'.format(output_data.rstrip('/'), info.base_name)
+            deleted[info.base_name] = len(SnapshotTable(table_path, settings).vacuum(retain_versions))
+    return deleted
@@ -0,0 +1,135 @@
+import argparse
+import random
+import string
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from create_tables import create_database, create_tables, drop_tables
+from etl import ensure_month_partitions
+from sql_queries import (artist_table_insert, schema_profiles, song_select, song_table_insert,
+                         songplay_table_insert)
+
+user_plays_select = ("""
+SELECT COUNT(*) FROM songplays
+    WHERE user_id = %s AND start_time >= %s AND start_time < %s
+""")
+
+
+def random_name(rng, length=12):
+    return ''.join(rng.choice(string.ascii_letters) for _ in range(length))
+
+
+def load_songs(cur, conn, rng, num_songs):
+    '''
+    Description : Inserts num_songs synthetic songs with one artist each
+    Returns :
+        list of (title, artist name, duration) of the inserted songs
+    '''
+    songs = []
+    for i in range(num_songs):
+        artist_id, song_id = 'AR{:016d}'.format(i), 'SO{:016d}'.format(i)
+        title, name, duration = random_name(rng), random_name(rng), round(rng.uniform(60, 600), 5)
+        cur.execute(artist_table_insert, (artist_id, name, random_name(rng), None, None))
+        cur.execute(song_table_insert, (song_id, title, artist_id, rng.randint(1950, 2018), duration))
+        songs.append((title, name, duration))
+    conn.commit()
+    cur.execute('ANALYZE')
+    return songs
+
+
+def time_lookups(cur, rng, songs, num_lookups):
+    '''
+    Description : Runs song_select for num_lookups plays, half of them matching a song like the log files do
+    Returns :
+        lookups per second
+    '''
+    plays = [rng.choice(songs) if i % 2 else (random_name(rng), random_name(rng), 1.0) for i in range(num_lookups)]
+    start = time.perf_counter()
+    for play in plays:
+        cur.execute(song_select, play)
+        cur.fetchone()
+    return num_lookups / (time.perf_counter() - start)
+
+
+def time_inserts(cur, conn, rng, partitioned, num_plays, num_users, months):
+    '''
+    Description : Inserts num_plays songplays spread over the last months, creating partitions when partitioned
+    Returns :
+        inserts per second, partition creation included
+    '''
+    first = datetime(2018, 11, 30) - timedelta(days=30 * months)
+    plays = sorted(first + timedelta(seconds=rng.randint(0, months * 30 * 86400)) for _ in range(num_plays))
+    start = time.perf_counter()
+    if partitioned:
+        ensure_month_partitions(cur, pd.Series(plays), set())
+    for start_time in plays:
+        cur.execute(songplay_table_insert, (start_time, rng.randint(1, num_users), 'free', rng.randint(1, 1000),
+                                            'Somewhere', 'Mozilla/5.0', None, None, None))
+    conn.commit()
+    elapsed = time.perf_counter() - start
+    cur.execute('ANALYZE songplays')
+    return num_plays / elapsed, first
+
+
+def time_user_queries(cur, rng, num_queries, num_users, first, months):
+    '''
+    Description : Counts one user's plays over one week, the query the (user_id, start_time) index serves
+    Returns :
+        queries per second
+    '''
+    start = time.perf_counter()
+    for _ in range(num_queries):
+        week = first + timedelta(days=rng.randint(0, months * 30 - 7))
+        cur.execute(user_plays_select, (rng.randint(1, num_users), week, week + timedelta(days=7)))
+        cur.fetchone()
+    return num_queries / (time.perf_counter() - start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compare lookup and insert rates of the schema profiles. '
+                                                 'Recreates sparkifydb for every profile.')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(schema_profiles), default=sorted(schema_profiles))
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--plays', type=int, default=50000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--dsn', help='connection string of the sparkify database to recreate')
+    parser.add_argument('--admin-dsn', help='connection string of the database to recreate it from')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''
+         - Recreating sparkifydb with every schema profile
+         - loading the same synthetic songs and songplays into each of them
+         - printing song lookups, songplay inserts and user/week queries per second per profile
+    '''
+    args = parse_args(argv)
+    results = []
+    for profile in args.profiles:
+        rng = random.Random(args.seed)
+        cur, conn = create_database(args.dsn, args.admin_dsn)
+        drop_tables(cur, conn)
+        create_tables(cur, conn, profile)
+
+        songs = load_songs(cur, conn, rng, args.songs)
+        lookups = time_lookups(cur, rng, songs, args.lookups)
+        inserts, first = time_inserts(cur, conn, rng, profile == 'partitioned', args.plays, args.users, args.months)
+        queries = time_user_queries(cur, rng, args.lookups, args.users, first, args.months)
+        results.append((profile, lookups, inserts, queries))
+        print('{}: {:.0f} lookups/s, {:.0f} inserts/s, {:.0f} user queries/s'.format(profile, lookups, inserts, queries))
+
+        cur.close()
+        conn.close()
+
+    print('\n{:<12} {:>12} {:>12} {:>14}'.format('profile', 'lookups/s', 'inserts/s', 'user queries/s'))
+    for profile, lookups, inserts, queries in results:
+        print('{:<12} {:>12.0f} {:>12.0f} {:>14.0f}'.format(profile, lookups, inserts, queries))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,50 @@
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+import os
 
+from sql_queries import drop_table_queries, schema_profiles
 
-def create_database():
+# connection strings of the default database and of the sparkify database, overridden by --admin-dsn / --dsn
+# or the SPARKIFY_ADMIN_DSN / SPARKIFY_DSN environment variables
+ADMIN_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+SPARKIFY_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def get_dsn(dsn=None, admin=False):
+    """
+    - Returns the given connection string, else the one of the environment, else the default
+    - admin selects the default database the sparkify database is created from
+    """
+    if dsn:
+        return dsn
+    if admin:
+        return os.environ.get('SPARKIFY_ADMIN_DSN', ADMIN_DSN)
+    return os.environ.get('SPARKIFY_DSN', SPARKIFY_DSN)
+
+
+def create_database(dsn=None, admin_dsn=None):
     """
-    - Creates and connects to the sparkifydb
+    - Creates and connects to the sparkify database, the dbname of the sparkify connection string
     - Returns the connection and cursor to sparkifydb
     """
+    import psycopg2
+    from psycopg2.extensions import parse_dsn
+    dsn = get_dsn(dsn)
+    dbname = parse_dsn(dsn)['dbname']
     
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = psycopg2.connect(get_dsn(admin_dsn, admin=True))
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    cur.execute("DROP DATABASE IF EXISTS {}".format(dbname))
+    cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0".format(dbname))
 
     # close connection to default database
     conn.close()    
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = psycopg2.connect(dsn)
     cur = conn.cursor()
     
     return cur, conn
@@ -43,23 +66,36 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, profile='default'):
     """
-    Creates each table using the queries in `create_table_queries` list.
+    Creates each table using the queries of a schema profile in `schema_profiles`.
     
     Keyword arguments:
         cur : cursor object
         conn : connection object for conecting to sparkify database
+        profile : 'default' for the plain tables of `create_table_queries`,
+                  'indexed' adds the song lookup and songplays (user_id, start_time) indexes,
+                  'partitioned' also partitions songplays by month of start_time
         
     Returns : None
     
     """
-    for query in create_table_queries:
+    for query in schema_profiles[profile]:
         cur.execute(query)
         conn.commit()
 
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Create the sparkify database and tables')
+    parser.add_argument('--profile', choices=sorted(schema_profiles), default='default',
+                        help='schema profile to create, see create_tables')
+    parser.add_argument('--dsn', help='connection string of the sparkify database, created from the admin database')
+    parser.add_argument('--admin-dsn', help='connection string of the database to create the sparkify database from')
+    parser.add_argument('--dry-run', action='store_true', help='print the statements without connecting')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """
     - Drops (if exists) and Creates the sparkify database. 
     
@@ -68,14 +104,22 @@ def main():
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed by the schema profile given with --profile. 
     
     - Finally, closes the connection. 
+
+    - With --dry-run the statements are printed instead.
     """
-    cur, conn = create_database()
+    args = parse_args(argv)
+    if args.dry_run:
+        for query in drop_table_queries + schema_profiles[args.profile]:
+            print(query.strip() + ';\n')
+        return
+
+    cur, conn = create_database(args.dsn, args.admin_dsn)
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, args.profile)
 
     cur.close()
     conn.close()
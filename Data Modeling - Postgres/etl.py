@@ -1,9 +1,22 @@
+import argparse
 import os
 import glob
-import psycopg2
-import pandas as pd
+import sys
+from datetime import datetime, timedelta
+from functools import partial
+
+# numpy, pandas and psycopg2 are imported by the functions using them, a --dry-run does not load them
+from create_tables import get_dsn
 from sql_queries import *
 
+# event_filter.py is shared with the Data Lake jobs and lives at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from event_filter import DEFAULT_CAPACITY, DEFAULT_ERROR_RATE, EventFilter, fingerprint
+
+# log columns of the event fingerprint
+EVENT_KEY = ['userId', 'sessionId', 'itemInSession', 'ts']
+EPOCH = datetime(1970, 1, 1)
+
 
 def process_song_file(cur, filepath):
     '''
@@ -21,6 +34,8 @@ def process_song_file(cur, filepath):
         None
         
     '''
+    import pandas as pd
+
     # open song file
     df = pd.read_json(filepath,lines=True)
 
@@ -33,64 +48,212 @@ def process_song_file(cur, filepath):
     cur.execute(artist_table_insert, artist_data)
 
 
-def process_log_file(cur, filepath):
+def is_partitioned(cur):
+    '''
+    Description : Whether songplays was created by the partitioned schema profile of create_tables.py
+    '''
+    cur.execute(songplay_partitioned_check)
+    result = cur.fetchone()
+    return bool(result and result[0])
+
+
+def ensure_month_partitions(cur, timestamps, known_months):
+    '''
+    Description :
+        - creating the monthly songplays partitions of the months found in timestamps
+        - months already in known_months are skipped, the others are created if missing and added to it
+    
+    Arguments :
+        cur : cursor object
+        timestamps : pandas series of start_time values
+        known_months : set of (year, month) tuples whose partition exists
+    
+    Returns :
+        None
+    '''
+    months = set(zip(timestamps.dt.year, timestamps.dt.month)) - known_months
+    for year, month in sorted(months):
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        cur.execute(songplay_partition_create.format(
+            partition='songplays_{}_{:02d}'.format(year, month),
+            start='{}-{:02d}-01'.format(year, month),
+            end='{}-{:02d}-01'.format(next_year, next_month)))
+        known_months.add((year, month))
+
+
+def to_row(values):
+    '''
+    Description : Values as a tuple of python values psycopg2 can adapt, NaN and NaT become NULL
+    '''
+    import numpy as np
+    import pandas as pd
+
+    return tuple(None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value
+                 for value in values)
+
+
+def to_rows(df):
+    return [to_row(row) for row in df.itertuples(index=False, name=None)]
+
+
+def event_keys(df):
+    '''
+    Description : Fingerprints of the events of a log dataframe, see event_filter.fingerprint
+    '''
+    return [fingerprint(*values) for values in df[EVENT_KEY].itertuples(index=False, name=None)]
+
+
+def to_ms(start_time):
+    return (start_time - EPOCH) // timedelta(milliseconds=1)
+
+
+def drop_loaded_events(cur, df, event_filter, page_size=500):
+    '''
+    Description :
+        - dropping the events of a log dataframe that are already in songplays, and the repeated events of the dataframe
+        - the events the filter has not seen are kept without asking the database, the others are looked up
+          in songplays by their fingerprint, page_size events per query
+    
+    Arguments :
+        cur : cursor object
+        df : NextSong events dataframe
+        event_filter : EventFilter of the loaded events
+        page_size : events per lookup query
+    
+    Returns :
+        dataframe of the events to load
+    '''
+    import pandas as pd
+    from psycopg2.extras import execute_values
+
+    df = df.drop_duplicates(subset=EVENT_KEY)
+    keys = event_keys(df)
+    candidates = df[[key in event_filter for key in keys]]
+    if candidates.empty:
+        return df
+
+    events = [(int(row.userId), int(row.sessionId), int(row.itemInSession),
+               pd.to_datetime(row.ts, unit='ms').to_pydatetime()) for row in candidates.itertuples(index=False)]
+    rows = execute_values(cur, songplay_event_select, events, page_size=page_size, fetch=True)
+    loaded = {fingerprint(user_id, session_id, item_in_session, to_ms(start_time))
+              for user_id, session_id, item_in_session, start_time in rows}
+    return df[[key not in loaded for key in keys]]
+
+
+def load_log_data(cur, df, partition_months=None, page_size=500, event_filter=None):
     '''
     Description : 
-    This function is focusing on
-         - processing all the log files(.json format) present in the directory
+    This function is the transform and load path shared by the log files and the stream mode
          - extracting data for the 'NextSong' page
-         - converting timestamp attribute values to different time components for generating time data
-         - inserting time data records into the time table.
-         - extracting attribute values for only user data  from the log files and ingesting records into user table.
-         - Getting the song_id and artist_id values from song and artist table for the song name,artist name and duration of the song from              the log file and other attributes from log file for songplays data.
-         - Inserting the extracted data into songplays fact table
+         - with an event filter, dropping the events already loaded before any insert, see drop_loaded_events
+         - converting timestamp attribute values to different time components and upserting the time table
+         - upserting the users table
+         - Getting the song_id and artist_id values once per distinct song name, artist name and duration
+         - Inserting the songplays, all inserts are sent in batches of page_size statements with execute_batch
+         - adding the fingerprints of the inserted songplays to the event filter, the caller saves it
     
     Arguments :
         cur : cursor object
-        filepath : log data file path
+        df : log events dataframe, as read from the NDJSON log files
+        partition_months : see process_log_file
+        page_size : statements per round trip to the database
+        event_filter : EventFilter of the loaded events, or None to load every event
     
     Returns :
-        None
+        number of songplays inserted
     '''
-    # open log file
-    df = pd.read_json(filepath,lines=True)
+    import pandas as pd
+    from psycopg2.extras import execute_batch
 
     # filter by NextSong action
     df = df[df['page']=='NextSong']
+    if event_filter is not None and not df.empty:
+        df = drop_loaded_events(cur, df, event_filter, page_size)
+    if df.empty:
+        return 0
 
     # convert timestamp column to datetime
     t = pd.to_datetime(df.ts,unit='ms')
     
     # insert time data records
-    time_data = pd.concat([t,t.dt.hour,t.dt.day,t.dt.week,t.dt.month,t.dt.year,t.dt.weekday],axis=1)
-    column_labels = time_data.set_axis(['start_time','hour','day', 'week','month','year','weekday'],axis=1,inplace=True)
-    time_df = time_data
-
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    time_df = pd.concat([t,t.dt.hour,t.dt.day,t.dt.isocalendar().week,t.dt.month,t.dt.year,t.dt.weekday],axis=1)
+    time_df.columns = ['start_time','hour','day', 'week','month','year','weekday']
+    execute_batch(cur, time_table_insert, to_rows(time_df.drop_duplicates()), page_size=page_size)
 
     # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']].assign(userId=df.userId.astype(int))
 
     # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    execute_batch(cur, user_table_insert, to_rows(user_df), page_size=page_size)
+
+    # create the songplays partitions of new months
+    if partition_months is not None:
+        ensure_month_partitions(cur, t, partition_months)
+
+    # get songid and artistid from song and artist tables
+    matches = {}
+    for song in set(zip(df.song, df.artist, df.length)):
+        cur.execute(song_select, to_row(song))
+        matches[song] = cur.fetchone() or (None, None)
 
     # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
+    songplay_data = [to_row((start_time, int(row.userId), row.level, row.sessionId, row.location, row.userAgent)
+                            + tuple(matches.get((row.song, row.artist, row.length), (None, None)))
+                            + (row.itemInSession,))
+                     for start_time, row in zip(t, df.itertuples(index=False))]
+    execute_batch(cur, songplay_table_insert, songplay_data, page_size=page_size)
 
-        # insert songplay record
-        songplay_data = (pd.to_datetime(row.ts,unit='ms'),int (row.userId),row.level,row.sessionId,row.location,row.userAgent,songid,artistid)
-        cur.execute(songplay_table_insert, songplay_data)
+    if event_filter is not None:
+        event_filter.update(event_keys(df))
+    return len(songplay_data)
+
+
+def process_log_file(cur, filepath, partition_months=None, event_filter=None):
+    '''
+    Description : 
+    This function is focusing on
+         - processing all the log files(.json format) present in the directory
+         - loading the time, users and songplays tables from the file with load_log_data
+         - saving the event filter before process_data commits the file, a crash in between leaves the filter
+           with events that are not loaded, which the exact check of drop_loaded_events lets through
+    
+    Arguments :
+        cur : cursor object
+        filepath : log data file path
+        partition_months : set of (year, month) with a songplays partition when songplays is partitioned,
+                           missing partitions are created before the inserts. None when it is not partitioned
+        event_filter : EventFilter of the loaded events, or None to load every event
+    
+    Returns :
+        None
+    '''
+    import pandas as pd
+
+    # open log file
+    df = pd.read_json(filepath,lines=True)
+
+    load_log_data(cur, df, partition_months, event_filter=event_filter)
+    if event_filter is not None:
+        event_filter.save()
+
+
+def rebuild_event_filter(conn, path, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+    '''
+    Description : Replacing the event filter at path with one of the songplays in the database, e.g. after the
+                  file was lost or once it holds more events than it was sized for
+    
+    Returns :
+        EventFilter
+    '''
+    event_filter = EventFilter.for_capacity(capacity, error_rate, path)
+    cur = conn.cursor(name='songplay_events')
+    cur.execute(songplay_events_select)
+    for user_id, session_id, item_in_session, start_time in cur:
+        event_filter.add(fingerprint(user_id, session_id, item_in_session, to_ms(start_time)))
+    cur.close()
+    conn.commit()
+    event_filter.save()
+    return event_filter
 
 
 def process_data(cur, conn, filepath, func):
@@ -131,17 +294,70 @@ def process_data(cur, conn, filepath, func):
         print('{}/{} files processed.'.format(i, num_files))
 
 
-def main():
+def print_plan(song_data, log_data):
+    '''
+    Description : Prints the files a run would load and the statements it runs for them, without connecting
+    '''
+    for filepath, queries in ((song_data, [song_table_insert, artist_table_insert]),
+                              (log_data, [time_table_insert, user_table_insert, song_select, songplay_table_insert])):
+        num_files = sum(len(glob.glob(os.path.join(root, '*.json'))) for root, dirs, files in os.walk(filepath))
+        print('-- {} files found in {}, every file runs :\n'.format(num_files, filepath))
+        for query in queries:
+            print(query.strip() + ';\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load the song and log files into the sparkify database')
+    parser.add_argument('--dsn', help='connection string of the sparkify database')
+    parser.add_argument('--song-data', default='data/song_data')
+    parser.add_argument('--log-data', default='data/log_data')
+    parser.add_argument('--event-filter', help='path of the filter of the loaded events, events already in songplays '
+                                               'are skipped when it is given, see event_filter.py')
+    parser.add_argument('--event-filter-capacity', type=int, default=DEFAULT_CAPACITY,
+                        help='events a new filter is sized for')
+    parser.add_argument('--event-filter-error-rate', type=float, default=DEFAULT_ERROR_RATE,
+                        help='false positive rate of a new filter at capacity')
+    parser.add_argument('--rebuild-event-filter', action='store_true',
+                        help='build the filter from the songplays in the database before loading')
+    parser.add_argument('--dry-run', action='store_true', help='print the files and statements without connecting')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     '''
-         - Connecting to sparkify database
+         - Connecting to sparkify database, the connection string comes from --dsn, SPARKIFY_DSN or the default
+         - checking whether songplays is partitioned by month, the log files then create the partitions they need
+         - opening the event filter given with --event-filter, rebuilt from songplays with --rebuild-event-filter
          - calling process_data() function to process song and log files for data ingestion process
          - closing the database connection
+         - with --dry-run only printing the files and statements
     '''
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    args = parse_args(argv)
+    if args.dry_run:
+        print_plan(args.song_data, args.log_data)
+        return
+
+    if args.rebuild_event_filter and not args.event_filter:
+        raise SystemExit('--rebuild-event-filter needs --event-filter')
+
+    import psycopg2
+    conn = psycopg2.connect(get_dsn(args.dsn))
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    event_filter = None
+    if args.event_filter and args.rebuild_event_filter:
+        event_filter = rebuild_event_filter(conn, args.event_filter, args.event_filter_capacity,
+                                            args.event_filter_error_rate)
+    elif args.event_filter:
+        event_filter = EventFilter.open(args.event_filter, args.event_filter_capacity, args.event_filter_error_rate)
+
+    process_data(cur, conn, filepath=args.song_data, func=process_song_file)
+    log_func = partial(process_log_file, partition_months=set() if is_partitioned(cur) else None,
+                       event_filter=event_filter)
+    process_data(cur, conn, filepath=args.log_data, func=log_func)
+    if event_filter is not None:
+        print('event filter {} : ~{:.0f} events, false positive rate {:.6f}'.format(
+            args.event_filter, event_filter.estimated_count(), event_filter.error_rate()))
 
     conn.close()
 
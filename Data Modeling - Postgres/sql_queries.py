@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+stream_offsets_table_drop = "DROP TABLE IF EXISTS stream_offsets"
 
 # CREATE TABLES
 
@@ -19,7 +20,8 @@ CREATE TABLE IF NOT EXISTS songplays
      artist_id   VARCHAR,
      session_id  INT,
      location    TEXT,
-     user_agent  TEXT
+     user_agent  TEXT,
+     item_in_session INT
   )
 """)
 
@@ -69,6 +71,58 @@ CREATE TABLE IF NOT EXISTS time
   )
 """)
 
+# byte offset up to which stream.py loaded each source file, updated in the transaction of the loaded batch
+stream_offsets_table_create = ("""
+CREATE TABLE IF NOT EXISTS stream_offsets
+  (
+      source VARCHAR PRIMARY KEY,
+      byte_offset BIGINT NOT NULL,
+      updated_at TIMESTAMP NOT NULL
+  )
+""")
+
+# PARTITIONED PROFILE
+
+# songplays range partitioned by month on start_time, the partition key has to be part of the primary key.
+# The monthly partitions are created by etl.py as it meets new months, see songplay_partition_create
+songplay_table_create_partitioned = ("""
+CREATE TABLE IF NOT EXISTS songplays
+  (
+     songplay_id SERIAL,
+     start_time  TIMESTAMP NOT NULL,
+     user_id     INT NOT NULL,
+     level       VARCHAR,
+     song_id     VARCHAR,
+     artist_id   VARCHAR,
+     session_id  INT,
+     location    TEXT,
+     user_agent  TEXT,
+     item_in_session INT,
+     PRIMARY KEY (songplay_id, start_time)
+  )
+  PARTITION BY RANGE (start_time)
+""")
+
+songplay_partition_create = ("""
+CREATE TABLE IF NOT EXISTS {partition} PARTITION OF songplays
+    FOR VALUES FROM ('{start}') TO ('{end}')
+""")
+
+songplay_partitioned_check = ("""
+SELECT relkind = 'p' FROM pg_class
+    WHERE relname = 'songplays' AND pg_table_is_visible(oid)
+""")
+
+# INDEXES
+
+# song_select looks songs up by title and duration and artists by name
+song_select_index_create = "CREATE INDEX IF NOT EXISTS songs_title_duration_idx ON songs (title, duration)"
+artist_name_index_create = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name)"
+# analytical filters on a user's plays over a period, created on every partition of a partitioned songplays
+songplay_user_time_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_user_id_start_time_idx ON songplays (user_id, start_time)
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = (""" 
@@ -81,10 +135,11 @@ INSERT INTO songplays
         location , 
         user_agent,
         song_id ,
-        artist_id
+        artist_id,
+        item_in_session
     ) 
     VALUES
-    (%s,%s,%s,%s,%s,%s,%s,%s) 
+    (%s,%s,%s,%s,%s,%s,%s,%s,%s) 
 """)
 
 user_table_insert = ("""
@@ -148,6 +203,20 @@ INSERT INTO time
     ON CONFLICT (start_time) DO NOTHING
 """)
 
+stream_offset_upsert = ("""
+INSERT INTO stream_offsets
+    (
+        source,
+        byte_offset,
+        updated_at
+    )
+    VALUES
+    (%s,%s,now())
+    ON CONFLICT (source)
+    DO
+        UPDATE SET byte_offset = EXCLUDED.byte_offset, updated_at = EXCLUDED.updated_at
+""")
+
 # FIND SONGS
 
 song_select = ("""
@@ -162,7 +231,35 @@ SELECT songs.song_id, artists.artist_id FROM
     );
 """)
 
+# songplays of the given events, the exact check of the events the event filter has seen before.
+# user_id, session_id, item_in_session and start_time (ts to the millisecond) are the event fingerprint
+songplay_event_select = ("""
+SELECT songplays.user_id, songplays.session_id, songplays.item_in_session, songplays.start_time
+    FROM songplays JOIN (VALUES %s) AS events (user_id, session_id, item_in_session, start_time)
+    ON songplays.user_id = events.user_id
+    AND songplays.session_id = events.session_id
+    AND songplays.item_in_session = events.item_in_session
+    AND songplays.start_time = events.start_time
+""")
+
+songplay_events_select = ("""
+SELECT user_id, session_id, item_in_session, start_time FROM songplays
+    WHERE session_id IS NOT NULL AND item_in_session IS NOT NULL
+""")
+
+stream_offset_select = ("""
+SELECT source, byte_offset FROM stream_offsets
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, stream_offsets_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, stream_offsets_table_drop]
+create_index_queries = [song_select_index_create, artist_name_index_create, songplay_user_time_index_create]
+
+# schema profiles of create_tables.py --profile
+schema_profiles = {
+    'default': create_table_queries,
+    'indexed': create_table_queries + create_index_queries,
+    'partitioned': [songplay_table_create_partitioned] + create_table_queries[1:] + create_index_queries,
+}
\ No newline at end of file
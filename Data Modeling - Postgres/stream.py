@@ -0,0 +1,244 @@
+import argparse
+import io
+import os
+import time
+from collections import deque
+
+from create_tables import get_dsn
+from etl import EventFilter, is_partitioned, load_log_data
+from sql_queries import stream_offset_select, stream_offset_upsert, stream_offsets_table_create
+
+
+class NdjsonTail:
+    '''
+    Description :
+        - Tails an append-only NDJSON source, a single growing file or a directory of growing files
+        - Only complete lines are returned, a line still being written is read again at the next poll
+        - Reading starts at the byte offsets committed by earlier runs
+    '''
+
+    def __init__(self, path, offsets):
+        self.path = path
+        self.positions = dict(offsets)
+
+    def files(self):
+        if os.path.isfile(self.path):
+            return [os.path.abspath(self.path)]
+        return sorted(os.path.abspath(os.path.join(root, name))
+                      for root, dirs, names in os.walk(self.path)
+                      for name in names if name.endswith(('.json', '.ndjson')))
+
+    def poll(self):
+        '''
+        Returns :
+            list of (source file, line, offset after the line, time the line was read)
+        '''
+        records = []
+        for source in self.files():
+            position = self.positions.get(source, 0)
+            if os.path.getsize(source) <= position:
+                continue
+            with open(source, 'rb') as f:
+                f.seek(position)
+                data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            observed = time.time()
+            for line in complete.splitlines(keepends=True):
+                position += len(line)
+                if line.strip():
+                    records.append((source, line.decode('utf-8'), position, observed))
+            self.positions[source] = position
+        return records
+
+
+class LatencyStats:
+    '''
+    Description : Keeps the latencies of the last max_samples loaded events and reports their percentiles
+    '''
+
+    def __init__(self, max_samples=100000):
+        self.ingest = deque(maxlen=max_samples)
+        self.event = deque(maxlen=max_samples)
+
+    def add(self, committed, observed, event_times):
+        self.ingest.extend(committed - observed)
+        self.event.extend(committed - event_times)
+
+    @staticmethod
+    def percentiles(samples):
+        if not samples:
+            return 'no events'
+        import numpy as np
+        p50, p95, p99 = np.percentile(np.fromiter(samples, dtype=float), [50, 95, 99])
+        return 'p50 {:.3f}s p95 {:.3f}s p99 {:.3f}s'.format(p50, p95, p99)
+
+    def report(self):
+        return 'ingest latency {} | event latency {}'.format(self.percentiles(self.ingest),
+                                                           self.percentiles(self.event))
+
+
+def load_batch(cur, conn, batch, partition_months, latencies, event_filter=None):
+    '''
+    Description :
+        - Parsing one micro-batch of NDJSON lines and loading it with load_log_data, like the log files
+        - Storing the offset after the batch of every source file in stream_offsets
+        - Committing data and offsets in one transaction, a batch is loaded exactly once even when
+          the process dies in between: the rolled back batch is read again from the committed offsets
+        - Saving the event filter before the commit, like process_log_file
+
+    Arguments :
+        cur : cursor object
+        conn : connection to the database
+        batch : list of records returned by NdjsonTail.poll
+        partition_months : see process_log_file
+        latencies : LatencyStats recording the latency of the batch's events
+        event_filter : EventFilter of the loaded events, or None to load every event
+
+    Returns :
+        number of songplays inserted
+    '''
+    import numpy as np
+    import pandas as pd
+
+    df = pd.read_json(io.StringIO(''.join(line for source, line, offset, observed in batch)), lines=True)
+    try:
+        songplays = load_log_data(cur, df, partition_months, event_filter=event_filter)
+        offsets = {}
+        for source, line, offset, observed in batch:
+            offsets[source] = offset
+        for source, offset in offsets.items():
+            cur.execute(stream_offset_upsert, (source, offset))
+        if event_filter is not None:
+            event_filter.save()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    committed = time.time()
+    observed = np.array([observed for source, line, offset, observed in batch])
+    event_times = df['ts'].to_numpy(dtype=float) / 1000 if 'ts' in df else observed
+    latencies.add(committed, observed, event_times)
+    return songplays
+
+
+def stream(conn, path, max_batch_events=500, max_batch_seconds=1.0, poll_interval=0.2,
+           idle_timeout=None, report_interval=10.0, event_filter=None):
+    '''
+    Description :
+        - Tailing the NDJSON source and cutting micro-batches of max_batch_events lines or
+          max_batch_seconds after the first pending line was read, whichever comes first
+        - Loading every batch with load_batch and printing the latency percentiles every report_interval seconds
+
+    Arguments :
+        conn : connection to the sparkify database
+        path : NDJSON file or directory of NDJSON files
+        max_batch_events : events per batch at most
+        max_batch_seconds : seconds an event waits for its batch to fill at most
+        poll_interval : seconds between polls of an idle source
+        idle_timeout : stop after this many seconds without new events, never when None
+        report_interval : seconds between latency reports
+        event_filter : EventFilter of the loaded events, events already in songplays are skipped when given
+
+    Returns :
+        LatencyStats of the run
+    '''
+    cur = conn.cursor()
+    cur.execute(stream_offsets_table_create)
+    cur.execute(stream_offset_select)
+    tail = NdjsonTail(path, cur.fetchall())
+    conn.commit()
+
+    partition_months = set() if is_partitioned(cur) else None
+    latencies = LatencyStats()
+    pending = deque()
+    last_event = last_report = time.time()
+    batches = songplays = 0
+    while True:
+        records = tail.poll()
+        pending.extend(records)
+        now = time.time()
+        if records:
+            last_event = now
+
+        while pending and (len(pending) >= max_batch_events or now - pending[0][3] >= max_batch_seconds):
+            batch = [pending.popleft() for _ in range(min(max_batch_events, len(pending)))]
+            songplays += load_batch(cur, conn, batch, partition_months, latencies, event_filter)
+            batches += 1
+            now = time.time()
+
+        if now - last_report >= report_interval:
+            print('{} batches, {} songplays loaded, {}'.format(batches, songplays, latencies.report()))
+            last_report = now
+        if idle_timeout is not None and not pending and now - last_event >= idle_timeout:
+            break
+        if not records:
+            time.sleep(poll_interval)
+
+    print('{} batches, {} songplays loaded, {}'.format(batches, songplays, latencies.report()))
+    return latencies
+
+
+def replay(source_dir, target, rate):
+    '''
+    Description : Appends the events of finished log files to a growing NDJSON file at about rate events
+                  per second with ts set to the time of writing, a stand-in for a live event broker
+    '''
+    import pandas as pd
+
+    paths = sorted(os.path.join(root, name) for root, dirs, names in os.walk(source_dir)
+                   for name in names if name.endswith('.json'))
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    with open(target, 'a') as out:
+        for path in paths:
+            for event in pd.read_json(path, lines=True).to_dict('records'):
+                event['ts'] = int(time.time() * 1000)
+                out.write(pd.Series(event).to_json() + '\n')
+                out.flush()
+                time.sleep(1.0 / rate)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-batch streaming ingestion of NDJSON log events')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest = commands.add_parser('ingest', help='tail an NDJSON file or directory into sparkifydb')
+    ingest.add_argument('source')
+    ingest.add_argument('--dsn', help='connection string of the sparkify database')
+    ingest.add_argument('--max-batch-events', type=int, default=500)
+    ingest.add_argument('--max-batch-seconds', type=float, default=1.0)
+    ingest.add_argument('--poll-interval', type=float, default=0.2)
+    ingest.add_argument('--idle-timeout', type=float, default=None)
+    ingest.add_argument('--report-interval', type=float, default=10.0)
+    ingest.add_argument('--event-filter', help='path of the filter of the loaded events, see etl.py --event-filter')
+    replayer = commands.add_parser('replay', help='append the events of log files to a growing NDJSON file')
+    replayer.add_argument('source_dir')
+    replayer.add_argument('target')
+    replayer.add_argument('--rate', type=float, default=50.0, help='events per second')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''
+         - ingest : connecting to sparkify database (--dsn, SPARKIFY_DSN or the default) and loading the NDJSON source in micro-batches until stopped,
+                    skipping the events already loaded when --event-filter is given
+         - replay : writing a growing NDJSON source from the log files, e.g. data/log_data
+    '''
+    args = parse_args(argv)
+    if args.command == 'replay':
+        replay(args.source_dir, args.target, args.rate)
+        return
+
+    event_filter = EventFilter.open(args.event_filter) if args.event_filter else None
+    import psycopg2
+    conn = psycopg2.connect(get_dsn(args.dsn))
+    try:
+        stream(conn, args.source, args.max_batch_events, args.max_batch_seconds, args.poll_interval,
+               args.idle_timeout, args.report_interval, event_filter)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
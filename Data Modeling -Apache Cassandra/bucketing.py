@@ -0,0 +1,182 @@
+import csv
+import heapq
+import math
+import zlib
+from collections import defaultdict
+
+from cassandra.concurrent import execute_concurrent_with_args
+
+# songplay_users_info is keyed by song alone, so all listeners of a popular song share one partition
+# that grows without bound and takes every write and read of the song.
+# songplay_users_bucketed spreads a song over a fixed number of buckets, the bucket is part of the partition key:
+#   - hash buckets : bucket = crc32(userid) % buckets, a user always lands in the same bucket of a song
+#   - time buckets : bucket = days since epoch // bucket_days of the play, for sources that carry ts
+#     (event_datafile_new.csv has no ts column, the notebook uses hash buckets), insert_listeners takes
+#     bucket_of=lambda line: time_bucket(line['ts']) for such files
+# A read fans out over all buckets of the song concurrently and merges the results by userid.
+
+DEFAULT_TARGET_ROWS = 100000
+MS_PER_DAY = 86400 * 1000
+
+songplay_users_bucketed_create = ("""
+CREATE TABLE IF NOT EXISTS songplay_users_bucketed (
+    song text,
+    bucket int,
+    userid int,
+    firstname text,
+    lastname text,
+    gender text,
+    PRIMARY KEY ((song, bucket), userid))
+""")
+
+songplay_users_bucketed_insert = ("""
+INSERT INTO songplay_users_bucketed (song, bucket, userid, firstname, lastname, gender)
+VALUES (?, ?, ?, ?, ?, ?)
+""")
+
+songplay_users_bucketed_select = ("""
+SELECT userid, firstname, lastname
+FROM songplay_users_bucketed
+WHERE song = ? AND bucket = ?
+""")
+
+songplay_users_bucketed_drop = "DROP TABLE IF EXISTS songplay_users_bucketed"
+
+
+def listener_counts(file):
+    '''
+    Description : Counts the distinct listeners of every song in event_datafile_new.csv,
+                  the rows each song adds to a table keyed by (song, userid)
+
+    Arguments :
+        file : path of event_datafile_new.csv
+
+    Returns :
+        dict of song : number of distinct userids
+    '''
+    listeners = defaultdict(set)
+    with open(file, encoding='utf8') as f:
+        for line in csv.DictReader(f):
+            listeners[line['song']].add(int(line['userId']))
+    return {song: len(users) for song, users in listeners.items()}
+
+
+def bucket_count(counts, target_rows=DEFAULT_TARGET_ROWS, growth=1.0):
+    '''
+    Description :
+        - Sizing the buckets so that the partition of the most listened song stays below target_rows rows
+          once the data grew by growth
+        - Rounding up to a power of two, the number of buckets can then be doubled when the data outgrows it
+
+    Arguments :
+        counts : dict of song : rows, see listener_counts
+        target_rows : rows per partition at most
+        growth : expected growth factor of the data
+
+    Returns :
+        number of buckets, 1 when no song reaches target_rows
+    '''
+    if not counts:
+        return 1
+    needed = math.ceil(max(counts.values()) * growth / target_rows)
+    return 1 << max(needed - 1, 0).bit_length()
+
+
+def distribution(counts, buckets):
+    '''
+    Description : Summarizes the rows per partition of the song-keyed table and of the bucketed one
+
+    Returns :
+        dict of songs, mean, p99 and max rows per song, and the expected max rows per (song, bucket) partition
+    '''
+    rows = sorted(counts.values())
+    if not rows:
+        return {'songs': 0, 'mean': 0, 'p99': 0, 'max': 0, 'buckets': buckets, 'max_per_bucket': 0}
+    return {'songs': len(rows),
+            'mean': sum(rows) / len(rows),
+            'p99': rows[min(len(rows) - 1, int(len(rows) * 0.99))],
+            'max': rows[-1],
+            'buckets': buckets,
+            'max_per_bucket': math.ceil(rows[-1] / buckets)}
+
+
+def hash_bucket(userid, buckets):
+    '''
+    Description : Bucket of a listener, crc32 is stable across processes unlike the salted hash of python
+    '''
+    return zlib.crc32(str(userid).encode('utf8')) % buckets
+
+
+def time_bucket(ts, bucket_days=1):
+    '''
+    Description : Bucket of a play at ts milliseconds since epoch, one bucket every bucket_days days
+    '''
+    return int(ts) // (MS_PER_DAY * bucket_days)
+
+
+def time_buckets(start_ts, end_ts, bucket_days=1):
+    '''
+    Description : Buckets of the plays between start_ts and end_ts milliseconds since epoch, both inclusive
+    '''
+    return list(range(time_bucket(start_ts, bucket_days), time_bucket(end_ts, bucket_days) + 1))
+
+
+def insert_listeners(session, file, buckets, concurrency=50, bucket_of=None):
+    '''
+    Description : Loading event_datafile_new.csv into songplay_users_bucketed, with hash buckets by default,
+                  running concurrency prepared inserts at a time
+
+    Arguments :
+        session : cassandra session with the keyspace set
+        file : path of event_datafile_new.csv
+        buckets : number of hash buckets, see bucket_count
+        concurrency : inserts in flight at most
+        bucket_of : function of a csv line to its bucket, e.g. lambda line: time_bucket(line['ts']),
+                    hash_bucket of the userId when None
+
+    Returns :
+        number of rows written
+    '''
+    if bucket_of is None:
+        bucket_of = lambda line: hash_bucket(line['userId'], buckets)
+    insert = session.prepare(songplay_users_bucketed_insert)
+    with open(file, encoding='utf8') as f:
+        parameters = [(line['song'], bucket_of(line), int(line['userId']),
+                       line['firstName'], line['lastName'], line['gender'])
+                      for line in csv.DictReader(f)]
+    execute_concurrent_with_args(session, insert, parameters, concurrency=concurrency, raise_on_first_error=True)
+    return len(parameters)
+
+
+def merge_listeners(results):
+    '''
+    Description : Merges the rows of several buckets, each sorted by the userid clustering column,
+                  into one list sorted by userid, keeping the first row of a user found in several time buckets
+    '''
+    merged = []
+    for row in heapq.merge(*results, key=lambda row: row.userid):
+        if not merged or merged[-1].userid != row.userid:
+            merged.append(row)
+    return merged
+
+
+def select_listeners(session, song, buckets):
+    '''
+    Description :
+        - Reading the listeners of a song from all of its partitions, one query per bucket all sent at once
+          with execute_async, then merging them with merge_listeners
+        - Same result and order as SELECT ... FROM songplay_users_info WHERE song = ...
+
+    Arguments :
+        session : cassandra session with the keyspace set
+        song : song title
+        buckets : number of hash buckets, or the list of buckets to read, e.g. from time_buckets
+
+    Returns :
+        list of rows with userid, firstname and lastname
+    '''
+    select = session.prepare(songplay_users_bucketed_select)
+    if isinstance(buckets, int):
+        buckets = range(buckets)
+    futures = [session.execute_async(select, (song, bucket)) for bucket in buckets]
+    return merge_listeners([list(future.result()) for future in futures])
@@ -0,0 +1,81 @@
+'''
+Checks the task graph of udac_example_dag, built by build_load_tasks from TABLE_DEPENDENCIES (needs airflow installed) :
+- the DAG folder imports without errors
+- every task has exactly the upstream tasks of the original hand wired DAG
+- the load tasks sit in the TaskGroup of their layer, on Airflow versions with task groups, and run in the redshift pool
+
+    python check_dag.py
+'''
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'plugins'))
+
+DAG_ID = 'udac_example_dag'
+REDSHIFT_POOL = 'redshift'
+
+# task : (task group, upstream tasks), task ids without the group prefix
+EXPECTED_TASKS = {
+    'Begin_execution': (None, set()),
+    'Stage_events': ('staging', {'Begin_execution'}),
+    'Stage_songs': ('staging', {'Begin_execution'}),
+    'Load_songplays_fact_table': ('fact', {'Stage_events', 'Stage_songs'}),
+    'Load_user_dim_table': ('dimensions', {'Stage_events'}),
+    'Load_song_dim_table': ('dimensions', {'Stage_songs'}),
+    'Load_artist_dim_table': ('dimensions', {'Stage_songs'}),
+    'Load_time_dim_table': ('dimensions', {'Load_songplays_fact_table'}),
+    'Run_data_quality_checks': (None, {'Load_user_dim_table', 'Load_song_dim_table', 'Load_artist_dim_table',
+                                       'Load_time_dim_table'}),
+    'Stop_execution': (None, {'Run_data_quality_checks'}),
+}
+
+
+def short_id(task_id):
+    return task_id.split('.')[-1]
+
+
+def check_graph(dag):
+    failures = []
+    tasks = {short_id(task.task_id): task for task in dag.tasks}
+    if set(tasks) != set(EXPECTED_TASKS):
+        failures.append(f'tasks {sorted(tasks)} differ from {sorted(EXPECTED_TASKS)}')
+
+    for name, (group, upstream) in EXPECTED_TASKS.items():
+        task = tasks.get(name)
+        if task is None:
+            continue
+        found = {short_id(task_id) for task_id in task.upstream_task_ids}
+        if found != upstream:
+            failures.append(f'{name}: upstream {sorted(found)}, expected {sorted(upstream)}')
+        task_group = getattr(task, 'task_group', None)
+        if group is not None and task_group is not None and task_group.group_id != group:
+            failures.append(f'{name}: in task group {task_group.group_id}, expected {group}')
+        if name not in ('Begin_execution', 'Stop_execution') and task.pool != REDSHIFT_POOL:
+            failures.append(f'{name}: runs in pool {task.pool}, expected {REDSHIFT_POOL}')
+        print(f'{task.task_id} <- {", ".join(sorted(task.upstream_task_ids)) or "-"}')
+    return failures
+
+
+def main():
+    try:
+        from airflow.models import DagBag
+    except ImportError as e:
+        print(f'skipping the DAG check, {e}')
+        sys.exit(0)
+
+    dagbag = DagBag(dag_folder=os.path.join(HERE, 'dags'), include_examples=False)
+    failures = [f'{path}: {error}' for path, error in dagbag.import_errors.items()]
+    dag = dagbag.get_dag(DAG_ID)
+    if dag is None:
+        failures.append(f'{DAG_ID} not found in {os.path.join(HERE, "dags")}')
+    else:
+        failures += check_graph(dag)
+    for failure in failures:
+        print(failure)
+    print('{} {}'.format(DAG_ID, 'FAILED' if failures else 'OK'))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
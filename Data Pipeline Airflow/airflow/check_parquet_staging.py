@@ -0,0 +1,105 @@
+'''
+Checks the Parquet staging path locally, without S3 or Redshift :
+- the fixed Parquet schemas follow the staging table columns of dags/create_tables.sql
+- the sample JSON of the Data Lake project converts to Parquet with every record and the fixed schema
+- StageToRedshiftOperator renders FORMAT AS PARQUET for data_format='PARQUET' (needs airflow installed)
+
+    python check_parquet_staging.py [path to a directory holding log_data/ and song_data/]
+'''
+import importlib.util
+import io
+import os
+import re
+import sys
+from collections import namedtuple
+
+import pyarrow.parquet as pq
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'plugins'))
+
+# loaded by path, the helpers package itself imports airflow
+spec = importlib.util.spec_from_file_location('parquet_staging',
+                                              os.path.join(HERE, 'plugins', 'helpers', 'parquet_staging.py'))
+parquet_staging = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(parquet_staging)
+STAGING_COLUMNS, convert_json, staging_schema = (parquet_staging.STAGING_COLUMNS, parquet_staging.convert_json,
+                                                 parquet_staging.staging_schema)
+
+SAMPLE_DATA = os.path.join(HERE, '..', '..', 'Data Lake', 'data')
+SOURCES = {'staging_events': 'log_data', 'staging_songs': 'song_data'}
+
+
+def table_columns(create_tables_path, table):
+    with open(create_tables_path) as f:
+        sql = f.read()
+    body = re.search(r'CREATE TABLE IF NOT EXISTS public\.{} \((.*?)\n\);'.format(table), sql, re.DOTALL).group(1)
+    return [line.strip().split()[0].strip('"') for line in body.strip().splitlines()
+            if not line.strip().startswith('CONSTRAINT')]
+
+
+def json_documents(root):
+    documents, records = [], 0
+    for directory, _, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    data = f.read()
+                documents.append(data)
+                records += len([line for line in data.splitlines() if line.strip()])
+    return documents, records
+
+
+def check_conversion(data_path):
+    failures = []
+    for table, source in SOURCES.items():
+        expected = table_columns(os.path.join(HERE, 'dags', 'create_tables.sql'), table)
+        columns = [column for column, field, column_type in STAGING_COLUMNS[table]]
+        if columns != expected:
+            failures.append(f'{table}: parquet columns {columns} differ from create_tables.sql {expected}')
+
+        documents, records = json_documents(os.path.join(data_path, source))
+        data, rows = convert_json(documents, table)
+        written = pq.read_table(io.BytesIO(data))
+        if not written.schema.equals(staging_schema(table)):
+            failures.append(f'{table}: written schema {written.schema} differs from the fixed schema')
+        if rows != records or written.num_rows != records:
+            failures.append(f'{table}: {written.num_rows} rows written from {records} JSON records')
+        print(f'{table}: {len(documents)} JSON files, {records} records -> {written.num_rows} rows, '
+              f'{len(data)} bytes of parquet')
+    return failures
+
+
+def check_copy_sql():
+    try:
+        from operators.stage_redshift import StageToRedshiftOperator
+    except ImportError as e:
+        print(f'skipping the COPY SQL check, {e}')
+        return []
+
+    credentials = namedtuple('Credentials', ['access_key', 'secret_key'])('key', 'secret')
+    operator = StageToRedshiftOperator(task_id='check_parquet_copy', table='staging_events', region='us-west-2',
+                                       data_format='PARQUET', compression='gzip', statupdate=True)
+    sql = operator.build_copy_sql('s3://bucket/parquet/staging_events/log_data/2018/11', credentials)
+    print(sql)
+    failures = []
+    if 'FORMAT AS PARQUET' not in sql:
+        failures.append('COPY SQL misses FORMAT AS PARQUET')
+    if 'GZIP' in sql:
+        failures.append('COPY SQL of Parquet files asks for GZIP')
+    if 'STATUPDATE ON' not in sql:
+        failures.append('COPY SQL of Parquet files lost STATUPDATE ON')
+    return failures
+
+
+def main():
+    data_path = sys.argv[1] if len(sys.argv) > 1 else SAMPLE_DATA
+    failures = check_conversion(data_path) + check_copy_sql()
+    for failure in failures:
+        print(failure)
+    print('parquet staging {}'.format('FAILED' if failures else 'OK'))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
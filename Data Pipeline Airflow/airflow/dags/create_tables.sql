@@ -1,88 +1,104 @@
+-- Generated by Data Warehouse Redshift/table_definitions.py, edit the table definitions there.
+
 CREATE TABLE IF NOT EXISTS public.artists (
-	artistid varchar(256) NOT NULL,
-	name varchar(256),
-	location varchar(256),
-	lattitude numeric(18,0),
-	longitude numeric(18,0)
+	artistid varchar(256) ENCODE zstd NOT NULL,
+	name varchar(256) ENCODE zstd,
+	location varchar(256) ENCODE zstd,
+	lattitude numeric(18,0) ENCODE az64,
+	longitude numeric(18,0) ENCODE az64
+);
+
+CREATE TABLE IF NOT EXISTS public.calendar_hours (
+	hour_start timestamp ENCODE az64 NOT NULL,
+	"hour" int4 ENCODE az64,
+	"day" int4 ENCODE az64,
+	week int4 ENCODE az64,
+	"month" int4 ENCODE runlength,
+	"year" int4 ENCODE runlength,
+	weekday int4 ENCODE az64,
+	CONSTRAINT calendar_hours_pkey PRIMARY KEY (hour_start)
 );
 
 CREATE TABLE IF NOT EXISTS public.songplays (
-	playid varchar(32) NOT NULL,
-	start_time timestamp NOT NULL,
-	userid int4 NOT NULL,
-	"level" varchar(256),
-	songid varchar(256),
-	artistid varchar(256),
-	sessionid int4,
-	location varchar(256),
-	user_agent varchar(256),
+	playid varchar(32) ENCODE zstd NOT NULL,
+	start_time timestamp ENCODE az64 NOT NULL,
+	userid int4 ENCODE az64 NOT NULL,
+	"level" varchar(256) ENCODE bytedict,
+	songid varchar(256) ENCODE zstd,
+	artistid varchar(256) ENCODE zstd,
+	sessionid int4 ENCODE az64,
+	location varchar(256) ENCODE zstd,
+	user_agent varchar(256) ENCODE zstd,
 	CONSTRAINT songplays_pkey PRIMARY KEY (playid)
 );
 
 CREATE TABLE IF NOT EXISTS public.songs (
-	songid varchar(256) NOT NULL,
-	title varchar(256),
-	artistid varchar(256),
-	"year" int4,
-	duration numeric(18,0),
+	songid varchar(256) ENCODE zstd NOT NULL,
+	title varchar(256) ENCODE zstd,
+	artistid varchar(256) ENCODE zstd,
+	"year" int4 ENCODE az64,
+	duration numeric(18,0) ENCODE az64,
 	CONSTRAINT songs_pkey PRIMARY KEY (songid)
 );
 
 CREATE TABLE IF NOT EXISTS public.staging_events (
-	artist varchar(256),
-	auth varchar(256),
-	firstname varchar(256),
-	gender varchar(256),
-	iteminsession int4,
-	lastname varchar(256),
-	length numeric(18,0),
-	"level" varchar(256),
-	location varchar(256),
-	"method" varchar(256),
-	page varchar(256),
-	registration numeric(18,0),
-	sessionid int4,
-	song varchar(256),
-	status int4,
-	ts int8,
-	useragent varchar(256),
-	userid int4
+	artist varchar(256) ENCODE zstd,
+	auth varchar(256) ENCODE bytedict,
+	firstname varchar(256) ENCODE zstd,
+	gender varchar(256) ENCODE bytedict,
+	iteminsession int4 ENCODE az64,
+	lastname varchar(256) ENCODE zstd,
+	length numeric(18,0) ENCODE az64,
+	"level" varchar(256) ENCODE bytedict,
+	location varchar(256) ENCODE zstd,
+	"method" varchar(256) ENCODE bytedict,
+	page varchar(256) ENCODE bytedict,
+	registration numeric(18,0) ENCODE az64,
+	sessionid int4 ENCODE az64,
+	song varchar(256) ENCODE zstd,
+	status int4 ENCODE az64,
+	ts int8 ENCODE az64,
+	useragent varchar(256) ENCODE zstd,
+	userid int4 ENCODE az64
+);
+
+CREATE TABLE IF NOT EXISTS public.stage_loads (
+	table_name varchar(256) ENCODE bytedict NOT NULL,
+	s3_path varchar(1024) ENCODE zstd NOT NULL,
+	loaded_at timestamp ENCODE az64 NOT NULL,
+	etag varchar(64) ENCODE zstd
 );
 
 CREATE TABLE IF NOT EXISTS public.staging_songs (
-	num_songs int4,
-	artist_id varchar(256),
-	artist_name varchar(256),
-	artist_latitude numeric(18,0),
-	artist_longitude numeric(18,0),
-	artist_location varchar(256),
-	song_id varchar(256),
-	title varchar(256),
-	duration numeric(18,0),
-	"year" int4
+	num_songs int4 ENCODE az64,
+	artist_id varchar(256) ENCODE zstd,
+	artist_name varchar(256) ENCODE zstd,
+	artist_latitude numeric(18,0) ENCODE az64,
+	artist_longitude numeric(18,0) ENCODE az64,
+	artist_location varchar(256) ENCODE zstd,
+	song_id varchar(256) ENCODE zstd,
+	title varchar(256) ENCODE zstd,
+	duration numeric(18,0) ENCODE az64,
+	"year" int4 ENCODE az64
 );
 
 CREATE TABLE IF NOT EXISTS public."time" (
-	start_time timestamp NOT NULL,
-	"hour" int4,
-	"day" int4,
-	week int4,
-	"month" varchar(256),
-	"year" int4,
-	weekday varchar(256),
+	start_time timestamp ENCODE az64 NOT NULL,
+	"hour" int4 ENCODE az64,
+	"day" int4 ENCODE az64,
+	week int4 ENCODE az64,
+	"month" varchar(256) ENCODE bytedict,
+	"year" int4 ENCODE runlength,
+	weekday varchar(256) ENCODE bytedict,
 	CONSTRAINT time_pkey PRIMARY KEY (start_time)
 );
 
 CREATE TABLE IF NOT EXISTS public.users (
-	userid int4 NOT NULL,
-	first_name varchar(256),
-	last_name varchar(256),
-	gender varchar(256),
-	"level" varchar(256),
+	userid int4 ENCODE az64 NOT NULL,
+	first_name varchar(256) ENCODE zstd,
+	last_name varchar(256) ENCODE zstd,
+	gender varchar(256) ENCODE bytedict,
+	"level" varchar(256) ENCODE bytedict,
 	CONSTRAINT users_pkey PRIMARY KEY (userid)
 );
 
-
-
-
-
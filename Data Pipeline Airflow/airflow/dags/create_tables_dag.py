@@ -0,0 +1,42 @@
+from datetime import datetime
+from airflow import DAG
+from airflow.operators.postgres_operator import PostgresOperator
+from airflow.operators import LoadDimensionOperator
+from helpers import SqlQueries
+
+# Creates the staging, star schema and bookkeeping tables once, instead of ahead of every hourly load,
+# and fills the hour grain calendar the time dimension can be joined from
+
+REDSHIFT_CONN_ID = 'redshift'
+
+default_args = {
+    'owner': 'udacity',
+    'start_date': datetime(2019, 1, 12),
+    'depends_on_past': False,
+    'retries': 3,
+    'email_on_retry': False,
+}
+
+dag = DAG('udac_create_tables_dag',
+          default_args=default_args,
+          description='Create the Sparkify tables in Redshift',
+          schedule_interval='@once'
+        )
+
+create_tables_task = PostgresOperator(
+    task_id='Create_tables',
+    dag=dag,
+    sql='create_tables.sql',
+    postgres_conn_id=REDSHIFT_CONN_ID
+)
+
+load_calendar_table = LoadDimensionOperator(
+    task_id='Load_calendar_table',
+    dag=dag,
+    redshift_conn_id=REDSHIFT_CONN_ID,
+    table='calendar_hours',
+    load_mode='append',
+    sql_query=SqlQueries.calendar_table_insert
+)
+
+create_tables_task >> load_calendar_table
@@ -1,23 +1,41 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
-                                LoadDimensionOperator, DataQualityOperator)
-from helpers import SqlQueries
-from airflow.operators.postgres_operator import PostgresOperator
+                                LoadDimensionOperator, DataQualityOperator,
+                                JsonToParquetOperator)
+from helpers import SqlQueries, table_ddl
+
+try:
+    from airflow.utils.task_group import TaskGroup
+except ImportError:
+    # Airflow 1.10 has no task groups, the layers then only shape the dependencies
+    TaskGroup = None
 
 # /opt/airflow/start.sh
+# The tables are created once by udac_create_tables_dag.
+# The Redshift pool caps the concurrent Redshift connections of all load tasks :
+#   airflow pool -s redshift 4 "Redshift connections"
 
 AWS_KEY = os.environ.get('AWS_KEY')
 AWS_SECRET = os.environ.get('AWS_SECRET')
 S3_BUCKET = 'udacity-dend'
+# writable bucket of the COPY manifests of the incremental staging tasks, udacity-dend is read only
+MANIFEST_BUCKET = os.environ.get('MANIFEST_BUCKET', 'sparkify-staging')
 S3_SONG_KEY = 'song_data'
 REDSHIFT_CONN_ID = 'redshift'
+REDSHIFT_POOL = 'redshift'
 AWS_CREDENTIALS_ID = 'aws_credentials'
-S3_LOG_KEY = 'log_data'
+S3_LOG_KEY = 'log_data/{{ execution_date.strftime("%Y/%m") }}/{{ ds }}-events.json'
 LOG_JSON_PATH = f's3://{S3_BUCKET}/log_json_path.json'
 REGION = 'us-west-2'
+# join the time dimension from calendar_hours (loaded by udac_create_tables_dag) instead of extract()
+USE_CALENDAR_TABLE = False
+# convert the JSON slices to Parquet under PARQUET_PREFIX first and COPY the columnar copy
+USE_PARQUET_STAGING = False
+PARQUET_PREFIX = 'parquet'
 
 
 default_args = {
@@ -28,108 +46,180 @@ default_args = {
     'retry_delay': timedelta(minutes=5),
     'email_on_retry': False,
     'catchup': False,
+    # Redshift query group of every load and check session, see stl_query.label and the WLM queue config
+    'query_group': 'sparkify_etl',
 }
 
 dag = DAG('udac_example_dag',
           default_args=default_args,
           description='Load and transform data in Redshift with Airflow',
-          schedule_interval='0 * * * *'
+          schedule_interval='0 * * * *',
+          max_active_runs=1
         )
 
-create_tables_task = PostgresOperator(
-    task_id='Create_tables',
-    dag=dag,
-    sql='create_tables.sql',
-    postgres_conn_id='redshift'
-)
-
-start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
-
-stage_events_to_redshift = StageToRedshiftOperator(
-    task_id='Stage_events',
-    dag=dag,
-    redshift_conn_id=REDSHIFT_CONN_ID,
-    aws_credentials_id=AWS_CREDENTIALS_ID,
-    table='staging_events',
-    s3_bucket=S3_BUCKET,
-    s3_key=S3_LOG_KEY,
-    region=REGION,
-    truncate=True,
-    data_format=f"JSON '{LOG_JSON_PATH}'",
-)
-
-stage_songs_to_redshift = StageToRedshiftOperator(
-    task_id='Stage_songs',
-    dag=dag,
-    redshift_conn_id=REDSHIFT_CONN_ID,
-    aws_credentials_id=AWS_CREDENTIALS_ID,
-    table='staging_songs',
-    s3_bucket=S3_BUCKET,
-    s3_key=S3_SONG_KEY,
-    region=REGION,
-    truncate=True,
-    data_format="JSON 'auto'",
-)
+# table : (layer, tables it is loaded from), the task graph is derived from these declarations
+TABLE_DEPENDENCIES = {
+    'staging_events': ('staging', []),
+    'staging_songs': ('staging', []),
+    'songplays': ('fact', ['staging_events', 'staging_songs']),
+    'users': ('dimensions', ['staging_events']),
+    'songs': ('dimensions', ['staging_songs']),
+    'artists': ('dimensions', ['staging_songs']),
+    'time': ('dimensions', ['songplays']),
+}
 
-load_songplays_table = LoadFactOperator(
-    task_id='Load_songplays_fact_table',
-    dag=dag,
-    table = 'songplays',
-    append_data=True,
-    sql_query=SqlQueries.songplay_table_insert
-)
+# table : (operator, arguments of its load task)
+LOAD_TASKS = {
+    'staging_events': (StageToRedshiftOperator, dict(
+        task_id='Stage_events',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        aws_credentials_id=AWS_CREDENTIALS_ID,
+        table='staging_events',
+        s3_bucket=S3_BUCKET,
+        s3_key=S3_LOG_KEY,
+        region=REGION,
+        truncate=False,
+        incremental=True,
+        manifest_bucket=MANIFEST_BUCKET,
+        data_format=f"JSON '{LOG_JSON_PATH}'",
+    )),
+    'staging_songs': (StageToRedshiftOperator, dict(
+        task_id='Stage_songs',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        aws_credentials_id=AWS_CREDENTIALS_ID,
+        table='staging_songs',
+        s3_bucket=S3_BUCKET,
+        s3_key=S3_SONG_KEY,
+        region=REGION,
+        # staging_songs keeps every song, songs and artists are rebuilt from it and songplays joins it,
+        # each run only copies the song files added since the last one
+        truncate=False,
+        incremental=True,
+        manifest_bucket=MANIFEST_BUCKET,
+        compupdate=False,
+        statupdate=True,
+        data_format="JSON 'auto'",
+    )),
+    'songplays': (LoadFactOperator, dict(
+        task_id='Load_songplays_fact_table',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        table='songplays',
+        append_data=True,
+        window_column='start_time',
+        sql_query=SqlQueries.songplay_table_insert,
+    )),
+    'users': (LoadDimensionOperator, dict(
+        task_id='Load_user_dim_table',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        table='users',
+        load_mode='upsert',
+        primary_key='userid',
+        sql_query=SqlQueries.user_table_insert,
+    )),
+    'songs': (LoadDimensionOperator, dict(
+        task_id='Load_song_dim_table',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        table='songs',
+        load_mode='swap',
+        table_ddl=table_ddl('songs'),
+        sql_query=SqlQueries.song_table_insert,
+    )),
+    'artists': (LoadDimensionOperator, dict(
+        task_id='Load_artist_dim_table',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        table='artists',
+        load_mode='swap',
+        table_ddl=table_ddl('artists'),
+        sql_query=SqlQueries.artist_table_insert,
+    )),
+    'time': (LoadDimensionOperator, dict(
+        task_id='Load_time_dim_table',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        table='time',
+        load_mode='append',
+        window_column='start_time',
+        sql_query=(SqlQueries.time_table_insert_from_calendar if USE_CALENDAR_TABLE
+                   else SqlQueries.time_table_insert),
+    )),
+}
 
-load_user_dimension_table = LoadDimensionOperator(
-    task_id='Load_user_dim_table',
-    dag=dag,
-    table = 'users',
-    truncate_data=True,
-    sql_query = SqlQueries.user_table_insert
-)
+if USE_PARQUET_STAGING:
+    for table, source_key in (('staging_events', S3_LOG_KEY), ('staging_songs', S3_SONG_KEY)):
+        TABLE_DEPENDENCIES[f'{table}_parquet'] = ('prestage', [])
+        TABLE_DEPENDENCIES[table] = ('staging', [f'{table}_parquet'])
+        LOAD_TASKS[f'{table}_parquet'] = (JsonToParquetOperator, dict(
+            task_id=f'Convert_{table}_to_parquet',
+            aws_credentials_id=AWS_CREDENTIALS_ID,
+            table=table,
+            s3_bucket=S3_BUCKET,
+            s3_key=source_key,
+            parquet_prefix=f'{PARQUET_PREFIX}/{table}',
+        ))
+        # the parquet directory mirrors the JSON key, s3_key stays a prefix of the converted files
+        source_prefix = source_key[:-len('.json')] if source_key.endswith('.json') else source_key
+        LOAD_TASKS[table][1].update(s3_key=f'{PARQUET_PREFIX}/{table}/{source_prefix}', data_format='PARQUET')
+
+
+@contextmanager
+def layer_group(layer, dag):
+    if TaskGroup is None:
+        yield None
+    else:
+        with TaskGroup(layer, dag=dag) as group:
+            yield group
+
+
+def build_load_tasks(dag, dependencies, load_tasks, pool):
+    '''
+    Description:
+    - Creates the load task of every table, grouped per layer
+    - Wires each task only to the tasks of the tables it is loaded from
+    - Returns the tasks by table
+    '''
+    layers = []
+    for layer, upstream in dependencies.values():
+        if layer not in layers:
+            layers.append(layer)
+
+    tasks = {}
+    for layer in layers:
+        with layer_group(layer, dag):
+            for table, (table_layer, upstream) in dependencies.items():
+                if table_layer == layer:
+                    operator, arguments = load_tasks[table]
+                    tasks[table] = operator(dag=dag, pool=pool, **arguments)
+
+    for table, (layer, upstream) in dependencies.items():
+        for upstream_table in upstream:
+            tasks[upstream_table] >> tasks[table]
+    return tasks
 
-load_song_dimension_table = LoadDimensionOperator(
-    task_id='Load_song_dim_table',
-    dag=dag,
-    table = 'songs',
-    truncate_data=True,
-    sql_query = SqlQueries.song_table_insert
-)
 
-load_artist_dimension_table = LoadDimensionOperator(
-    task_id='Load_artist_dim_table',
-    dag=dag,
-    table ='artists',
-    truncate_data=True,
-    sql_query = SqlQueries.artist_table_insert
-)
+start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
 
-load_time_dimension_table = LoadDimensionOperator(
-    task_id='Load_time_dim_table',
-    dag=dag,
-    table = 'time',
-    truncate_data=True,
-    sql_query = SqlQueries.time_table_insert
-)
+load_tasks = build_load_tasks(dag, TABLE_DEPENDENCIES, LOAD_TASKS, REDSHIFT_POOL)
 
 run_quality_checks = DataQualityOperator(
     task_id='Run_data_quality_checks',
-    dag=dag
+    dag=dag,
+    pool=REDSHIFT_POOL,
+    redshift_conn_id=REDSHIFT_CONN_ID,
+    checks={
+        'songplays': {'min_rows': 1, 'not_null': ['playid', 'start_time', 'userid'], 'unique': ['playid']},
+        'users': {'min_rows': 1, 'not_null': ['userid'], 'unique': ['userid']},
+        'songs': {'min_rows': 1, 'not_null': ['songid'], 'unique': ['songid']},
+        'artists': {'min_rows': 1, 'not_null': ['artistid']},
+        'time': {'min_rows': 1, 'not_null': ['start_time'], 'unique': ['start_time']},
+    },
 )
 
 end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
 
 
-start_operator >> create_tables_task 
-create_tables_task >> stage_events_to_redshift
-create_tables_task >> stage_songs_to_redshift
-stage_events_to_redshift >> load_songplays_table
-stage_songs_to_redshift >> load_songplays_table
-load_songplays_table >> load_user_dimension_table
-load_songplays_table >> load_song_dimension_table
-load_songplays_table >> load_artist_dimension_table
-load_songplays_table >> load_time_dimension_table
-load_user_dimension_table >> run_quality_checks
-load_song_dimension_table >> run_quality_checks
-load_artist_dimension_table >> run_quality_checks
-load_time_dimension_table >> run_quality_checks
-run_quality_checks >> end_operator
\ No newline at end of file
+loaded_from = {table for layer, upstream in TABLE_DEPENDENCIES.values() for table in upstream}
+for table, task in load_tasks.items():
+    if not TABLE_DEPENDENCIES[table][1]:
+        start_operator >> task
+    if table not in loaded_from:
+        task >> run_quality_checks
+run_quality_checks >> end_operator
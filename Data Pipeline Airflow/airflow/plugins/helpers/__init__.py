@@ -1,5 +1,13 @@
 from helpers.sql_queries import SqlQueries
+from helpers.execution_window import execution_window
+from helpers.redshift_session import RedshiftSession
+from helpers.instrumentation import InstrumentedOperatorMixin
+from helpers.table_ddl import table_ddl
 
 __all__ = [
     'SqlQueries',
-]
\ No newline at end of file
+    'execution_window',
+    'RedshiftSession',
+    'InstrumentedOperatorMixin',
+    'table_ddl',
+]
@@ -0,0 +1,11 @@
+def execution_window(context):
+    '''
+    Description:
+    - Returns the data interval of a DAG run as (start, end) timestamp strings,
+      from the execution date up to (excluding) the next execution date
+    '''
+    start = context['execution_date']
+    end = context.get('next_execution_date')
+    if end is None:
+        raise ValueError(f'No next execution date for the run of {start}, cannot derive its window')
+    return start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')
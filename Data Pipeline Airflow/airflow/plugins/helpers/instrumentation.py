@@ -0,0 +1,103 @@
+import re
+import threading
+import time
+
+try:
+    from airflow.stats import Stats
+except ImportError:
+    from airflow.settings import Stats
+
+from helpers.redshift_session import RedshiftSession
+
+class InstrumentedOperatorMixin:
+    '''
+    Description:
+    - Times every SQL statement an operator runs and records the rows it touched from cursor.rowcount
+    - With explain_inserts set, the EXPLAIN plan of every INSERT ... SELECT is captured before it runs
+    - Statement metrics are sent to StatsD as <metrics_prefix>.<dag_id>.<task_id>.<statement>.duration/rows
+      while the task runs, and pushed to XCom under the key sql_metrics when push_sql_metrics is called
+    - Operators set explain_inserts in their constructor, metrics_prefix can be overridden per operator class
+    - redshift_session opens the task's RedshiftSession from the operator's redshift_conn_id,
+      query_group and wlm_slot_count
+    - execute_sql may be called from several threads, e.g. DataQualityOperator's pool, the metrics list is
+      created and appended to under a lock. The lock is a class attribute, operators are deep copied and a
+      lock per instance could not be
+    '''
+    metrics_prefix = 'sparkify'
+    explain_inserts = False
+    insert_select_pattern = re.compile(r'^\s*INSERT\s+INTO\s+\S+\s*(\([^)]*\)\s*)?(WITH|SELECT)\b',
+                                       re.IGNORECASE | re.DOTALL)
+    sql_metrics_lock = threading.Lock()
+
+    @property
+    def sql_metrics(self):
+        with InstrumentedOperatorMixin.sql_metrics_lock:
+            if not hasattr(self, '_sql_metrics'):
+                self._sql_metrics = []
+            return self._sql_metrics
+
+    def statement_label(self, sql, label=None):
+        '''
+        Names a statement for its metrics, by default after its first keyword, e.g. insert or copy.
+        '''
+        if label is None:
+            words = sql.split()
+            label = words[0].lower() if words else 'empty'
+        return re.sub(r'[^a-zA-Z0-9_]', '_', label)
+
+    def stat_name(self, label, metric):
+        return '.'.join(re.sub(r'[^a-zA-Z0-9_\-]', '_', part)
+                        for part in (self.metrics_prefix, self.dag_id, self.task_id, label, metric))
+
+    def explain(self, cursor, sql):
+        cursor.execute('EXPLAIN ' + sql.strip().rstrip(';'))
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def execute_sql(self, cursor, sql, parameters=None, label=None):
+        '''
+        Runs one statement on the cursor and records its duration, affected rows and, for insert-selects
+        with explain_inserts set, its plan.
+        Returns the metric record, rows can be corrected by the caller, e.g. from pg_last_copy_count.
+        '''
+        record = {'statement': self.statement_label(sql, label), 'table': getattr(self, 'table', None)}
+        if self.explain_inserts and InstrumentedOperatorMixin.insert_select_pattern.match(sql):
+            record['plan'] = self.explain(cursor, sql)
+            self.log.info(f"Plan of {record['statement']} on {record['table']}:\n{record['plan']}")
+
+        start = time.perf_counter()
+        cursor.execute(sql, parameters)
+        record['duration'] = round(time.perf_counter() - start, 3)
+        record['rows'] = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else None
+
+        metrics = self.sql_metrics
+        with InstrumentedOperatorMixin.sql_metrics_lock:
+            metrics.append(record)
+        self.log.info(f"{record['statement']} on {record['table']}: {record['duration']}s, {record['rows']} rows")
+        Stats.timing(self.stat_name(record['statement'], 'duration'), record['duration'] * 1000)
+        if record['rows'] is not None:
+            Stats.gauge(self.stat_name(record['statement'], 'rows'), record['rows'])
+        return record
+
+    def redshift_session(self):
+        return RedshiftSession(self.redshift_conn_id,
+                               query_group=getattr(self, 'query_group', None),
+                               wlm_slot_count=getattr(self, 'wlm_slot_count', None))
+
+    def run_statements(self, session, statements):
+        '''
+        Runs the statements on the session's connection, recording the metrics of each statement.
+        They are committed together when the session's block exits.
+        '''
+        for sql in statements:
+            self.execute_sql(session.cursor, sql)
+
+    def push_sql_metrics(self, context):
+        '''
+        Pushes the metrics of the task's statements to XCom and its total SQL time to StatsD.
+        '''
+        total = round(sum(record['duration'] for record in self.sql_metrics), 3)
+        rows = sum(record['rows'] or 0 for record in self.sql_metrics)
+        Stats.timing(self.stat_name('total', 'duration'), total * 1000)
+        context['ti'].xcom_push(key='sql_metrics', value={'statements': self.sql_metrics,
+                                                          'duration': total, 'rows': rows})
+        self.log.info(f'{len(self.sql_metrics)} statements in {total}s, {rows} rows')
@@ -0,0 +1,107 @@
+import io
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+import pyarrow.parquet as pq
+
+# staging table : [(column, JSON field, Redshift type)] in the column order of create_tables.sql,
+# COPY ... FORMAT AS PARQUET maps the Parquet columns to the table columns by position
+STAGING_COLUMNS = {
+    'staging_events': [
+        ('artist', 'artist', 'varchar'),
+        ('auth', 'auth', 'varchar'),
+        ('firstname', 'firstName', 'varchar'),
+        ('gender', 'gender', 'varchar'),
+        ('iteminsession', 'itemInSession', 'int4'),
+        ('lastname', 'lastName', 'varchar'),
+        ('length', 'length', 'numeric(18,0)'),
+        ('level', 'level', 'varchar'),
+        ('location', 'location', 'varchar'),
+        ('method', 'method', 'varchar'),
+        ('page', 'page', 'varchar'),
+        ('registration', 'registration', 'numeric(18,0)'),
+        ('sessionid', 'sessionId', 'int4'),
+        ('song', 'song', 'varchar'),
+        ('status', 'status', 'int4'),
+        ('ts', 'ts', 'int8'),
+        ('useragent', 'userAgent', 'varchar'),
+        ('userid', 'userId', 'int4'),
+    ],
+    'staging_songs': [
+        ('num_songs', 'num_songs', 'int4'),
+        ('artist_id', 'artist_id', 'varchar'),
+        ('artist_name', 'artist_name', 'varchar'),
+        ('artist_latitude', 'artist_latitude', 'numeric(18,0)'),
+        ('artist_longitude', 'artist_longitude', 'numeric(18,0)'),
+        ('artist_location', 'artist_location', 'varchar'),
+        ('song_id', 'song_id', 'varchar'),
+        ('title', 'title', 'varchar'),
+        ('duration', 'duration', 'numeric(18,0)'),
+        ('year', 'year', 'int4'),
+    ],
+}
+
+ARROW_TYPES = {
+    'varchar': pa.string(),
+    'int4': pa.int32(),
+    'int8': pa.int64(),
+    'numeric(18,0)': pa.decimal128(18, 0),
+}
+
+
+def staging_schema(table):
+    '''
+    Description:
+    - Arrow schema of the Parquet files of a staging table, named and ordered like the table
+    '''
+    return pa.schema([(column, ARROW_TYPES[column_type]) for column, field, column_type in STAGING_COLUMNS[table]])
+
+
+def cast_column(values, arrow_type):
+    '''
+    Description:
+    - Casts a JSON column to the type of its table column the way COPY does: empty strings of
+      numeric columns become NULL and numbers are rounded to the scale of numeric columns
+    '''
+    if values.type == arrow_type:
+        return values
+    if pa.types.is_null(values.type):
+        return pa.nulls(len(values), arrow_type)
+    if pa.types.is_string(values.type) and not pa.types.is_string(arrow_type):
+        values = pc.if_else(pc.equal(values, ''), pa.scalar(None, pa.string()), values)
+        values = values.cast(pa.float64() if pa.types.is_decimal(arrow_type) else arrow_type)
+    if pa.types.is_decimal(arrow_type) and pa.types.is_floating(values.type):
+        values = pc.round(values, arrow_type.scale)
+    return values.cast(arrow_type)
+
+
+def json_to_table(data, table):
+    '''
+    Description:
+    - Parses newline delimited JSON into an arrow table with the fixed schema of a staging table
+    - Fields are matched by their JSON name, missing fields are NULL and unknown fields are dropped
+    '''
+    schema = staging_schema(table)
+    records = pj.read_json(io.BytesIO(data))
+    columns = []
+    for (column, field, column_type), target in zip(STAGING_COLUMNS[table], schema):
+        if field in records.column_names:
+            columns.append(cast_column(records.column(field).combine_chunks(), target.type))
+        else:
+            columns.append(pa.nulls(records.num_rows, target.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def convert_json(documents, table):
+    '''
+    Description:
+    - Converts a list of JSON documents of one staging table to the bytes of one Parquet file
+    Returns:
+    - Parquet bytes and the number of rows
+    '''
+    parsed = [json_to_table(data, table) for data in documents]
+    converted = pa.concat_tables(parsed) if parsed else staging_schema(table).empty_table()
+    buffer = io.BytesIO()
+    pq.write_table(converted, buffer, compression='snappy')
+    return buffer.getvalue(), converted.num_rows
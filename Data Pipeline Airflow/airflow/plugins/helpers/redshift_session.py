@@ -0,0 +1,58 @@
+from airflow.hooks.postgres_hook import PostgresHook
+
+class RedshiftSession:
+    '''
+    Description:
+    - Holds one connection of a Postgres/Redshift connection id for the statements of a task execution
+    - Used as a context manager, everything run inside the block is one transaction, committed when
+      the block exits and rolled back when it raises
+    - query_group sets the session's query group, so the loads can be routed to a WLM queue and found
+      in stl_query, wlm_slot_count sets wlm_query_slot_count to give a heavy load more slots of its queue.
+      Both are Redshift session parameters and are only sent when set
+    - TRUNCATE commits implicitly on Redshift, run it first in the block to keep the rest in one transaction
+    '''
+    session_sql = {
+        'query_group': "SET query_group TO '{}';",
+        'wlm_slot_count': "SET wlm_query_slot_count TO {};",
+    }
+
+    def __init__(self, redshift_conn_id, query_group=None, wlm_slot_count=None):
+        self.redshift_conn_id = redshift_conn_id
+        self.query_group = query_group
+        self.wlm_slot_count = wlm_slot_count
+        self.conn = None
+        self.cursor = None
+
+    def session_statements(self):
+        settings = {'query_group': self.query_group, 'wlm_slot_count': self.wlm_slot_count}
+        return [RedshiftSession.session_sql[name].format(value)
+                for name, value in settings.items() if value is not None]
+
+    def __enter__(self):
+        self.conn = PostgresHook(postgres_conn_id=self.redshift_conn_id).get_conn()
+        self.cursor = self.conn.cursor()
+        for sql in self.session_statements():
+            self.cursor.execute(sql)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
+            self.conn = self.cursor = None
+        return False
+
+    def commit(self):
+        self.conn.commit()
+
+    def get_records(self, sql, parameters=None):
+        self.cursor.execute(sql, parameters)
+        return self.cursor.fetchall()
+
+    def get_first(self, sql, parameters=None):
+        self.cursor.execute(sql, parameters)
+        return self.cursor.fetchone()
@@ -19,10 +19,14 @@ class SqlQueries:
                 AND events.length = songs.duration
     """)
 
+    # one row per user, from their latest event, so a user who changed level is loaded with the current one
     user_table_insert = ("""
-        SELECT distinct userid, firstname, lastname, gender, level
-        FROM staging_events
-        WHERE page='NextSong'
+        SELECT userid, firstname, lastname, gender, level
+        FROM (SELECT userid, firstname, lastname, gender, level,
+                     ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS event_rank
+              FROM staging_events
+              WHERE page='NextSong' AND userid IS NOT NULL) events
+        WHERE event_rank = 1
     """)
 
     song_table_insert = ("""
@@ -36,7 +40,43 @@ class SqlQueries:
     """)
 
     time_table_insert = ("""
-        SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
-               extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
+        SELECT DISTINCT songplays.start_time, extract(hour from songplays.start_time), extract(day from songplays.start_time),
+               extract(week from songplays.start_time), extract(month from songplays.start_time),
+               extract(year from songplays.start_time), extract(dow from songplays.start_time)
         FROM songplays
-    """)
\ No newline at end of file
+        LEFT JOIN "time"
+            ON "time".start_time = songplays.start_time
+        WHERE "time".start_time IS NULL
+    """)
+
+    # time rows joined from the precomputed calendar instead of derived with extract
+    time_table_insert_from_calendar = ("""
+        SELECT DISTINCT songplays.start_time, calendar.hour, calendar.day, calendar.week,
+               calendar.month, calendar.year, calendar.weekday
+        FROM songplays
+        JOIN calendar_hours calendar
+            ON calendar.hour_start = date_trunc('hour', songplays.start_time)
+        LEFT JOIN "time"
+            ON "time".start_time = songplays.start_time
+        WHERE "time".start_time IS NULL
+    """)
+
+    # one row per hour from 2018-01-01 for 100000 hours (until 2029), rows already present are skipped
+    calendar_table_insert = ("""
+        WITH digits AS (
+            SELECT 0 AS n UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4
+            UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7 UNION ALL SELECT 8 UNION ALL SELECT 9
+        ),
+        hours AS (
+            SELECT TIMESTAMP '2018-01-01 00:00:00'
+                   + (d1.n + 10 * d2.n + 100 * d3.n + 1000 * d4.n + 10000 * d5.n) * interval '1 hour' AS hour_start
+            FROM digits d1, digits d2, digits d3, digits d4, digits d5
+        )
+        SELECT hours.hour_start, extract(hour from hours.hour_start), extract(day from hours.hour_start),
+               extract(week from hours.hour_start), extract(month from hours.hour_start),
+               extract(year from hours.hour_start), extract(dow from hours.hour_start)
+        FROM hours
+        LEFT JOIN calendar_hours
+            ON calendar_hours.hour_start = hours.hour_start
+        WHERE calendar_hours.hour_start IS NULL
+    """)
@@ -0,0 +1,20 @@
+import os
+import re
+
+# generated from the table registry of Data Warehouse Redshift/table_definitions.py
+CREATE_TABLES_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'dags', 'create_tables.sql')
+
+
+def table_ddl(table, path=CREATE_TABLES_SQL):
+    '''
+    Description:
+    - Returns the CREATE TABLE statement of a table from dags/create_tables.sql, with its encodings,
+      distribution and primary key, e.g. for LoadDimensionOperator to create a shadow table from
+    '''
+    with open(path) as f:
+        sql = f.read()
+    match = re.search(r'CREATE TABLE IF NOT EXISTS public\.("?){}\1 \(.*?\n\)[^;]*;'.format(re.escape(table)),
+                      sql, re.DOTALL)
+    if match is None:
+        raise ValueError(f'No CREATE TABLE statement of {table} in {path}')
+    return match.group(0)
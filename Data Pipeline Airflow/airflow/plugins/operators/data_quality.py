@@ -1,54 +1,107 @@
-from airflow.hooks.postgres_hook import PostgresHook
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
-class DataQualityOperator(BaseOperator):
+from helpers import InstrumentedOperatorMixin
+
+class DataQualityOperator(InstrumentedOperatorMixin, BaseOperator):
     '''
     Description:
-    - Checks Data quality on Dimension Tables
-    - Focuses on NULL value entry on primary key of tables
-    
+    - Checks Data quality on the tables given by per table check specs, e.g.
+      {'songplays': {'min_rows': 1, 'not_null': ['playid', 'start_time'], 'unique': ['playid'],
+                     'freshness': {'column': 'start_time', 'max_age_hours': 24}}}
+    - All checks of one table are fused into a single SELECT, so every table is scanned once
+    - Tables are checked concurrently and every failing check is reported before failing the task
+    - Tables listed in `tables` without a spec are checked for at least one row
+    - Duration of every table's check query is pushed to XCom and StatsD
+    - Every concurrently checked table uses its own session, tagged with query_group when set
     '''
-    data_quality_checks = [
-        {'check_sql' : "SELECT COUNT(*) FROM users WHERE userid IS NULL",
-         'expected_val' : 0},
-        {'check_sql' : "SELECT COUNT(*) FROM songs WHERE songid IS NULL",
-         'expected_val' : 0},
-        {'check_sql' : "SELECT COUNT(*) FROM time WHERE start_time IS NULL",
-         'expected_val' : 0}]
-        
+    default_checks = {
+        'users': {'not_null': ['userid']},
+        'songs': {'not_null': ['songid']},
+        'time': {'not_null': ['start_time']},
+    }
+
     ui_color = '#89DA59'
 
     @apply_defaults
     def __init__(self,
                  redshift_conn_id = "redshift",
                  tables=[],
+                 checks=None,
+                 max_workers=4,
+                 query_group=None,
                  *args, **kwargs):
 
         super(DataQualityOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id = redshift_conn_id
         self.tables = tables
-        
+        self.checks = checks
+        self.max_workers = max_workers
+        self.query_group = query_group
+
+    def table_checks(self):
+        checks = dict(self.checks or {})
+        for table in self.tables:
+            checks.setdefault(table, {'min_rows': 1})
+        return checks or DataQualityOperator.default_checks
+
+    @staticmethod
+    def build_check_sql(table, spec):
+        '''
+        Builds the single SELECT of all checks of a table.
+        Returns the SQL and the list of (check, column) names of its result columns.
+        '''
+        columns = [('COUNT(*)', ('row_count', None))]
+        for column in spec.get('not_null', []):
+            columns.append((f'SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END)', ('not_null', column)))
+        for column in spec.get('unique', []):
+            columns.append((f'COUNT({column}) - COUNT(DISTINCT {column})', ('unique', column)))
+        if 'freshness' in spec:
+            column = spec['freshness']['column']
+            columns.append((f'MAX({column})', ('freshness', column)))
+        select = ',\n               '.join(expression for expression, name in columns)
+        return f'SELECT {select}\n        FROM {table}', [name for expression, name in columns]
+
+    def run_table_checks(self, table, spec, execution_date):
+        sql, names = DataQualityOperator.build_check_sql(table, spec)
+        with self.redshift_session() as session:
+            self.execute_sql(session.cursor, sql, label=f'check_{table}')
+            values = session.cursor.fetchone()
+
+        failures = []
+        for (check, column), value in zip(names, values):
+            if check == 'row_count':
+                if value < spec.get('min_rows', 0):
+                    failures.append(f"{table} has {value} rows, expected at least {spec['min_rows']}")
+            elif check == 'not_null' and value:
+                failures.append(f'{table}.{column} has {value} NULL values')
+            elif check == 'unique' and value:
+                failures.append(f'{table}.{column} has {value} duplicate values')
+            elif check == 'freshness':
+                oldest = execution_date - timedelta(hours=spec['freshness']['max_age_hours'])
+                if value is None or value < oldest.replace(tzinfo=None):
+                    failures.append(f'{table}.{column} latest value {value} is older than {oldest}')
+        self.log.info(f'{table}: {len(names)} checks, {len(failures)} failed')
+        return failures
 
     def execute(self, context):
-        redshift_hook = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        failureCount = 0
-        failingTest = []
-        
-        for check in DataQualityOperator.data_quality_checks:
-            sql_query = check.get('check_sql')
-            expect_result = check.get('expected_val')
-            records = redshift_hook.get_records(sql_query)[0]
-            
-            if expect_result != records[0]:
-                failureCount += 1
-                failingTest.append(sql_query)
-                
-            if failureCount > 0:
-                self.log.info("bad data quality")
-                self.log.info("number of failed test: {}".format(failureCount))
-                self.log.info(failingTest)
-                raise ValueError("Data Quality check Failed")
-                
-            if failureCount == 0:
-                self.log.info("Pass")
\ No newline at end of file
+        checks = self.table_checks()
+        execution_date = context['execution_date']
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = pool.map(lambda item: self.run_table_checks(item[0], item[1], execution_date),
+                               checks.items())
+            failingTest = [failure for failures in results for failure in failures]
+        self.push_sql_metrics(context)
+
+        if failingTest:
+            self.log.info("bad data quality")
+            self.log.info("number of failed test: {}".format(len(failingTest)))
+            for failure in failingTest:
+                self.log.info(failure)
+            raise ValueError("Data Quality check Failed: {}".format('; '.join(failingTest)))
+
+        self.log.info("Pass")
@@ -0,0 +1,78 @@
+from airflow.hooks.S3_hook import S3Hook
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+class JsonToParquetOperator(BaseOperator):
+    '''
+    Description:
+    - Converts the JSON objects under s3_key into Parquet under parquet_prefix, with the fixed schema and
+      column order of a staging table, so StageToRedshiftOperator can COPY them with data_format='PARQUET'
+    - s3_key is templated like in StageToRedshiftOperator, every run converts the slice of its execution date
+    - The objects of one source directory are combined into one Parquet file at the same directory below
+      parquet_prefix, named after the last segment of s3_key, e.g.
+      log_data/2018/11/2018-11-12-events.json -> parquet/staging_events/log_data/2018/11/2018-11-12-events.parquet
+      song_data/A/B/C/*.json -> parquet/staging_songs/song_data/A/B/C/song_data.parquet
+    - Directories whose Parquet file is newer than all their JSON objects are skipped, only new slices are converted
+    - A changed slice is converted again under the same key, an incremental StageToRedshiftOperator that already
+      loaded it fails on the changed ETag instead of staging its rows twice
+    - Needs pyarrow on the workers, it is imported when the task runs
+    '''
+    ui_color = '#7FB3D5'
+    template_fields = ("s3_key", "parquet_prefix")
+
+    @apply_defaults
+    def __init__(self,
+                 aws_credentials_id="",
+                 table="",
+                 s3_bucket="",
+                 s3_key="",
+                 parquet_prefix="",
+                 *args, **kwargs):
+
+        super(JsonToParquetOperator, self).__init__(*args, **kwargs)
+        self.aws_credentials_id = aws_credentials_id
+        self.table = table
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.parquet_prefix = parquet_prefix
+
+    def list_objects(self, s3, prefix):
+        '''
+        Lists key and last modified time of the objects under prefix.
+        '''
+        paginator = s3.get_conn().get_paginator('list_objects_v2')
+        objects = {}
+        for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix):
+            objects.update((item['Key'], item['LastModified']) for item in page.get('Contents', [])
+                           if not item['Key'].endswith('/'))
+        return objects
+
+    def parquet_key(self, directory):
+        name = self.s3_key.rstrip('/').split('/')[-1]
+        name = name[:-len('.json')] if name.endswith('.json') else name
+        return '{}/{}/{}.parquet'.format(self.parquet_prefix.rstrip('/'), directory, name)
+
+    def execute(self, context):
+        from helpers.parquet_staging import convert_json
+
+        s3 = S3Hook(aws_conn_id=self.aws_credentials_id)
+        sources = {key: modified for key, modified in self.list_objects(s3, self.s3_key).items()
+                   if key.endswith('.json')}
+        converted = self.list_objects(s3, self.parquet_prefix)
+
+        directories = {}
+        for key in sorted(sources):
+            directories.setdefault(key.rsplit('/', 1)[0] if '/' in key else '', []).append(key)
+
+        written = 0
+        for directory, keys in directories.items():
+            target = self.parquet_key(directory)
+            if target in converted and converted[target] >= max(sources[key] for key in keys):
+                continue
+            documents = [s3.read_key(key, bucket_name=self.s3_bucket).encode('utf-8') for key in keys]
+            data, rows = convert_json(documents, self.table)
+            s3.load_bytes(data, target, bucket_name=self.s3_bucket, replace=True)
+            written += 1
+            self.log.info(f'Converted {len(keys)} JSON objects of {directory} into {rows} rows of s3://{self.s3_bucket}/{target}')
+
+        self.log.info(f'{written} of {len(directories)} directories under {self.s3_key} converted for {self.table}')
@@ -1,19 +1,62 @@
-from airflow.hooks.postgres_hook import PostgresHook
+import re
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
-class LoadDimensionOperator(BaseOperator):
+from helpers import InstrumentedOperatorMixin, execution_window
+
+class LoadDimensionOperator(InstrumentedOperatorMixin, BaseOperator):
     '''
     Description :
-    - Truncate Dimension tables using truncate_sql
-    - Insert data into tables using insert_sql
+    - load_mode chooses how the dimension table is loaded from sql_query
+        - truncate : Truncate Dimension tables using truncate_sql, then insert data using insert_sql
+        - append : insert data using insert_sql only
+        - swap : build the table in a shadow table and rename it in place of the live table in one
+          transaction, readers never see an empty dimension. The shadow is created from table_ddl,
+          the CREATE TABLE statement of the table (see helpers.table_ddl), so it keeps the encodings,
+          distribution and primary key, and grants are run on the swapped table, since both go with
+          the dropped table
+        - upsert : stage the rows in a temp table, drop the staged rows equal to their live row, delete
+          the live rows of the remaining keys and insert the staged rows in one transaction, needs
+          primary_key and a sql_query returning one row per key
+    - load_mode defaults to truncate or append following truncate_data
+    - With window_column set in append mode, only the rows of sql_query whose window_column falls inside
+      the DAG run's interval are inserted, e.g. the new start_time values of the time dimension
+    - Duration and rows of every statement are pushed to XCom and StatsD, explain_inserts also logs
+      the plan of the inserts
+    - All statements run on one connection and commit once, query_group and wlm_slot_count are set
+      on that session
     '''
+    load_modes = ('truncate', 'append', 'swap', 'upsert')
     truncate_sql = """
     TRUNCATE TABLE {};
     """
     insert_sql = """
     INSERT INTO {} {};
     """
+    insert_window_sql = """
+    INSERT INTO {table}
+    SELECT * FROM ({sql_query}) window_rows
+    WHERE window_rows.{column} >= '{start}' AND window_rows.{column} < '{end}';
+    """
+    swap_sql = [
+        "DROP TABLE IF EXISTS {table}_shadow;",
+        "{create_shadow}",
+        "INSERT INTO {table}_shadow {sql_query};",
+        "ALTER TABLE {table} RENAME TO {table}_old;",
+        "ALTER TABLE {table}_shadow RENAME TO {table};",
+        "DROP TABLE {table}_old;",
+    ]
+    upsert_sql = [
+        "CREATE TEMP TABLE {table}_stage (LIKE {table});",
+        "INSERT INTO {table}_stage {sql_query};",
+        # set operations compare NULLs as equal, the keys whose row is unchanged are left alone
+        """DELETE FROM {table}_stage WHERE {primary_key} IN (
+            SELECT {primary_key} FROM (SELECT * FROM {table}_stage INTERSECT SELECT * FROM {table}) unchanged);""",
+        "DELETE FROM {table} USING {table}_stage WHERE {table}.{primary_key} = {table}_stage.{primary_key};",
+        "INSERT INTO {table} SELECT * FROM {table}_stage;",
+        "DROP TABLE {table}_stage;",
+    ]
     ui_color = '#80BD9E'
 
     @apply_defaults
@@ -22,6 +65,14 @@ class LoadDimensionOperator(BaseOperator):
                  table = "",
                  truncate_data = True,
                  sql_query = "",
+                 load_mode = None,
+                 primary_key = None,
+                 table_ddl = None,
+                 grants = None,
+                 window_column = None,
+                 explain_inserts = False,
+                 query_group = None,
+                 wlm_slot_count = None,
                  *args, **kwargs):
 
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
@@ -29,16 +80,60 @@ class LoadDimensionOperator(BaseOperator):
         self.table = table
         self.truncate_data = truncate_data
         self.sql_query = sql_query
+        self.load_mode = load_mode or ('truncate' if truncate_data else 'append')
+        self.primary_key = primary_key
+        self.table_ddl = table_ddl
+        self.grants = grants or []
+        self.window_column = window_column
+        self.explain_inserts = explain_inserts
+        self.query_group = query_group
+        self.wlm_slot_count = wlm_slot_count
+
+        if self.load_mode not in LoadDimensionOperator.load_modes:
+            raise ValueError(f"Unknown load_mode '{self.load_mode}' for {self.table}")
+        if self.load_mode == 'upsert' and not self.primary_key:
+            raise ValueError(f"load_mode 'upsert' for {self.table} needs a primary_key")
+        if self.load_mode == 'swap' and not self.table_ddl:
+            raise ValueError(f"load_mode 'swap' for {self.table} needs the table_ddl to create the shadow from")
+        if self.window_column and self.load_mode != 'append':
+            raise ValueError(f"window_column of {self.table} needs load_mode 'append'")
+
+    def shadow_ddl(self):
+        '''
+        Renames the table of table_ddl to its shadow, the primary key constraint loses its name so that
+        the database names it and it cannot clash with the constraint of the live table.
+        '''
+        ddl = re.sub(r'^(CREATE TABLE (IF NOT EXISTS )?(\w+\.)?)"?{}"? \('.format(re.escape(self.table)),
+                     r'\g<1>{}_shadow ('.format(self.table), self.table_ddl.strip())
+        return re.sub(r'CONSTRAINT \w+ PRIMARY KEY', 'PRIMARY KEY', ddl)
+
+    def load_statements(self, context):
+        if self.load_mode == 'swap':
+            statements = [sql.format(table=self.table, sql_query=self.sql_query, create_shadow=self.shadow_ddl())
+                          for sql in LoadDimensionOperator.swap_sql]
+            return statements + [grant.format(table=self.table) for grant in self.grants]
+        if self.load_mode == 'upsert':
+            return [sql.format(table=self.table, sql_query=self.sql_query, primary_key=self.primary_key)
+                    for sql in LoadDimensionOperator.upsert_sql]
+
+        if self.window_column:
+            start, end = execution_window(context)
+            self.log.info(f"Loading window {start} - {end} of {self.table}")
+            return [LoadDimensionOperator.insert_window_sql.format(
+                table=self.table, sql_query=self.sql_query, column=self.window_column, start=start, end=end)]
+
+        statements = []
+        if self.load_mode == 'truncate':
+            statements.append(LoadDimensionOperator.truncate_sql.format(self.table))
+        statements.append(LoadDimensionOperator.insert_sql.format(self.table, self.sql_query))
+        return statements
 
     def execute(self, context):
         self.log.info(f" Start LoadDimensionOperator on {self.table} \
-                      truncating table: {self.truncate_data}.")
-        redshift_hook = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        
-        if self.truncate_data:
-            redshift_hook.run(LoadDimensionOperator.truncate_sql.format(self.table))
-            
+                      load mode: {self.load_mode}.")
         self.log.info(f'Start Loading data into {self.table} dimension table')
-        redshift_hook.run(LoadDimensionOperator.insert_sql.format(self.table, self.sql_query))
-        
+        with self.redshift_session() as session:
+            self.run_statements(session, self.load_statements(context))
+        self.push_sql_metrics(context)
+
         self.log.info(f"Loading Complete Dimension table '{self.table}' into Redshift")
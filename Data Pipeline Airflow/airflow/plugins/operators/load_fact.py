@@ -1,16 +1,36 @@
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
-class LoadFactOperator(BaseOperator):
+from helpers import InstrumentedOperatorMixin, execution_window
+
+class LoadFactOperator(InstrumentedOperatorMixin, BaseOperator):
     '''
     Description:
-    - Data will be loaded into Fact table in append mode
+    - Data will be loaded into Fact table in append mode, append_data=False truncates the table first
+    - With window_column set, only the rows of sql_query whose window_column falls inside the DAG run's
+      interval are loaded. The rows of that interval are deleted first, in the same transaction,
+      so retries and backfills replace their window instead of duplicating it
+    - Duration and rows of every statement are pushed to XCom and StatsD, explain_inserts also logs
+      the plan of the insert
+    - All statements run on one connection and commit once, query_group and wlm_slot_count are set
+      on that session
 
     '''
+    truncate_sql = """
+    TRUNCATE TABLE {};
+    """
     insert_sql = """
     INSERT INTO {} {};
     """
+    delete_window_sql = """
+    DELETE FROM {table}
+    WHERE {column} >= '{start}' AND {column} < '{end}';
+    """
+    insert_window_sql = """
+    INSERT INTO {table}
+    SELECT * FROM ({sql_query}) window_rows
+    WHERE window_rows.{column} >= '{start}' AND window_rows.{column} < '{end}';
+    """
     ui_color = '#F98866'
 
     @apply_defaults
@@ -19,6 +39,10 @@ class LoadFactOperator(BaseOperator):
                  table = "",
                  append_data = True,
                  sql_query = "",
+                 window_column = None,
+                 explain_inserts = False,
+                 query_group = None,
+                 wlm_slot_count = None,
                  *args, **kwargs):
         
         super(LoadFactOperator, self).__init__(*args, **kwargs)
@@ -26,11 +50,30 @@ class LoadFactOperator(BaseOperator):
         self.table = table
         self.append_data = append_data
         self.sql_query = sql_query
+        self.window_column = window_column
+        self.explain_inserts = explain_inserts
+        self.query_group = query_group
+        self.wlm_slot_count = wlm_slot_count
+
+    def load_statements(self, context):
+        if self.window_column:
+            start, end = execution_window(context)
+            self.log.info(f"Loading window {start} - {end} of {self.table}")
+            params = dict(table=self.table, sql_query=self.sql_query, column=self.window_column,
+                          start=start, end=end)
+            return [LoadFactOperator.delete_window_sql.format(**params),
+                    LoadFactOperator.insert_window_sql.format(**params)]
+
+        statements = []
+        if not self.append_data:
+            statements.append(LoadFactOperator.truncate_sql.format(self.table))
+        statements.append(LoadFactOperator.insert_sql.format(self.table, self.sql_query))
+        return statements
         
     def execute(self, context):
-        self.log.info(f"Start LoadFactorOperator on {self.table}.{self.append_data}. appending data")
-        redshift_hook = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        
-        redshift_hook.run(LoadFactOperator.insert_sql.format(self.table, self.sql_query))
+        self.log.info(f"Start LoadFactorOperator on {self.table}. appending data: {self.append_data}")
+        with self.redshift_session() as session:
+            self.run_statements(session, self.load_statements(context))
+        self.push_sql_metrics(context)
                               
-        self.log.info(f"Finished Loading fact table '{self.table}' into Redshift")
\ No newline at end of file
+        self.log.info(f"Finished Loading fact table '{self.table}' into Redshift")
@@ -1,11 +1,45 @@
-from airflow.hooks.postgres_hook import PostgresHook
+import json
+from datetime import datetime
+
+from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 from airflow.contrib.hooks.aws_hook import AwsHook
 
-class StageToRedshiftOperator(BaseOperator):
+from helpers import InstrumentedOperatorMixin
+
+class StageToRedshiftOperator(InstrumentedOperatorMixin, BaseOperator):
+    '''
+    Description:
+    - Copies the S3 objects under s3_key into a Redshift staging table
+    - s3_key is templated, e.g. log_data/{{ execution_date.strftime("%Y/%m") }}/{{ ds }}-events.json,
+      so every run stages the slice of its execution date
+    - In incremental mode only objects not yet recorded in stage_loads are copied and recorded
+      in the same transaction, the COPY is skipped when there is no new object. The COPY reads a manifest
+      of exactly the listed objects, so objects arriving after the listing are left to the next run
+    - Objects are recorded with their ETag. An object rewritten under the same key since it was loaded, e.g. a
+      Parquet slice converted again by JsonToParquetOperator, fails the task: the staging tables do not record
+      the object a row came from, so the rows of the earlier version cannot be replaced and copying the new
+      version would duplicate them. Clear the table and its stage_loads rows to load the rewritten objects
+    - use_truncate clears the table with TRUNCATE instead of DELETE, which leaves no dead rows behind.
+      TRUNCATE commits on Redshift, so it runs ahead of the COPY transaction, after the object listing
+      and the slices lookup of use_manifest
+    - truncate cannot be combined with incremental, the objects recorded in stage_loads would not be copied back
+    - use_manifest copies from a generated COPY manifest listing the objects largest first with their sizes,
+      and logs how evenly they spread over the cluster slices
+    - Manifests are written to manifest_bucket under manifest_prefix, s3_bucket by default, the source
+      bucket may be read only
+    - compression, compupdate and statupdate add the matching COPY options
+    - data_format='PARQUET' copies the columnar files written by JsonToParquetOperator with FORMAT AS PARQUET,
+      compression is ignored as Parquet files are compressed internally
+    - log_load_stats logs rows and files per COPY from pg_last_copy_count and stl_load_commits
+    - Lookups, DELETE, COPY and the stage_loads records run on one connection and commit once,
+      query_group and wlm_slot_count are set on that session
+    - Duration and rows of every statement are pushed to XCom and StatsD, COPY rows are taken
+      from pg_last_copy_count when log_load_stats is set
+    '''
     ui_color = '#358140'
-    templated_fields = ("s3_key", )
+    template_fields = ("s3_key", )
     copy_sql = """
         COPY {}
         FROM '{}'
@@ -13,6 +47,25 @@ class StageToRedshiftOperator(BaseOperator):
         SECRET_ACCESS_KEY '{}'
         {} REGION '{}';
     """
+    loaded_paths_sql = """
+        SELECT s3_path, etag FROM stage_loads WHERE table_name = %s AND s3_path LIKE %s
+    """
+    record_load_sql = """
+        INSERT INTO stage_loads (table_name, s3_path, loaded_at, etag) VALUES {};
+    """
+    # stage_loads rows per INSERT, the values are bound parameters
+    record_batch_size = 500
+    slices_sql = """
+        SELECT COUNT(*) FROM stv_slices
+    """
+    last_copy_sql = """
+        SELECT pg_last_copy_id(), pg_last_copy_count()
+    """
+    load_commits_sql = """
+        SELECT COUNT(*), SUM(lines_scanned), MIN(curtime), MAX(curtime)
+        FROM stl_load_commits
+        WHERE query = %s
+    """
 
     @apply_defaults
     def __init__(self,
@@ -24,6 +77,18 @@ class StageToRedshiftOperator(BaseOperator):
                  region='',
                  truncate=False,
                  data_format='',
+                 incremental=False,
+                 use_truncate=False,
+                 use_manifest=False,
+                 manifest_prefix='manifests',
+                 manifest_bucket=None,
+                 slices=None,
+                 compression=None,
+                 compupdate=None,
+                 statupdate=None,
+                 log_load_stats=True,
+                 query_group=None,
+                 wlm_slot_count=None,
                  *args, **kwargs):
 
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
@@ -35,33 +100,163 @@ class StageToRedshiftOperator(BaseOperator):
         self.region = region
         self.truncate = truncate
         self.data_format = data_format
-        
+        self.incremental = incremental
+        self.use_truncate = use_truncate
+        self.use_manifest = use_manifest
+        self.manifest_prefix = manifest_prefix
+        self.manifest_bucket = manifest_bucket
+        self.slices = slices
+        self.compression = compression
+        self.compupdate = compupdate
+        self.statupdate = statupdate
+        self.log_load_stats = log_load_stats
+        self.query_group = query_group
+        self.wlm_slot_count = wlm_slot_count
 
-    def execute(self, context):
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        
-        if self.truncate:
-            self.log.info(f'Delete Redshift table {self.table} data')
-            redshift.run(f'DELETE FROM {self.table}')
-        
-        self.log.info('Copying data from s3 to the redshift cluster')
-        rendered_key = self.s3_key.format(**context)
-        s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
-        
-        formatted_stage_sql = StageToRedshiftOperator.copy_sql.format(
+        if self.truncate and self.incremental:
+            raise ValueError(f'{self.table} cannot be staged with both truncate and incremental, the objects already '
+                             'recorded in stage_loads would not be copied back after the table is cleared')
+
+    def copy_options(self, manifest=False):
+        if self.data_format.upper() == 'PARQUET':
+            # Parquet is compressed per column chunk and mapped to the table columns by position
+            options = ['FORMAT AS PARQUET']
+        else:
+            options = [self.data_format]
+            if self.compression:
+                options.append(self.compression.upper())
+        if manifest:
+            options.append('MANIFEST')
+        if self.compupdate is not None:
+            options.append('COMPUPDATE {}'.format('ON' if self.compupdate else 'OFF'))
+        if self.statupdate is not None:
+            options.append('STATUPDATE {}'.format('ON' if self.statupdate else 'OFF'))
+        return ' '.join(option for option in options if option)
+
+    def build_copy_sql(self, s3_path, credentials, manifest=False):
+        return StageToRedshiftOperator.copy_sql.format(
             self.table,
             s3_path,
             credentials.access_key,
             credentials.secret_key,
-            self.data_format,
+            self.copy_options(manifest),
             self.region
         )
-        self.log.info(f'Copy data from {s3_path} to Redshift table {self.table}')
-        redshift.run(formatted_stage_sql)
 
+    def list_objects(self, s3):
+        '''
+        Lists key, size and ETag of the objects under the rendered s3_key.
+        '''
+        paginator = s3.get_conn().get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=self.s3_key):
+            objects.extend((item['Key'], item['Size'], item['ETag'].strip('"')) for item in page.get('Contents', [])
+                           if not item['Key'].endswith('/'))
+        return objects
+
+    def new_objects(self, redshift, objects):
+        '''
+        Drops the objects already loaded into the table according to stage_loads, an object counts as loaded
+        when its path was recorded with its current ETag, or without an ETag by an earlier version of the operator.
+        Raises ValueError for objects recorded with another ETag, they were rewritten since they were loaded.
+        Returns the new objects.
+        '''
+        prefix = "s3://{}/{}".format(self.s3_bucket, self.s3_key)
+        loaded = {}
+        for path, etag in redshift.get_records(StageToRedshiftOperator.loaded_paths_sql,
+                                               parameters=(self.table, prefix + '%')):
+            loaded.setdefault(path, set()).add(etag)
+        new, rewritten = [], []
+        for key, size, etag in objects:
+            path = "s3://{}/{}".format(self.s3_bucket, key)
+            if path not in loaded:
+                new.append((key, size, etag))
+            elif etag not in loaded[path] and None not in loaded[path]:
+                rewritten.append(path)
+        if rewritten:
+            raise ValueError(f'{len(rewritten)} objects under {prefix} were rewritten after they were loaded into '
+                             f'{self.table}, e.g. {rewritten[0]}. Copying them again would duplicate the rows of '
+                             f'their earlier version, clear {self.table} and its stage_loads rows to reload them')
+        return new
+
+    def build_manifest(self, objects, slices):
+        '''
+        Builds the COPY manifest, largest objects first so the slices picking up the next file as they
+        finish end up with similar byte counts. Logs the expected bytes per slice of that assignment.
+        '''
+        objects = sorted(objects, key=lambda item: item[1], reverse=True)
+        slice_bytes = [0] * max(slices, 1)
+        for key, size, etag in objects:
+            slice_bytes[slice_bytes.index(min(slice_bytes))] += size
+        mean = sum(slice_bytes) / len(slice_bytes)
+        self.log.info(f'{len(objects)} files over {slices} slices, '
+                      f'max/mean bytes per slice {max(slice_bytes) / mean if mean else 0:.2f}')
+        if len(objects) % max(slices, 1):
+            self.log.warning(f'{len(objects)} files is not a multiple of {slices} slices, '
+                             'split the input into a multiple of the slice count to keep every slice busy')
+        return {'entries': [{'url': "s3://{}/{}".format(self.s3_bucket, key),
+                             'mandatory': True,
+                             'meta': {'content_length': size}} for key, size, etag in objects]}
+
+    def execute(self, context):
+        aws_hook = AwsHook(self.aws_credentials_id)
+        credentials = aws_hook.get_credentials()
+
+        with self.redshift_session() as session:
+            self.stage(context, session, credentials)
+        self.push_sql_metrics(context)
+
+    def stage(self, context, session, credentials):
+        s3_path = "s3://{}/{}".format(self.s3_bucket, self.s3_key)
+        copy_path, loaded_paths = s3_path, []
+        manifest = self.incremental or self.use_manifest
+        if manifest:
+            s3 = S3Hook(aws_conn_id=self.aws_credentials_id)
+            objects = self.list_objects(s3)
+            if self.incremental:
+                objects = self.new_objects(session, objects)
+                loaded_paths = [("s3://{}/{}".format(self.s3_bucket, key), etag) for key, size, etag in objects]
+            if not objects:
+                self.log.info(f'No new objects under {s3_path}, skipping COPY into {self.table}')
+                return
+            self.log.info(f'{len(objects)} objects to copy under {s3_path}')
 
+            slices = self.slices or session.get_first(StageToRedshiftOperator.slices_sql)[0]
+            manifest_bucket = self.manifest_bucket or self.s3_bucket
+            manifest_key = '{}/{}/{}.manifest'.format(self.manifest_prefix, self.table, context['ts_nodash'])
+            s3.load_string(json.dumps(self.build_manifest(objects, slices)), manifest_key,
+                           bucket_name=manifest_bucket, replace=True)
+            copy_path = "s3://{}/{}".format(manifest_bucket, manifest_key)
 
+        cursor = session.cursor
+        if self.truncate and self.use_truncate:
+            self.log.info(f'Truncate Redshift table {self.table}')
+            self.execute_sql(cursor, f'TRUNCATE TABLE {self.table}')
+        elif self.truncate:
+            self.log.info(f'Delete Redshift table {self.table} data')
+            self.execute_sql(cursor, f'DELETE FROM {self.table}')
+
+        self.log.info('Copying data from s3 to the redshift cluster')
+        copy_ids = []
+        self.log.info(f'Copy data from {copy_path} to Redshift table {self.table}')
+        copy = self.execute_sql(cursor, self.build_copy_sql(copy_path, credentials, manifest=manifest))
+        if self.log_load_stats:
+            copy_id, copy_count = session.get_first(StageToRedshiftOperator.last_copy_sql)
+            copy_ids.append(copy_id)
+            copy['rows'] = copy_count
+            self.log.info(f'COPY {copy_id} loaded {copy_count} rows into {self.table}')
 
+        loaded_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        batch_size = StageToRedshiftOperator.record_batch_size
+        for start in range(0, len(loaded_paths), batch_size):
+            paths = loaded_paths[start:start + batch_size]
+            sql = StageToRedshiftOperator.record_load_sql.format(', '.join(['(%s, %s, %s, %s)'] * len(paths)))
+            parameters = [value for path, etag in paths for value in (self.table, path, loaded_at, etag)]
+            self.execute_sql(cursor, sql, parameters, label='record_load')
+        session.commit()
 
+        for copy_id in copy_ids:
+            files, lines, first_commit, last_commit = session.get_first(StageToRedshiftOperator.load_commits_sql,
+                                                                        (copy_id,))
+            self.log.info(f'COPY {copy_id}: {files} files, {lines} lines scanned, '
+                          f'committed between {first_commit} and {last_commit}')
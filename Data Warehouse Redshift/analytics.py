@@ -0,0 +1,200 @@
+from datetime import timedelta
+
+# Pre-joined, pre-aggregated tables over the star schema, one row per day and group.
+# After insert_tables only the days of the staged events are recomputed from songplays, see refresh_aggregates.
+# The SQL only uses what redshift and postgres share, so it runs against a local postgres stand-in too.
+
+# first and last day of the NextSong events in the staging table, the window loaded by insert_tables
+staged_window_select = ("""
+    SELECT MIN(CAST(timestamp 'epoch' + ts/1000 * interval '1 second' AS DATE)),
+           MAX(CAST(timestamp 'epoch' + ts/1000 * interval '1 second' AS DATE))
+    FROM stg_events
+    WHERE page='NextSong'
+""")
+
+AGGREGATES = {
+    'agg_song_plays_daily': ("""
+    INSERT INTO agg_song_plays_daily(day, song_id, artist_id, title, artist_name, plays)
+    SELECT CAST(sp.start_time AS DATE) AS day,
+           sp.song_id,
+           sp.artist_id,
+           s.title,
+           a.name                      AS artist_name,
+           COUNT(*)                    AS plays
+    FROM songplays sp
+    JOIN (SELECT song_id, MAX(title) AS title FROM songs GROUP BY song_id) s
+    ON s.song_id = sp.song_id
+    LEFT JOIN (SELECT artist_id, MAX(name) AS name FROM artists GROUP BY artist_id) a
+    ON a.artist_id = sp.artist_id
+    WHERE sp.start_time >= %(start)s AND sp.start_time < %(end)s
+    GROUP BY 1, 2, 3, 4, 5
+"""),
+    'agg_hourly_plays': ("""
+    INSERT INTO agg_hourly_plays(day, hour, level, plays, users)
+    SELECT CAST(start_time AS DATE)           AS day,
+           EXTRACT(HOUR FROM start_time)      AS hour,
+           level,
+           COUNT(*)                           AS plays,
+           COUNT(DISTINCT user_id)            AS users
+    FROM songplays
+    WHERE start_time >= %(start)s AND start_time < %(end)s
+    GROUP BY 1, 2, 3
+"""),
+    'agg_level_daily': ("""
+    INSERT INTO agg_level_daily(day, level, plays, sessions, users)
+    SELECT CAST(start_time AS DATE)           AS day,
+           level,
+           COUNT(*)                           AS plays,
+           COUNT(DISTINCT session_id)         AS sessions,
+           COUNT(DISTINCT user_id)            AS users
+    FROM songplays
+    WHERE start_time >= %(start)s AND start_time < %(end)s
+    GROUP BY 1, 2
+"""),
+}
+
+aggregate_delete = "DELETE FROM {} WHERE day >= %(start)s AND day < %(end)s"
+
+# question : (query over the aggregates, same question over the star schema)
+QUESTIONS = {
+    'top_songs': ("""
+    SELECT title, artist_name, SUM(plays) AS plays
+    FROM agg_song_plays_daily
+    WHERE day >= %(start)s AND day < %(end)s
+    GROUP BY song_id, title, artist_name
+    ORDER BY plays DESC, title
+    LIMIT %(limit)s
+""", """
+    SELECT s.title, a.name AS artist_name, COUNT(*) AS plays
+    FROM songplays sp
+    JOIN (SELECT song_id, MAX(title) AS title FROM songs GROUP BY song_id) s
+    ON s.song_id = sp.song_id
+    LEFT JOIN (SELECT artist_id, MAX(name) AS name FROM artists GROUP BY artist_id) a
+    ON a.artist_id = sp.artist_id
+    WHERE sp.start_time >= %(start)s AND sp.start_time < %(end)s
+    GROUP BY sp.song_id, s.title, a.name
+    ORDER BY plays DESC, s.title
+    LIMIT %(limit)s
+"""),
+    'plays_per_hour': ("""
+    SELECT hour, SUM(plays) AS plays
+    FROM agg_hourly_plays
+    WHERE day >= %(start)s AND day < %(end)s
+    GROUP BY hour
+    ORDER BY hour
+""", """
+    SELECT EXTRACT(HOUR FROM start_time) AS hour, COUNT(*) AS plays
+    FROM songplays
+    WHERE start_time >= %(start)s AND start_time < %(end)s
+    GROUP BY 1
+    ORDER BY 1
+"""),
+    'level_usage': ("""
+    SELECT level, SUM(plays) AS plays
+    FROM agg_level_daily
+    WHERE day >= %(start)s AND day < %(end)s
+    GROUP BY level
+    ORDER BY level
+""", """
+    SELECT level, COUNT(*) AS plays
+    FROM songplays
+    WHERE start_time >= %(start)s AND start_time < %(end)s
+    GROUP BY level
+    ORDER BY level
+"""),
+    # distinct users do not add up over days, so the aggregates answer them per single day only
+    'daily_users': ("""
+    SELECT level, users, sessions
+    FROM agg_level_daily
+    WHERE day = %(start)s
+    ORDER BY level
+""", """
+    SELECT level, COUNT(DISTINCT user_id) AS users, COUNT(DISTINCT session_id) AS sessions
+    FROM songplays
+    WHERE start_time >= %(start)s AND start_time < %(end)s
+    GROUP BY level
+    ORDER BY level
+"""),
+}
+
+
+def day_window(start_day, end_day):
+    """
+    - parameters of the inclusive day range start_day .. end_day, as a half open [start, end) range
+    """
+    return {'start': start_day, 'end': end_day + timedelta(days=1)}
+
+
+def refresh_statements(start_day, end_day):
+    """
+    - DELETE and INSERT statements recomputing the aggregate rows of the days start_day .. end_day
+    - returns : list of (sql, parameters)
+    """
+    window = day_window(start_day, end_day)
+    statements = []
+    for table, insert in AGGREGATES.items():
+        statements.append((aggregate_delete.format(table), window))
+        statements.append((insert, window))
+    return statements
+
+
+def refresh_aggregates(cur, conn):
+    """
+    - Refreshes the aggregates for the days of the events in the staging table, once insert_tables loaded them
+    - Every day of the window is recomputed from songplays in one transaction, readers see the old or the new rows
+    - arguments : cur, conn
+                - python cursor object to connect to database and execute queries
+                - conn provides the connection to the database
+    - returns : the refreshed (first day, last day), None when nothing was staged
+    """
+    cur.execute(staged_window_select)
+    start_day, end_day = cur.fetchone()
+    if start_day is None:
+        return None
+    for sql, parameters in refresh_statements(start_day, end_day):
+        cur.execute(sql, parameters)
+    conn.commit()
+    return start_day, end_day
+
+
+def route(question, start_day, end_day=None, limit=10, use_aggregates=True):
+    """
+    - Routes an analytics question over an inclusive day range to the aggregates, or to the star schema
+      with use_aggregates=False
+    - daily_users is answered from the aggregates for single days only and falls back to the star schema otherwise
+    - returns : (sql, parameters)
+    """
+    if question not in QUESTIONS:
+        raise ValueError('Unsupported question {}, supported are {}'.format(question, ', '.join(QUESTIONS)))
+    end_day = end_day or start_day
+    aggregate_sql, base_sql = QUESTIONS[question]
+    if question == 'daily_users' and end_day != start_day:
+        use_aggregates = False
+    parameters = dict(day_window(start_day, end_day), limit=limit)
+    return (aggregate_sql if use_aggregates else base_sql), parameters
+
+
+def answer(cur, question, start_day, end_day=None, limit=10, use_aggregates=True):
+    """
+    - Answers an analytics question, see route
+    - returns : list of result rows
+    """
+    sql, parameters = route(question, start_day, end_day, limit, use_aggregates)
+    cur.execute(sql, parameters)
+    return cur.fetchall()
+
+
+def verify(cur, start_day, end_day, limit=10):
+    """
+    - Answers every question from the aggregates and from the star schema and compares the results
+    - returns : list of the questions whose answers differ
+    """
+    mismatches = []
+    for question in QUESTIONS:
+        end = start_day if question == 'daily_users' else end_day
+        expected = [tuple(row) for row in answer(cur, question, start_day, end, limit, use_aggregates=False)]
+        actual = [tuple(row) for row in answer(cur, question, start_day, end, limit)]
+        if [tuple(str(value) for value in row) for row in expected] != \
+                [tuple(str(value) for value in row) for row in actual]:
+            mismatches.append(question)
+    return mismatches
@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import sys
+
+import psycopg2
+
+from analytics import QUESTIONS, answer, refresh_aggregates, verify
+from sql_queries import artist_table_insert, song_table_insert, songplay_table_insert, user_table_insert
+from table_definitions import WAREHOUSE_TABLES, create_table_sql, quote
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data Lake', 'data')
+
+
+def json_records(path):
+    for root, dirs, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            if name.endswith('.json'):
+                with open(os.path.join(root, name)) as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+
+
+def stage(cur, table, records, definitions=WAREHOUSE_TABLES):
+    """
+    - Inserts JSON records into a staging table, matching the fields to the columns case insensitively like
+      COPY ... JSON 'auto' does, empty strings of numeric columns become NULL
+    - definitions : registry of the table, WAREHOUSE_TABLES or AIRFLOW_TABLES
+    """
+    columns = [c for c in definitions[table]['columns'] if not c['identity']]
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(quote(c['name']) for c in columns),
+                                                   ', '.join(['%s'] * len(columns)))
+    for record in records:
+        fields = {key.lower(): value for key, value in record.items()}
+        values = []
+        for c in columns:
+            value = fields.get(c['name'].lower())
+            if value == '' and not c['type'].startswith('varchar'):
+                value = None
+            values.append(value)
+        cur.execute(sql, values)
+
+
+def main(argv=None):
+    """
+    - Checks the aggregate refresh and the question routing of analytics.py against a local postgres stand-in :
+        - creates the warehouse tables with the postgres dialect in the given database, dropping them first
+        - stages the sample song and log data of the Data Lake project and loads the star schema
+          (time is left out, its insert relies on redshift's lateral column aliases)
+        - refreshes the aggregates and compares every question answered from them and from the star schema
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default='host=127.0.0.1 dbname=studentdb user=student password=student')
+    parser.add_argument('--data', default=SAMPLE_DATA)
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    for name, definition in WAREHOUSE_TABLES.items():
+        cur.execute('DROP TABLE IF EXISTS {}'.format(quote(name)))
+        cur.execute(create_table_sql(name, definition, dialect='postgres'))
+    stage(cur, 'stg_songs', json_records(os.path.join(args.data, 'song_data')))
+    stage(cur, 'stg_events', json_records(os.path.join(args.data, 'log_data')))
+    for query in (songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert):
+        cur.execute(query)
+    conn.commit()
+
+    window = refresh_aggregates(cur, conn)
+    print('refreshed aggregates for {}'.format(window))
+    if window is None:
+        sys.exit(1)
+    for question in QUESTIONS:
+        print('{}: {}'.format(question, answer(cur, question, *window)))
+
+    # a second refresh of the same window must leave the aggregates unchanged
+    refresh_aggregates(cur, conn)
+    mismatches = verify(cur, *window)
+    conn.close()
+    for question in mismatches:
+        print('{} differs between the aggregates and the star schema'.format(question))
+    print('analytics {}'.format('FAILED' if mismatches else 'OK'))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
-import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+
+from sql_queries import connection_string, create_table_queries, drop_table_queries, read_config
 
 
 def drop_tables(cur, conn):
@@ -27,16 +27,28 @@ def create_tables(cur, conn):
         conn.commit()
 
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Drop and create the staging, star schema and aggregate tables')
+    parser.add_argument('--config', default='dwh.cfg', help='path of the config file')
+    parser.add_argument('--dry-run', action='store_true', help='print the statements without connecting')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """
     - To call config files for credential authorization and database connection 
     - To call drop_tables and create_tables fucntions to drop and create tables in redshift cluster database.
+    - With --dry-run the statements are printed instead, without reading the config or connecting
     
     """
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    args = parse_args(argv)
+    if args.dry_run:
+        for query in drop_table_queries + create_table_queries:
+            print(query.strip().rstrip(';') + ';\n')
+        return
+
+    import psycopg2
+    conn = psycopg2.connect(connection_string(read_config(args.config)))
     cur = conn.cursor()
 
     drop_tables(cur, conn)
@@ -1,17 +1,19 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import argparse
 
+from analytics import AGGREGATES, aggregate_delete, refresh_aggregates, staged_window_select
+from sql_queries import connection_string, copy_table_queries, insert_table_queries, read_config
 
-def load_staging_tables(cur, conn):
+
+def load_staging_tables(cur, conn, config):
     """
     - Extract data from AWS S3 buckets
     - Load into staging tables using COPY command
-    - arguments : cur, conn 
+    - arguments : cur, conn, config
                 - python cursor object to connect to database and execute queries
                 - conn provides the connection to the database
+                - config returned by read_config, holding the S3 paths and the IAM role
     """
-    for query in copy_table_queries:
+    for query in copy_table_queries(config):
         cur.execute(query)
         conn.commit()
 
@@ -28,20 +30,46 @@ def insert_tables(cur, conn):
         conn.commit()
 
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load the staging tables from S3 and the star schema from them')
+    parser.add_argument('--config', default='dwh.cfg', help='path of the config file')
+    parser.add_argument('--dry-run', action='store_true', help='print the statements without connecting')
+    return parser.parse_args(argv)
+
+
+def print_statements(config):
+    """
+    - Prints the COPY, INSERT and aggregate refresh statements a run executes, the refresh window
+      is only known once the events are staged and is left as placeholders
+    """
+    for query in copy_table_queries(config) + insert_table_queries + [staged_window_select]:
+        print(query.strip().rstrip(';') + ';\n')
+    for table, insert in AGGREGATES.items():
+        print(aggregate_delete.format(table) + ';\n')
+        print(insert.strip().rstrip(';') + ';\n')
+
+
+def main(argv=None):
     """
     - To call config files for credential authorization and database connection 
     - To call load_staging_tables and insert_tables fucntions to load into stage and target tables in redshift cluster database.
+    - To refresh the aggregate tables of analytics.py for the days of the newly loaded events.
+    - With --dry-run the statements are printed instead, the config is read for the COPY paths but nothing connects
     
     """
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    args = parse_args(argv)
+    config = read_config(args.config)
+    if args.dry_run:
+        print_statements(config)
+        return
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    import psycopg2
+    conn = psycopg2.connect(connection_string(config))
     cur = conn.cursor()
     
-    load_staging_tables(cur, conn)
+    load_staging_tables(cur, conn, config)
     insert_tables(cur, conn)
+    refresh_aggregates(cur, conn)
 
     conn.close()
 
@@ -1,20 +1,29 @@
 import configparser
 
+from table_definitions import WAREHOUSE_TABLES, create_table_sql
+
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
-HOST= config.get("CLUSTER","HOST")
-DB_NAME=config.get("CLUSTER","DB_NAME")
-DB_USER= config.get("CLUSTER","DB_USER")
-DB_PASSWORD= config.get("CLUSTER","DB_PASSWORD")
-DB_PORT = config.get("CLUSTER","DB_PORT")
 
-ARN=config.get("IAM_ROLE","ARN")
+def read_config(path='dwh.cfg'):
+    """
+    - Reads the cluster, IAM role and S3 settings, only when a command needs them
+    - returns : ConfigParser
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError("Config file {} not found".format(path))
+    return config
+
+
+def connection_string(config):
+    """
+    - psycopg2 connection string of the cluster in the CLUSTER section of the config
+    """
+    cluster = config['CLUSTER']
+    return "host={} dbname={} user={} password={} port={}".format(
+        cluster['HOST'], cluster['DB_NAME'], cluster['DB_USER'], cluster['DB_PASSWORD'], cluster['DB_PORT'])
 
-LOG_DATA=config.get("S3","LOG_DATA")
-LOG_JSONPATH=config.get("S3","LOG_JSONPATH")
-SONG_DATA=config.get("S3","SONG_DATA")
 
 # DROP TABLES
 
@@ -25,127 +34,41 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+song_plays_daily_table_drop = "DROP TABLE IF EXISTS agg_song_plays_daily"
+hourly_plays_table_drop = "DROP TABLE IF EXISTS agg_hourly_plays"
+level_daily_table_drop = "DROP TABLE IF EXISTS agg_level_daily"
 
 # CREATE TABLES
 
-staging_events_table_create= ("""
-CREATE TABLE IF NOT EXISTS stg_events(
-                    stg_event_id      int IDENTITY(1,1) NOT NULL,
-                    artist            varchar,
-                    auth              varchar(40),
-                    firstName         varchar(40),
-                    gender            varchar(20),
-                    itemInSession     int,
-                    lastName          varchar(40),
-                    length            double precision,
-                    level             varchar(20),
-                    location          varchar(100),
-                    method            varchar,
-                    page              varchar,
-                    registration      double precision,
-                    sessionid         int,
-                    song              varchar(200),
-                    status            int,
-                    ts                bigint,
-                    useragent         varchar(200),
-                    userid            int,
-                    primary     key(stg_event_id))
-
-""")
-
-staging_songs_table_create = ("""
-CREATE TABLE IF NOT EXISTS stg_songs(
-                     stg_song_id              int IDENTITY(1,1) NOT NULL,
-                     num_songs                int,
-                     artist_id                varchar(30),
-                     artist_latitude          double precision,
-                     artist_longitude         double precision,
-                     artist_location          varchar(300),
-                     artist_name              varchar,
-                     song_id                  varchar(40),
-                     title                    varchar(200),
-                     duration                 double precision,
-                     year                     int,
-                     primary    key(stg_song_id))
-""")
-
-songplay_table_create = ("""
-CREATE TABLE IF NOT EXISTS songplays(
-                    songplay_id  int IDENTITY(1,1) NOT NULL,
-                    start_time   timestamp,
-                    user_id      int distkey,
-                    level        varchar(20),
-                    song_id      varchar(40) sortkey,
-                    artist_id    varchar(30),
-                    session_id   int,
-                    location     varchar(100),
-                    user_agent   varchar(200),
-                    primary  key(songplay_id))
-""")
-
-user_table_create = ("""
-CREATE TABLE IF NOT EXISTS users(
-                    user_id     int not null distkey,
-                    first_name  varchar(40) not null,
-                    last_name   varchar(40) not null,
-                    gender      varchar(10) not null,
-                    level       varchar(20) not null sortkey,
-                    primary key(user_id))
-
-""")
-
-song_table_create = ("""
-CREATE TABLE IF NOT EXISTS songs(
-                    song_id    varchar(40) not null,
-                    title      varchar(200) not null,
-                    artist_id  varchar(30) not null,
-                    year       int not null sortkey,
-                    duration   double precision,
-                    primary key(song_id))
-diststyle all
-""")
-
-artist_table_create = ("""
-CREATE TABLE IF NOT EXISTS artists(
-                    artist_id    varchar(30) not null sortkey,
-                    name         varchar,
-                    location     varchar(300),
-                    lattitude    double precision,
-                    longitude    double precision,
-                    primary  key(artist_id))
-diststyle all
-""")
-
-time_table_create = ("""
-CREATE TABLE IF NOT EXISTS time(
-                    start_time    timestamp not null sortkey,
-                    hour          int not null,
-                    day           int not null,
-                    week          int not null,
-                    month         int not null,
-                    year          int not null,
-                    weekday       int not null,
-                    primary       key(start_time))
-diststyle all
-""")
+# generated from the definitions in table_definitions.py, with the column encodings
+staging_events_table_create = create_table_sql('stg_events', WAREHOUSE_TABLES['stg_events'])
+staging_songs_table_create = create_table_sql('stg_songs', WAREHOUSE_TABLES['stg_songs'])
+songplay_table_create = create_table_sql('songplays', WAREHOUSE_TABLES['songplays'])
+user_table_create = create_table_sql('users', WAREHOUSE_TABLES['users'])
+song_table_create = create_table_sql('songs', WAREHOUSE_TABLES['songs'])
+artist_table_create = create_table_sql('artists', WAREHOUSE_TABLES['artists'])
+time_table_create = create_table_sql('time', WAREHOUSE_TABLES['time'])
+song_plays_daily_table_create = create_table_sql('agg_song_plays_daily', WAREHOUSE_TABLES['agg_song_plays_daily'])
+hourly_plays_table_create = create_table_sql('agg_hourly_plays', WAREHOUSE_TABLES['agg_hourly_plays'])
+level_daily_table_create = create_table_sql('agg_level_daily', WAREHOUSE_TABLES['agg_level_daily'])
 
 # STAGING TABLES
 
 staging_events_copy = (""" COPY stg_events 
-                           FROM {}
-                           iam_role {}
+                           FROM {LOG_DATA}
+                           iam_role {ARN}
                            COMPUPDATE OFF region 'us-west-2'
                            TIMEFORMAT as 'epochmillisecs'
-                           FORMAT AS JSON {};
+                           FORMAT AS JSON {LOG_JSONPATH};
                           
-""").format(LOG_DATA,ARN,LOG_JSONPATH) 
+""")
 
 staging_songs_copy = (""" COPY stg_songs 
-                           FROM {}
-                           iam_role {}
+                           FROM {SONG_DATA}
+                           iam_role {ARN}
                            COMPUPDATE OFF region 'us-west-2'
                            JSON 'auto';
-""").format(SONG_DATA,ARN)
+""")
 
 # FINAL TABLES
 
@@ -239,7 +162,19 @@ time_table_insert = (""" INSERT INTO time(
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, song_plays_daily_table_create, hourly_plays_table_create, level_daily_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, song_plays_daily_table_drop, hourly_plays_table_drop, level_daily_table_drop]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+
+
+def copy_table_queries(config):
+    """
+    - COPY statements of the staging tables with the S3 paths and the IAM role of the config filled in
+    - arguments : config returned by read_config
+    - returns : list of COPY statements
+    """
+    values = {'ARN': config.get("IAM_ROLE", "ARN"),
+              'LOG_DATA': config.get("S3", "LOG_DATA"),
+              'LOG_JSONPATH': config.get("S3", "LOG_JSONPATH"),
+              'SONG_DATA': config.get("S3", "SONG_DATA")}
+    return [query.format(**values) for query in (staging_events_copy, staging_songs_copy)]
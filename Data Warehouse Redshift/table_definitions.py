@@ -0,0 +1,425 @@
+import argparse
+import os
+
+# Single source of the table definitions of this project and of the Airflow pipeline.
+# sql_queries.py builds its CREATE TABLE statements from WAREHOUSE_TABLES and
+# `python table_definitions.py airflow` writes the Airflow dags/create_tables.sql from AIRFLOW_TABLES.
+#
+# Column encodings follow what sampling the staging data suggests (see `suggest`) :
+#   - raw for sort key columns, so range restricted scans read the zone maps of uncompressed blocks
+#   - az64 for integers, numerics and timestamps
+#   - bytedict for varchar columns with a handful of distinct values (level, gender, page, ...)
+#   - runlength for columns with long runs in sort key order (year and month of time)
+#   - zstd for the other varchar and double precision columns
+
+AIRFLOW_CREATE_TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                     'Data Pipeline Airflow', 'airflow', 'dags', 'create_tables.sql')
+
+ENCODINGS = ('raw', 'az64', 'zstd', 'bytedict', 'runlength', 'lzo')
+# identifiers quoted in the generated DDL
+RESERVED = {'time', 'hour', 'day', 'month', 'year', 'level', 'method'}
+AZ64_TYPES = ('int', 'bigint', 'smallint', 'numeric', 'decimal', 'timestamp', 'date')
+
+
+def column(name, data_type, encode, not_null=False, identity=False, distkey=False, sortkey=False):
+    """
+    - Definition of one column
+    - encode : one of ENCODINGS, sort key columns have to be raw
+    """
+    if encode not in ENCODINGS:
+        raise ValueError('Unknown encoding {} of column {}'.format(encode, name))
+    if sortkey and encode != 'raw':
+        raise ValueError('Sort key column {} has to be raw, not {}'.format(name, encode))
+    return {'name': name, 'type': data_type, 'encode': encode, 'not_null': not_null,
+            'identity': identity, 'distkey': distkey, 'sortkey': sortkey}
+
+
+def table(columns, primary_key=None, diststyle=None):
+    return {'columns': columns, 'primary_key': primary_key, 'diststyle': diststyle}
+
+
+WAREHOUSE_TABLES = {
+    'stg_events': table([
+        column('stg_event_id', 'int', 'az64', not_null=True, identity=True),
+        column('artist', 'varchar', 'zstd'),
+        column('auth', 'varchar(40)', 'bytedict'),
+        column('firstName', 'varchar(40)', 'zstd'),
+        column('gender', 'varchar(20)', 'bytedict'),
+        column('itemInSession', 'int', 'az64'),
+        column('lastName', 'varchar(40)', 'zstd'),
+        column('length', 'double precision', 'zstd'),
+        column('level', 'varchar(20)', 'bytedict'),
+        column('location', 'varchar(100)', 'zstd'),
+        column('method', 'varchar', 'bytedict'),
+        column('page', 'varchar', 'bytedict'),
+        column('registration', 'double precision', 'zstd'),
+        column('sessionid', 'int', 'az64'),
+        column('song', 'varchar(200)', 'zstd'),
+        column('status', 'int', 'az64'),
+        column('ts', 'bigint', 'az64'),
+        column('useragent', 'varchar(200)', 'zstd'),
+        column('userid', 'int', 'az64'),
+    ], primary_key='stg_event_id'),
+    'stg_songs': table([
+        column('stg_song_id', 'int', 'az64', not_null=True, identity=True),
+        column('num_songs', 'int', 'az64'),
+        column('artist_id', 'varchar(30)', 'zstd'),
+        column('artist_latitude', 'double precision', 'zstd'),
+        column('artist_longitude', 'double precision', 'zstd'),
+        column('artist_location', 'varchar(300)', 'zstd'),
+        column('artist_name', 'varchar', 'zstd'),
+        column('song_id', 'varchar(40)', 'zstd'),
+        column('title', 'varchar(200)', 'zstd'),
+        column('duration', 'double precision', 'zstd'),
+        column('year', 'int', 'az64'),
+    ], primary_key='stg_song_id'),
+    'songplays': table([
+        column('songplay_id', 'int', 'az64', not_null=True, identity=True),
+        column('start_time', 'timestamp', 'az64'),
+        column('user_id', 'int', 'az64', distkey=True),
+        column('level', 'varchar(20)', 'bytedict'),
+        column('song_id', 'varchar(40)', 'raw', sortkey=True),
+        column('artist_id', 'varchar(30)', 'zstd'),
+        column('session_id', 'int', 'az64'),
+        column('location', 'varchar(100)', 'zstd'),
+        column('user_agent', 'varchar(200)', 'zstd'),
+    ], primary_key='songplay_id'),
+    'users': table([
+        column('user_id', 'int', 'az64', not_null=True, distkey=True),
+        column('first_name', 'varchar(40)', 'zstd', not_null=True),
+        column('last_name', 'varchar(40)', 'zstd', not_null=True),
+        column('gender', 'varchar(10)', 'bytedict', not_null=True),
+        column('level', 'varchar(20)', 'raw', not_null=True, sortkey=True),
+    ], primary_key='user_id'),
+    'songs': table([
+        column('song_id', 'varchar(40)', 'zstd', not_null=True),
+        column('title', 'varchar(200)', 'zstd', not_null=True),
+        column('artist_id', 'varchar(30)', 'zstd', not_null=True),
+        column('year', 'int', 'raw', not_null=True, sortkey=True),
+        column('duration', 'double precision', 'zstd'),
+    ], primary_key='song_id', diststyle='all'),
+    'artists': table([
+        column('artist_id', 'varchar(30)', 'raw', not_null=True, sortkey=True),
+        column('name', 'varchar', 'zstd'),
+        column('location', 'varchar(300)', 'zstd'),
+        column('lattitude', 'double precision', 'zstd'),
+        column('longitude', 'double precision', 'zstd'),
+    ], primary_key='artist_id', diststyle='all'),
+    'time': table([
+        column('start_time', 'timestamp', 'raw', not_null=True, sortkey=True),
+        column('hour', 'int', 'az64', not_null=True),
+        column('day', 'int', 'az64', not_null=True),
+        column('week', 'int', 'az64', not_null=True),
+        column('month', 'int', 'runlength', not_null=True),
+        column('year', 'int', 'runlength', not_null=True),
+        column('weekday', 'int', 'az64', not_null=True),
+    ], primary_key='start_time', diststyle='all'),
+    # aggregates maintained by analytics.py, one row per day and group, refreshed per loaded window
+    'agg_song_plays_daily': table([
+        column('day', 'date', 'raw', not_null=True, sortkey=True),
+        column('song_id', 'varchar(40)', 'zstd', not_null=True),
+        column('artist_id', 'varchar(30)', 'zstd'),
+        column('title', 'varchar(200)', 'zstd'),
+        column('artist_name', 'varchar', 'zstd'),
+        column('plays', 'int', 'az64', not_null=True),
+    ]),
+    'agg_hourly_plays': table([
+        column('day', 'date', 'raw', not_null=True, sortkey=True),
+        column('hour', 'int', 'az64', not_null=True),
+        column('level', 'varchar(20)', 'bytedict'),
+        column('plays', 'int', 'az64', not_null=True),
+        column('users', 'int', 'az64', not_null=True),
+    ]),
+    'agg_level_daily': table([
+        column('day', 'date', 'raw', not_null=True, sortkey=True),
+        column('level', 'varchar(20)', 'bytedict'),
+        column('plays', 'int', 'az64', not_null=True),
+        column('sessions', 'int', 'az64', not_null=True),
+        column('users', 'int', 'az64', not_null=True),
+    ]),
+}
+
+AIRFLOW_TABLES = {
+    'artists': table([
+        column('artistid', 'varchar(256)', 'zstd', not_null=True),
+        column('name', 'varchar(256)', 'zstd'),
+        column('location', 'varchar(256)', 'zstd'),
+        column('lattitude', 'numeric(18,0)', 'az64'),
+        column('longitude', 'numeric(18,0)', 'az64'),
+    ]),
+    'calendar_hours': table([
+        column('hour_start', 'timestamp', 'az64', not_null=True),
+        column('hour', 'int4', 'az64'),
+        column('day', 'int4', 'az64'),
+        column('week', 'int4', 'az64'),
+        column('month', 'int4', 'runlength'),
+        column('year', 'int4', 'runlength'),
+        column('weekday', 'int4', 'az64'),
+    ], primary_key='hour_start'),
+    'songplays': table([
+        column('playid', 'varchar(32)', 'zstd', not_null=True),
+        column('start_time', 'timestamp', 'az64', not_null=True),
+        column('userid', 'int4', 'az64', not_null=True),
+        column('level', 'varchar(256)', 'bytedict'),
+        column('songid', 'varchar(256)', 'zstd'),
+        column('artistid', 'varchar(256)', 'zstd'),
+        column('sessionid', 'int4', 'az64'),
+        column('location', 'varchar(256)', 'zstd'),
+        column('user_agent', 'varchar(256)', 'zstd'),
+    ], primary_key='playid'),
+    'songs': table([
+        column('songid', 'varchar(256)', 'zstd', not_null=True),
+        column('title', 'varchar(256)', 'zstd'),
+        column('artistid', 'varchar(256)', 'zstd'),
+        column('year', 'int4', 'az64'),
+        column('duration', 'numeric(18,0)', 'az64'),
+    ], primary_key='songid'),
+    'staging_events': table([
+        column('artist', 'varchar(256)', 'zstd'),
+        column('auth', 'varchar(256)', 'bytedict'),
+        column('firstname', 'varchar(256)', 'zstd'),
+        column('gender', 'varchar(256)', 'bytedict'),
+        column('iteminsession', 'int4', 'az64'),
+        column('lastname', 'varchar(256)', 'zstd'),
+        column('length', 'numeric(18,0)', 'az64'),
+        column('level', 'varchar(256)', 'bytedict'),
+        column('location', 'varchar(256)', 'zstd'),
+        column('method', 'varchar(256)', 'bytedict'),
+        column('page', 'varchar(256)', 'bytedict'),
+        column('registration', 'numeric(18,0)', 'az64'),
+        column('sessionid', 'int4', 'az64'),
+        column('song', 'varchar(256)', 'zstd'),
+        column('status', 'int4', 'az64'),
+        column('ts', 'int8', 'az64'),
+        column('useragent', 'varchar(256)', 'zstd'),
+        column('userid', 'int4', 'az64'),
+    ]),
+    'stage_loads': table([
+        column('table_name', 'varchar(256)', 'bytedict', not_null=True),
+        column('s3_path', 'varchar(1024)', 'zstd', not_null=True),
+        column('loaded_at', 'timestamp', 'az64', not_null=True),
+        column('etag', 'varchar(64)', 'zstd'),
+    ]),
+    'staging_songs': table([
+        column('num_songs', 'int4', 'az64'),
+        column('artist_id', 'varchar(256)', 'zstd'),
+        column('artist_name', 'varchar(256)', 'zstd'),
+        column('artist_latitude', 'numeric(18,0)', 'az64'),
+        column('artist_longitude', 'numeric(18,0)', 'az64'),
+        column('artist_location', 'varchar(256)', 'zstd'),
+        column('song_id', 'varchar(256)', 'zstd'),
+        column('title', 'varchar(256)', 'zstd'),
+        column('duration', 'numeric(18,0)', 'az64'),
+        column('year', 'int4', 'az64'),
+    ]),
+    'time': table([
+        column('start_time', 'timestamp', 'az64', not_null=True),
+        column('hour', 'int4', 'az64'),
+        column('day', 'int4', 'az64'),
+        column('week', 'int4', 'az64'),
+        column('month', 'varchar(256)', 'bytedict'),
+        column('year', 'int4', 'runlength'),
+        column('weekday', 'varchar(256)', 'bytedict'),
+    ], primary_key='start_time'),
+    'users': table([
+        column('userid', 'int4', 'az64', not_null=True),
+        column('first_name', 'varchar(256)', 'zstd'),
+        column('last_name', 'varchar(256)', 'zstd'),
+        column('gender', 'varchar(256)', 'bytedict'),
+        column('level', 'varchar(256)', 'bytedict'),
+    ], primary_key='userid'),
+}
+
+
+def quote(name):
+    return '"{}"'.format(name) if name.lower() in RESERVED else name
+
+
+def column_sql(definition, dialect='redshift'):
+    """
+    - Renders one column definition
+    - the postgres dialect leaves out ENCODE, DISTKEY and SORTKEY and declares identities the postgres way
+    """
+    parts = [quote(definition['name']), definition['type']]
+    if definition['identity']:
+        parts.append('IDENTITY(1,1)' if dialect == 'redshift' else 'GENERATED BY DEFAULT AS IDENTITY')
+    if dialect == 'redshift':
+        parts.append('ENCODE {}'.format(definition['encode']))
+        if definition['distkey']:
+            parts.append('DISTKEY')
+        if definition['sortkey']:
+            parts.append('SORTKEY')
+    if definition['not_null']:
+        parts.append('NOT NULL')
+    return ' '.join(parts)
+
+
+def create_table_sql(name, definition, dialect='redshift', schema=None):
+    """
+    - Renders the CREATE TABLE IF NOT EXISTS statement of a table definition
+    - arguments :
+                - name : table name
+                - definition : entry of WAREHOUSE_TABLES or AIRFLOW_TABLES
+                - dialect : redshift or postgres
+                - schema : schema to qualify the table name with, e.g. public
+    """
+    qualified = '{}.{}'.format(schema, quote(name)) if schema else quote(name)
+    lines = [column_sql(column_definition, dialect) for column_definition in definition['columns']]
+    if definition['primary_key']:
+        lines.append('CONSTRAINT {}_pkey PRIMARY KEY ({})'.format(name, quote(definition['primary_key'])))
+    sql = 'CREATE TABLE IF NOT EXISTS {} (\n\t{}\n)'.format(qualified, ',\n\t'.join(lines))
+    if dialect == 'redshift' and definition['diststyle']:
+        sql += '\nDISTSTYLE {}'.format(definition['diststyle'].upper())
+    return sql
+
+
+def create_tables_script(definitions, dialect='redshift', schema='public'):
+    """
+    - Renders all tables of a registry as one SQL script, like the Airflow dags/create_tables.sql
+    """
+    header = '-- Generated by Data Warehouse Redshift/table_definitions.py, edit the table definitions there.\n\n'
+    return header + ''.join('{};\n\n'.format(create_table_sql(name, definition, dialect, schema))
+                            for name, definition in definitions.items())
+
+
+def write_airflow_ddl(path=AIRFLOW_CREATE_TABLES, dialect='redshift'):
+    with open(path, 'w') as f:
+        f.write(create_tables_script(AIRFLOW_TABLES, dialect))
+
+
+# SAMPLING
+
+sample_sql = "SELECT {} FROM {} {} LIMIT {}"
+analyze_compression_sql = "ANALYZE COMPRESSION {} COMPROWS {}"
+table_encodings_sql = """
+    SELECT "column", encoding FROM pg_table_def WHERE tablename = %s
+"""
+alter_encoding_sql = "ALTER TABLE {} ALTER COLUMN {} ENCODE {}"
+
+
+def choose_encoding(definition, values):
+    """
+    - Picks the encoding of a column from a sample of its values, in sort key order when the table has one
+    - raw for sort keys, runlength for long runs of equal values, bytedict for varchars with few distinct values,
+      az64 for the types it supports, zstd otherwise
+    """
+    if definition['sortkey']:
+        return 'raw'
+    present = [value for value in values if value is not None]
+    if not present:
+        return 'zstd'
+    runs = 1 + sum(1 for previous, value in zip(values, values[1:]) if value != previous)
+    if len(values) / runs >= 10:
+        return 'runlength'
+    data_type = definition['type'].lower()
+    if data_type.startswith(('varchar', 'char')) and len(set(present)) <= 255:
+        return 'bytedict'
+    if data_type.startswith(AZ64_TYPES):
+        return 'az64'
+    return 'zstd'
+
+
+def sample_encodings(cur, name, definition, rows=100000):
+    """
+    - Samples up to `rows` rows of a loaded table and picks the encoding of every column with choose_encoding
+    - works on postgres as well as on redshift
+    - returns : dict of column -> encoding
+    """
+    sortkeys = [quote(c['name']) for c in definition['columns'] if c['sortkey']]
+    order = 'ORDER BY {}'.format(', '.join(sortkeys)) if sortkeys else ''
+    names = [c['name'] for c in definition['columns']]
+    cur.execute(sample_sql.format(', '.join(quote(n) for n in names), quote(name), order, rows))
+    sample = cur.fetchall()
+    return {c['name']: choose_encoding(c, [row[i] for row in sample]) for i, c in enumerate(definition['columns'])}
+
+
+def analyze_compression(cur, name, rows=100000):
+    """
+    - Asks redshift for the encodings that compress a sample of the table best
+    - returns : dict of column -> encoding
+    """
+    cur.execute(analyze_compression_sql.format(quote(name), rows))
+    return {column_name: encoding for table_name, column_name, encoding, *estimate in cur.fetchall()}
+
+
+def suggest(cur, definitions, analyze=False, rows=100000):
+    """
+    - Prints the columns whose registry encoding differs from the one suggested by the sampled data
+    """
+    for name, definition in definitions.items():
+        suggested = analyze_compression(cur, name, rows) if analyze else sample_encodings(cur, name, definition, rows)
+        for c in definition['columns']:
+            encoding = suggested.get(c['name'], suggested.get(c['name'].lower()))
+            if encoding and encoding != c['encode']:
+                print('{}.{}: registry {}, sampled {}'.format(name, c['name'], c['encode'], encoding))
+
+
+# MIGRATION
+
+def migration_statements(cur, definitions):
+    """
+    - Compares the encodings of the existing tables in pg_table_def with the registry
+    - returns : ALTER TABLE ... ALTER COLUMN ... ENCODE statements re-encoding the columns in place,
+                the data stays readable while redshift rewrites them
+    """
+    statements = []
+    for name, definition in definitions.items():
+        cur.execute(table_encodings_sql, (name,))
+        current = {column_name.lower(): encoding.lower() for column_name, encoding in cur.fetchall()}
+        for c in definition['columns']:
+            encoding = current.get(c['name'].lower())
+            if encoding is not None and encoding != c['encode'] and not c['sortkey']:
+                statements.append(alter_encoding_sql.format(quote(name), quote(c['name']), c['encode']))
+    return statements
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Table definitions of the warehouse and the Airflow pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+    airflow = commands.add_parser('airflow', help='write the Airflow dags/create_tables.sql')
+    airflow.add_argument('--output', default=AIRFLOW_CREATE_TABLES)
+    airflow.add_argument('--dialect', choices=['redshift', 'postgres'], default='redshift')
+    for command in ('suggest', 'migrate'):
+        subparser = commands.add_parser(command)
+        subparser.add_argument('--tables', choices=['warehouse', 'airflow'], default='warehouse')
+        subparser.add_argument('--config', default='dwh.cfg', help='path of the config file')
+    commands.choices['suggest'].add_argument('--analyze', action='store_true',
+                                             help='use ANALYZE COMPRESSION instead of sampling the rows')
+    commands.choices['suggest'].add_argument('--rows', type=int, default=100000)
+    commands.choices['migrate'].add_argument('--apply', action='store_true',
+                                             help='run the statements instead of printing them')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    - airflow : writes the Airflow create_tables.sql
+    - suggest : prints the registry encodings the sampled staging and star schema data disagrees with
+    - migrate : prints, or runs with --apply, the statements re-encoding existing tables to the registry
+    """
+    args = parse_args(argv)
+    if args.command == 'airflow':
+        write_airflow_ddl(args.output, args.dialect)
+        return
+
+    # sql_queries builds its CREATE statements from this module, it is imported once the registry is loaded
+    import psycopg2
+    from sql_queries import connection_string, read_config
+    conn = psycopg2.connect(connection_string(read_config(args.config)))
+    # ALTER COLUMN ENCODE runs outside of a transaction block
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    definitions = WAREHOUSE_TABLES if args.tables == 'warehouse' else AIRFLOW_TABLES
+    if args.command == 'suggest':
+        suggest(cur, definitions, args.analyze, args.rows)
+    else:
+        for statement in migration_statements(cur, definitions):
+            print(statement)
+            if args.apply:
+                cur.execute(statement)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+'''
+Bloom filter of the song play events already loaded, shared by the Postgres ETL and the Data Lake jobs :
+
+    python event_filter.py info songplays.filter
+    python event_filter.py merge merged.filter day1.filter day2.filter
+
+- An event is identified by its fingerprint (userId, sessionId, itemInSession, ts), see fingerprint
+- A filter answers "maybe loaded" or "not loaded". The loaders drop the events it has not seen without
+  asking the database and check the positives against the loaded songplays exactly, a false positive costs
+  one lookup and never drops an event
+- Filters of the same size are merged by OR-ing their bits, e.g. the filters built by the partitions of a
+  spark job or by two loaders of disjoint log files. A cuckoo filter would support deletes but not merges
+- The file is replaced atomically, loaders save it before committing the events they added, so a filter may
+  know events whose transaction rolled back, which the exact check catches, but never misses loaded ones
+'''
+import argparse
+import hashlib
+import math
+import os
+import struct
+
+MAGIC = b'SPKFBLM1'
+HEADER = struct.Struct('<8sQBQQ')
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.001
+
+
+def fingerprint(user_id, session_id, item_in_session, ts):
+    '''
+    Description : Canonical key of an event, ts in milliseconds since epoch, the user id of the logs is a string
+    Returns :
+        - bytes
+    '''
+    return '{}|{}|{}|{}'.format(int(user_id), int(session_id), int(item_in_session), int(ts)).encode('ascii')
+
+
+class EventFilter:
+    '''
+    Description : Bloom filter of num_bits bits and num_hashes positions per key, the positions are derived from
+                  one blake2b digest by double hashing, they are the same in every process and on every host
+    '''
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0, path=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = count
+        self.path = path
+
+    @classmethod
+    def for_capacity(cls, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, path=None):
+        '''
+        Description : Filter sized for capacity keys at a false positive rate of error_rate
+        '''
+        num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return cls(num_bits, num_hashes, path=path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, num_bits, num_hashes, count, size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('{} is not an event filter'.format(path))
+            bits = f.read(size)
+        if len(bits) != size or size != (num_bits + 7) // 8:
+            raise ValueError('{} is truncated'.format(path))
+        return cls(num_bits, num_hashes, bits, count, path)
+
+    @classmethod
+    def open(cls, path, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        '''
+        Description : The filter saved at path, a new empty one sized for capacity when there is none yet
+        '''
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls.for_capacity(capacity, error_rate, path)
+
+    def save(self, path=None):
+        '''
+        Description : Write the filter to path, by default the path it was opened from, replacing the file atomically
+        '''
+        path = path or self.path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.num_bits, self.num_hashes, self.count, len(self.bits)))
+            f.write(self.bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.path = path
+
+    def positions(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.blake2b(key, digest_size=16).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def add_events(self, events):
+        '''
+        Description : Add the fingerprints of (user_id, session_id, item_in_session, ts) tuples
+        '''
+        for event in events:
+            self.add(fingerprint(*event))
+
+    def has_event(self, user_id, session_id, item_in_session, ts):
+        return fingerprint(user_id, session_id, item_in_session, ts) in self
+
+    def merge(self, other):
+        '''
+        Description : Add the keys of another filter of the same size, count becomes an upper bound
+        '''
+        if (self.num_bits, self.num_hashes) != (other.num_bits, other.num_hashes):
+            raise ValueError('Cannot merge a filter of {} bits and {} hashes into one of {} bits and {} hashes'.format(
+                other.num_bits, other.num_hashes, self.num_bits, self.num_hashes))
+        merged = int.from_bytes(self.bits, 'little') | int.from_bytes(other.bits, 'little')
+        self.bits = bytearray(merged.to_bytes(len(self.bits), 'little'))
+        self.count += other.count
+        return self
+
+    def fill_ratio(self):
+        return sum(bin(byte).count('1') for byte in self.bits) / self.num_bits
+
+    def estimated_count(self):
+        '''
+        Description : Distinct keys estimated from the bits set, unlike count it is not inflated by merges of
+                      overlapping filters or keys added twice
+        '''
+        ratio = self.fill_ratio()
+        if ratio >= 1:
+            return float('inf')
+        return self.num_bits / self.num_hashes * -math.log1p(-ratio)
+
+    def error_rate(self):
+        '''
+        Description : Current false positive rate, it grows past the rate the filter was sized for once it
+                      holds more keys than its capacity
+        '''
+        return self.fill_ratio() ** self.num_hashes
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+    info = commands.add_parser('info', help='print the size, keys and false positive rate of filters')
+    info.add_argument('paths', nargs='+')
+    merge = commands.add_parser('merge', help='merge filters of the same size into a new one')
+    merge.add_argument('output')
+    merge.add_argument('inputs', nargs='+')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'info':
+        for path in args.paths:
+            event_filter = EventFilter.load(path)
+            print('{} : {} bits, {} hashes, {} keys added, ~{:.0f} distinct, {:.2%} full, error rate {:.6f}'.format(
+                path, event_filter.num_bits, event_filter.num_hashes, event_filter.count,
+                event_filter.estimated_count(), event_filter.fill_ratio(), event_filter.error_rate()))
+    else:
+        merged = EventFilter.load(args.inputs[0])
+        for path in args.inputs[1:]:
+            merged.merge(EventFilter.load(path))
+        merged.save(args.output)
+        print('merged {} filters into {}'.format(len(args.inputs), args.output))
+
+
+if __name__ == "__main__":
+    main()
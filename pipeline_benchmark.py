@@ -0,0 +1,558 @@
+'''
+Cross-pipeline benchmark of the four star schema implementations on one synthetic dataset :
+
+    python pipeline_benchmark.py --scales 1000 10000 --admin-dsn "host=127.0.0.1 dbname=studentdb ..."
+    python pipeline_benchmark.py --scales 1000 --baseline baseline.json --write-baseline
+    python pipeline_benchmark.py --scales 1000 --baseline baseline.json
+
+- generate_dataset writes song_data and log_data in the layout of the udacity datasets, one dataset per scale
+  (number of log events), the same seed gives the same files
+- Every pipeline loads the dataset in a fresh interpreter, the projects share module names like etl and
+  sql_queries, and reports its time, peak memory and the rows of the five tables :
+    - postgres : etl.py of Data Modeling - Postgres into a fresh database
+    - redshift_sql : the staging and insert statements of Data Warehouse Redshift/sql_queries.py on a postgres
+      stand-in, the JSON records are inserted into the staging tables in place of COPY and time is left out,
+      its insert relies on redshift's lateral column aliases
+    - airflow_sql : the Airflow SqlQueries on a postgres stand-in, staged the same way
+    - spark : Data Lake/etl.py with a local spark session, skipped without pyspark or java
+    - arrow : the arrow engine of Data Lake/arrow_etl.py
+- The tables of every pipeline are compared with those of the reference pipeline on TABLE_COLUMNS, the
+  dimensions as sets of rows and songplays as a multiset
+- With --baseline the run fails on changed row counts or mismatches and on slowdowns beyond --max-slowdown
+'''
+import argparse
+import datetime
+import decimal
+import importlib.util
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from sparkify import HERE, PIPELINES, airflow_sql_queries
+
+ADMIN_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+
+# canonical columns of the star schema tables, the rows of every pipeline are compared on these.
+# weekday is left out of time, postgres numbers the days from monday, redshift from sunday and spark names them
+TABLE_COLUMNS = {
+    'songplays': ['start_time', 'user_id', 'level', 'song_id', 'artist_id', 'session_id', 'location', 'user_agent'],
+    'users': ['user_id', 'first_name', 'last_name', 'gender', 'level'],
+    'songs': ['song_id', 'title', 'artist_id', 'year', 'duration'],
+    'artists': ['artist_id', 'name', 'location', 'latitude', 'longitude'],
+    'time': ['start_time', 'hour', 'day', 'week', 'month', 'year'],
+}
+
+# tables compared as a multiset, the others are compared as sets of distinct rows
+FACT_TABLES = {'songplays'}
+
+# column expressions of the database pipelines whose tables name a canonical column differently
+SQL_COLUMNS = {
+    'postgres': {},
+    'redshift_sql': {
+        'artists': {'latitude': 'lattitude'},
+    },
+    'airflow_sql': {
+        'songplays': {'user_id': 'userid', 'song_id': 'songid', 'artist_id': 'artistid', 'session_id': 'sessionid'},
+        'users': {'user_id': 'userid'},
+        'songs': {'song_id': 'songid', 'artist_id': 'artistid'},
+        'artists': {'artist_id': 'artistid', 'latitude': 'lattitude'},
+        'time': {'month': 'CAST("month" AS int)'},
+    },
+}
+
+# redshift casts the operands of || to varchar, md5(events.sessionid || events.start_time)
+# of SqlQueries.songplay_table_insert needs the operator declared on postgres
+CONCAT_OPERATOR_SQL = """
+CREATE FUNCTION int4_timestamp_concat(int4, timestamp) RETURNS text
+    AS 'SELECT $1::text || $2::text' LANGUAGE SQL IMMUTABLE;
+CREATE OPERATOR || (LEFTARG = int4, RIGHTARG = timestamp, FUNCTION = int4_timestamp_concat)
+"""
+
+# statements of SqlQueries in the order of the DAG, inserted like LoadFactOperator and LoadDimensionOperator do
+AIRFLOW_INSERTS = [('songplays', 'songplay_table_insert'), ('users', 'user_table_insert'),
+                   ('songs', 'song_table_insert'), ('artists', 'artist_table_insert'), ('time', 'time_table_insert')]
+
+# runs shorter than this are too noisy for the slowdown check of the regression gate
+MIN_GATED_SECONDS = 1.0
+
+FIRST_NAMES = ['Kaylee', 'Lily', 'Jacob', 'Tegan', 'Chloe', 'Aleena', 'Mohammad', 'Ryan', 'Kate', 'Jayden']
+LAST_NAMES = ['Summers', 'Koch', 'Klein', 'Levine', 'Cuevas', 'Kirby', 'Rodriguez', 'Smith', 'Harrell', 'Graves']
+LOCATIONS = ['Phoenix-Mesa-Scottsdale, AZ', 'Chicago-Naperville-Elgin, IL-IN-WI', 'San Jose-Sunnyvale-Santa Clara, CA',
+             'Portland-South Portland, ME', 'Lansing-East Lansing, MI', 'Atlanta-Sandy Springs-Roswell, GA']
+USER_AGENTS = ['Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Ubuntu Chromium/36.0.1985.125 Chrome/36.0.1985.125 Safari/537.36"']
+WORDS = ['love', 'night', 'river', 'electric', 'heart', 'summer', 'ghost', 'dance', 'blue', 'city', 'fire', 'dream',
+         'shadow', 'gold', 'road', 'rain', 'wild', 'echo', 'silver', 'storm']
+OTHER_PAGES = ['Home', 'Logout', 'Settings', 'Help', 'Upgrade']
+
+
+def random_id(rng, prefix, length=16):
+    return prefix + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(length))
+
+
+def generate_dataset(path, events, seed=0):
+    '''
+    Description :
+        - Write a synthetic song_data and log_data under path, like the udacity datasets : one JSON file per song
+          in song_data/<A>/<B>/<C>/, one NDJSON file of events per day of November 2018 in log_data/2018/11/
+        - About 80% of the events are NextSong plays, 40% of the plays match a song on title, artist and duration
+        - Some free users upgrade to paid within the month, they appear with both levels
+    Arguments :
+        - path : directory to write, replaced when it exists
+        - events : number of log events
+        - seed : seed of the generator
+    Returns :
+        - dict of songs and events written
+    '''
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    artists = []
+    for i in range(max(5, events // 40)):
+        has_coordinates = rng.random() < 0.6
+        artists.append({'artist_id': random_id(rng, 'AR'),
+                        'artist_name': '{} {}'.format(rng.choice(WORDS).title(), i),
+                        'artist_location': rng.choice(LOCATIONS + ['']),
+                        'artist_latitude': round(rng.uniform(-60, 60), 5) if has_coordinates else None,
+                        'artist_longitude': round(rng.uniform(-180, 180), 5) if has_coordinates else None})
+
+    songs = []
+    for i in range(max(10, events // 10)):
+        track = random_id(rng, 'TR', 16)
+        song = dict(rng.choice(artists), num_songs=1, song_id=random_id(rng, 'SO'),
+                    title='{} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS), i).title(),
+                    duration=round(rng.uniform(60, 600), 5), year=rng.choice([0] + list(range(1960, 2019))))
+        directory = os.path.join(path, 'song_data', track[2], track[3], track[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '{}.json'.format(track)), 'w') as f:
+            json.dump(song, f)
+        songs.append(song)
+
+    users = [{'userId': str(i), 'firstName': rng.choice(FIRST_NAMES), 'lastName': rng.choice(LAST_NAMES),
+              'gender': rng.choice('MF'), 'level': rng.choice(['free', 'paid']), 'location': rng.choice(LOCATIONS),
+              'userAgent': rng.choice(USER_AGENTS), 'registration': float(rng.randint(1535000000, 1541000000) * 1000)}
+             for i in range(1, max(5, events // 200) + 1)]
+
+    month_start = datetime.datetime(2018, 11, 1)
+    month_ms = 29 * 86400 * 1000
+    days = {}
+    session_id = 0
+    written = 0
+    while written < events:
+        user = rng.choice(users)
+        if user['level'] == 'free' and rng.random() < 0.05:
+            user['level'] = 'paid'
+        session_id += 1
+        ts = int(month_start.timestamp() * 1000) + rng.randint(0, month_ms)
+        for item in range(min(rng.randint(1, 30), events - written)):
+            event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+                     'itemInSession': item, 'lastName': user['lastName'], 'length': None, 'level': user['level'],
+                     'location': user['location'], 'method': 'GET', 'page': rng.choice(OTHER_PAGES),
+                     'registration': user['registration'], 'sessionId': session_id, 'song': None, 'status': 200,
+                     'ts': ts, 'userAgent': user['userAgent'], 'userId': user['userId']}
+            if rng.random() < 0.8:
+                if rng.random() < 0.4:
+                    song = rng.choice(songs)
+                    artist, title, length = song['artist_name'], song['title'], song['duration']
+                else:
+                    artist = '{} {}'.format(rng.choice(WORDS).title(), rng.choice(WORDS).title())
+                    title = '{} {}'.format(rng.choice(WORDS), rng.choice(WORDS)).title()
+                    length = round(rng.uniform(60, 600), 5)
+                event.update(artist=artist, song=title, length=length, method='PUT', page='NextSong')
+            days.setdefault(datetime.datetime.utcfromtimestamp(ts / 1000).date(), []).append(event)
+            ts += rng.randint(1000, 300000)
+            written += 1
+
+    for day, day_events in days.items():
+        directory = os.path.join(path, 'log_data', str(day.year), '{:02d}'.format(day.month))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '{}-events.json'.format(day.isoformat())), 'w') as f:
+            f.writelines(json.dumps(event) + '\n' for event in day_events)
+    return {'songs': len(songs), 'events': written}
+
+
+def canonical(value):
+    '''
+    Description : Comparable form of a table value, timestamps truncated to seconds like ts/1000 on redshift,
+                  numbers rounded to 5 decimals, NaN as NULL
+    '''
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, (float, decimal.Decimal)):
+        value = float(value)
+        return int(value) if value.is_integer() else round(value, 5)
+    return value
+
+
+def sql_tables(conn, pipeline, tables=TABLE_COLUMNS):
+    '''
+    Description : Canonical rows of the tables of a database pipeline
+    Returns :
+        - dict of table -> list of rows
+    '''
+    cur = conn.cursor()
+    result = {}
+    for table in tables:
+        names = SQL_COLUMNS[pipeline].get(table, {})
+        columns = [names.get(name, '"{}"'.format(name)) for name in TABLE_COLUMNS[table]]
+        cur.execute('SELECT {} FROM "{}"'.format(', '.join(columns), table))
+        result[table] = [[canonical(value) for value in row] for row in cur.fetchall()]
+    return result
+
+
+def parquet_tables(settings):
+    '''
+    Description : Canonical rows of the tables written by the Data Lake ETL, partition columns included,
+                  read from the latest version when the table log is enabled
+    Returns :
+        - dict of table -> list of rows
+    '''
+    from table_log import live_dataset
+    result = {}
+    for table, columns in TABLE_COLUMNS.items():
+        dataset = live_dataset('{}/songs/{}_table.parquet'.format(settings['output_data'], table), settings)
+        rows = dataset.to_table(columns=columns).to_pylist()
+        result[table] = [[canonical(row[name]) for name in columns] for row in rows]
+    return result
+
+
+def fresh_database(admin_dsn, dbname):
+    '''
+    Description : Drop and create dbname from the admin database
+    Returns :
+        - connection to the new database
+    '''
+    import psycopg2
+    from psycopg2.extensions import make_dsn
+    conn = psycopg2.connect(admin_dsn)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute('DROP DATABASE IF EXISTS {}'.format(dbname))
+    cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0".format(dbname))
+    conn.close()
+    return psycopg2.connect(make_dsn(admin_dsn, dbname=dbname))
+
+
+def without_primary_key(definition):
+    '''
+    Description : Table definition without its primary key, redshift does not enforce them and the
+                  statements rely on it, e.g. the SELECT DISTINCT userid, ..., level of the Redshift project for users
+                  of both levels
+    '''
+    return dict(definition, primary_key=None)
+
+
+def run_postgres(data, workdir, admin_dsn):
+    from psycopg2.extensions import make_dsn
+    import create_tables
+    import etl
+    cur, conn = create_tables.create_database(make_dsn(admin_dsn, dbname='bench_postgres'), admin_dsn)
+    create_tables.create_tables(cur, conn)
+    etl.process_data(cur, conn, os.path.join(data, 'song_data'), etl.process_song_file)
+    etl.process_data(cur, conn, os.path.join(data, 'log_data'), etl.process_log_file)
+    return lambda: sql_tables(conn, 'postgres')
+
+
+def run_redshift_sql(data, workdir, admin_dsn):
+    from check_analytics import json_records, stage
+    from sql_queries import insert_table_queries, time_table_insert
+    from table_definitions import WAREHOUSE_TABLES, create_table_sql
+    conn = fresh_database(admin_dsn, 'bench_redshift_sql')
+    cur = conn.cursor()
+    for name, definition in WAREHOUSE_TABLES.items():
+        cur.execute(create_table_sql(name, without_primary_key(definition), dialect='postgres'))
+    stage(cur, 'stg_songs', json_records(os.path.join(data, 'song_data')))
+    stage(cur, 'stg_events', json_records(os.path.join(data, 'log_data')))
+    for query in insert_table_queries:
+        if query is not time_table_insert:
+            cur.execute(query)
+    conn.commit()
+    return lambda: sql_tables(conn, 'redshift_sql', [table for table in TABLE_COLUMNS if table != 'time'])
+
+
+def run_airflow_sql(data, workdir, admin_dsn):
+    from check_analytics import json_records, stage
+    from table_definitions import AIRFLOW_TABLES, create_table_sql, quote
+    queries = airflow_sql_queries()
+    conn = fresh_database(admin_dsn, 'bench_airflow_sql')
+    cur = conn.cursor()
+    for name, definition in AIRFLOW_TABLES.items():
+        cur.execute(create_table_sql(name, without_primary_key(definition), dialect='postgres'))
+    cur.execute(CONCAT_OPERATOR_SQL)
+    stage(cur, 'staging_songs', json_records(os.path.join(data, 'song_data')), AIRFLOW_TABLES)
+    stage(cur, 'staging_events', json_records(os.path.join(data, 'log_data')), AIRFLOW_TABLES)
+    for table, name in AIRFLOW_INSERTS:
+        cur.execute('INSERT INTO {} {}'.format(quote(table), queries[name]))
+    conn.commit()
+    return lambda: sql_tables(conn, 'airflow_sql')
+
+
+def datalake_settings(data, workdir, engine):
+    from settings import load_settings
+    return load_settings('dl.cfg', 'local', {
+        'engine': engine, 'input_data': data + '/', 'output_data': os.path.join(workdir, engine),
+        'rollups': 'false', 'manifests': 'false', 'table_log': 'false', 'metrics_report': ''})
+
+
+def run_spark(data, workdir, admin_dsn):
+    import etl
+    settings = datalake_settings(data, workdir, 'spark')
+    etl.run(settings)
+    return lambda: parquet_tables(settings)
+
+
+def run_arrow(data, workdir, admin_dsn):
+    import arrow_etl
+    settings = datalake_settings(data, workdir, 'arrow')
+    arrow_etl.run(settings)
+    return lambda: parquet_tables(settings)
+
+
+# pipeline : (keys of sparkify.PIPELINES put on sys.path, the first one is the working directory,
+#             function loading the dataset and returning a reader of its tables)
+BENCHMARKS = {
+    'postgres': (['postgres'], run_postgres),
+    'redshift_sql': (['redshift'], run_redshift_sql),
+    'airflow_sql': (['airflow', 'redshift'], run_airflow_sql),
+    'spark': (['datalake'], run_spark),
+    'arrow': (['datalake'], run_arrow),
+}
+
+
+def skip_reason(pipeline):
+    if pipeline == 'spark':
+        if importlib.util.find_spec('pyspark') is None:
+            return 'pyspark is not installed'
+        if not (os.environ.get('JAVA_HOME') or shutil.which('java')):
+            return 'no java runtime found'
+    return None
+
+
+def run_worker(pipeline, data, workdir, admin_dsn, result_path):
+    '''
+    Description : Load the dataset with one pipeline in this interpreter and write its result to result_path
+    Arguments :
+        - pipeline : key of BENCHMARKS
+        - data : dataset directory
+        - workdir : directory for the outputs of the pipeline
+        - admin_dsn : connection string of the database the benchmark databases are created from
+        - result_path : path of the JSON result
+    Returns :
+        - None
+    '''
+    projects, load = BENCHMARKS[pipeline]
+    directories = [os.path.join(HERE, PIPELINES[project][0]) for project in projects]
+    sys.path[:0] = directories
+    os.chdir(directories[0])
+
+    start = time.perf_counter()
+    read_tables = load(os.path.abspath(data), os.path.abspath(workdir), admin_dsn)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on linux, children covers the processes this one waited for, not a database server
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    tables = read_tables()
+    result = {'status': 'ok', 'seconds': round(seconds, 3), 'max_rss_mb': round(max_rss / 1024, 1),
+              'rows': {table: len(tables[table]) if table in tables else None for table in TABLE_COLUMNS},
+              'tables': tables}
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+def run_pipeline(pipeline, data, workdir, admin_dsn):
+    '''
+    Description : Run one pipeline in a fresh interpreter, its output goes to <workdir>/<pipeline>.log
+    Returns :
+        - result of run_worker, or a dict with the status skipped or failed and the reason
+    '''
+    reason = skip_reason(pipeline)
+    if reason:
+        return {'status': 'skipped', 'error': reason}
+
+    result_path = os.path.join(workdir, '{}.json'.format(pipeline))
+    log_path = os.path.join(workdir, '{}.log'.format(pipeline))
+    with open(log_path, 'w') as log:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', pipeline,
+                                    '--data', data, '--workdir', workdir, '--admin-dsn', admin_dsn,
+                                    '--result', result_path], stdout=log, stderr=subprocess.STDOUT)
+    if completed.returncode != 0:
+        with open(log_path) as f:
+            lines = [line.strip() for line in f if line.strip()]
+        return {'status': 'failed', 'error': '{} (see {})'.format(lines[-1] if lines else 'no output', log_path)}
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def diff_tables(reference, tables):
+    '''
+    Description : Compare the canonical rows of a pipeline with those of the reference, tables missing
+                  from either side are left out
+    Returns :
+        - dict of table -> [rows only in the reference, rows only in the pipeline]
+    '''
+    differences = {}
+    for table in TABLE_COLUMNS:
+        if table not in reference or table not in tables:
+            continue
+        expected = Counter(tuple(row) for row in reference[table])
+        found = Counter(tuple(row) for row in tables[table])
+        if table not in FACT_TABLES:
+            expected, found = Counter(set(expected)), Counter(set(found))
+        differences[table] = [sum((expected - found).values()), sum((found - expected).values())]
+    return differences
+
+
+def run_scale(events, pipelines, reference, args):
+    '''
+    Description : Generate the dataset of one scale, run the pipelines on it and diff them with the reference
+    Returns :
+        - dict of pipeline -> result without the table rows, with the mismatches of each table
+    '''
+    workdir = os.path.join(os.path.abspath(args.workdir), str(events))
+    data = os.path.join(workdir, 'data')
+    generated = generate_dataset(data, events, args.seed)
+    print('scale {} : {} events, {} songs'.format(events, generated['events'], generated['songs']))
+
+    results = {pipeline: run_pipeline(pipeline, data, workdir, args.admin_dsn) for pipeline in pipelines}
+    reference_tables = results.get(reference, {}).get('tables')
+    for pipeline, result in results.items():
+        tables = result.pop('tables', None)
+        if reference_tables is not None and tables is not None and pipeline != reference:
+            result['mismatches'] = diff_tables(reference_tables, tables)
+    return results
+
+
+def print_results(events, results, reference):
+    print('{:<8}{:<14}{:<9}{:>10}{:>9}  {:<44}{}'.format('scale', 'pipeline', 'status', 'seconds', 'rss MB',
+                                                        'rows ' + '/'.join(TABLE_COLUMNS), 'mismatches'))
+    for pipeline, result in results.items():
+        if result['status'] != 'ok':
+            print('{:<8}{:<14}{:<9}{}'.format(events, pipeline, result['status'], result['error']))
+            continue
+        rows = '/'.join('-' if count is None else str(count) for count in result['rows'].values())
+        mismatches = ', '.join('{} -{}/+{}'.format(table, missing, extra)
+                               for table, (missing, extra) in result.get('mismatches', {}).items()
+                               if missing or extra)
+        if not mismatches:
+            mismatches = '-' if 'mismatches' in result else 'reference' if pipeline == reference else 'not compared'
+        print('{:<8}{:<14}{:<9}{:>10.2f}{:>9.1f}  {:<44}{}'.format(
+            events, pipeline, result['status'], result['seconds'], result['max_rss_mb'], rows, mismatches))
+
+
+def regressions(report, baseline, max_slowdown, max_memory_growth):
+    '''
+    Description : Compare a report with a baseline report of the same scales and pipelines
+        - a pipeline that ran in the baseline has to run
+        - row counts and mismatches have to be the same, the outputs are deterministic for a seed, a pipeline
+          diffed with the reference in the baseline has to be diffed again
+        - time and peak memory may grow by max_slowdown and max_memory_growth at most
+    Returns :
+        - list of regressions, empty when the report passes
+    '''
+    problems = []
+    for scale, results in report.items():
+        for pipeline, result in results.items():
+            expected = baseline.get(scale, {}).get(pipeline)
+            if expected is None or expected['status'] != 'ok':
+                continue
+            name = '{} at scale {}'.format(pipeline, scale)
+            if result['status'] != 'ok':
+                problems.append('{} {}: {}'.format(name, result['status'], result['error']))
+                continue
+            if result['rows'] != expected['rows']:
+                problems.append('{} rows changed from {} to {}'.format(name, expected['rows'], result['rows']))
+            if 'mismatches' in expected and 'mismatches' not in result:
+                problems.append('{} was not compared with the reference'.format(name))
+            elif result.get('mismatches') != expected.get('mismatches'):
+                problems.append('{} mismatches changed from {} to {}'.format(
+                    name, expected.get('mismatches'), result.get('mismatches')))
+            if result['seconds'] > max(expected['seconds'], MIN_GATED_SECONDS) * max_slowdown:
+                problems.append('{} took {:.2f}s, {:.2f}s in the baseline'.format(
+                    name, result['seconds'], expected['seconds']))
+            if result['max_rss_mb'] > expected['max_rss_mb'] * max_memory_growth:
+                problems.append('{} peaked at {:.1f} MB, {:.1f} MB in the baseline'.format(
+                    name, result['max_rss_mb'], expected['max_rss_mb']))
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000], help='log events of each dataset')
+    parser.add_argument('--pipelines', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--reference', choices=list(BENCHMARKS), default='postgres',
+                        help='pipeline the others are compared with')
+    parser.add_argument('--admin-dsn', default=os.environ.get('SPARKIFY_ADMIN_DSN', ADMIN_DSN),
+                        help='connection string of the database the bench_<pipeline> databases are created from')
+    parser.add_argument('--workdir', default=os.path.join(HERE, 'benchmark_output'),
+                        help='directory of the datasets, outputs, logs and report')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='report of an earlier run to gate this one on')
+    parser.add_argument('--write-baseline', action='store_true', help='write the report of this run to --baseline')
+    parser.add_argument('--max-slowdown', type=float, default=1.5, help='allowed factor of time over the baseline')
+    parser.add_argument('--max-memory-growth', type=float, default=1.5,
+                        help='allowed factor of peak memory over the baseline')
+    parser.add_argument('--worker', choices=list(BENCHMARKS), help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''
+    Description :
+        - Run every pipeline at every scale, print and write the report to <workdir>/report.json
+        - Exit with 1 when the reference pipeline did not run at some scale, nothing was diffed there
+        - With --baseline, exit with 1 when the report regressed from it, with --write-baseline replace it instead
+    '''
+    args = parse_args(argv)
+    if args.worker:
+        run_worker(args.worker, args.data, args.workdir, args.admin_dsn, args.result)
+        return
+    if args.write_baseline and not args.baseline:
+        raise SystemExit('--write-baseline needs --baseline')
+
+    pipelines = [args.reference] + [pipeline for pipeline in args.pipelines if pipeline != args.reference]
+    report = {}
+    for events in args.scales:
+        report[str(events)] = run_scale(events, pipelines, args.reference, args)
+        print_results(events, report[str(events)], args.reference)
+        print()
+
+    with open(os.path.join(args.workdir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    undiffed = [events for events, results in report.items() if results[args.reference]['status'] != 'ok']
+    if undiffed:
+        print('reference {} did not run at scale {}, the pipelines were not compared'.format(
+            args.reference, ', '.join(undiffed)))
+        sys.exit(1)
+
+    if args.baseline and args.write_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('baseline written to {}'.format(args.baseline))
+    elif args.baseline:
+        with open(args.baseline) as f:
+            problems = regressions(report, json.load(f), args.max_slowdown, args.max_memory_growth)
+        for problem in problems:
+            print(problem)
+        print('benchmark {}'.format('REGRESSED' if problems else 'OK'))
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
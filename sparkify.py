@@ -0,0 +1,191 @@
+'''
+One command line for the ETL jobs of every project :
+
+    python sparkify.py postgres create-tables --profile indexed --dsn "host=... dbname=sparkifydb ..."
+    python sparkify.py postgres etl --dry-run
+    python sparkify.py redshift etl --config dwh.cfg --dry-run
+    python sparkify.py datalake etl --profile local
+    python sparkify.py airflow sql songplay_table_insert
+    python sparkify.py startup-benchmark
+
+- Only the standard library is imported up front. A command puts its project directory first on sys.path,
+  changes into it, the jobs resolve their config files and data paths relative to it, and imports its
+  module only then, so pyspark, pandas or psycopg2 are loaded by the commands that use them only.
+- The options after the command are handed to the module's own parser, see `<pipeline> <command> --help`.
+'''
+import argparse
+import importlib
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def datalake_etl(argv):
+    '''
+    Description : etl.py of the Data Lake, importing pyspark only for runs of the spark engine
+    '''
+    from settings import parse_args, print_plan, settings_from_args
+    args = parse_args(argv)
+    settings = settings_from_args(args)
+    if args.dry_run:
+        print_plan(settings)
+    elif settings['engine'] == 'arrow':
+        importlib.import_module('arrow_etl').run(settings)
+    else:
+        importlib.import_module('etl').run(settings)
+
+
+def airflow_sql_queries():
+    '''
+    Description : The statements of the Airflow SqlQueries by name, the helpers package itself imports airflow
+                  so the module is loaded by path
+    '''
+    path = os.path.join(HERE, PIPELINES['airflow'][0], 'plugins', 'helpers', 'sql_queries.py')
+    spec = importlib.util.spec_from_file_location('airflow_sql_queries', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return {name: value for name, value in vars(module.SqlQueries).items()
+            if not name.startswith('_') and isinstance(value, str)}
+
+
+def airflow_sql(argv):
+    '''
+    Description : Print the statements of SqlQueries
+    '''
+    parser = argparse.ArgumentParser(prog='sparkify.py airflow sql', description=airflow_sql.__doc__)
+    parser.add_argument('names', nargs='*', help='statements to print, all when none is given')
+    args = parser.parse_args(argv)
+
+    queries = airflow_sql_queries()
+    for name in args.names or sorted(queries):
+        if name not in queries:
+            raise SystemExit("Unknown statement '{}', known are {}".format(name, ', '.join(sorted(queries))))
+        print('-- {}\n{};\n'.format(name, queries[name].strip()))
+
+
+# pipeline : (project directory, {command : (module with a main(argv) or function(argv), help)})
+PIPELINES = {
+    'postgres': ('Data Modeling - Postgres', {
+        'create-tables': ('create_tables', 'drop and create sparkifydb with a schema profile'),
+        'etl': ('etl', 'load the song and log files into sparkifydb'),
+        'stream': ('stream', 'micro-batch ingestion of NDJSON log events'),
+        'benchmark': ('benchmark', 'compare the schema profiles'),
+    }),
+    'redshift': ('Data Warehouse Redshift', {
+        'create-tables': ('create_tables', 'drop and create the staging, star schema and aggregate tables'),
+        'etl': ('etl', 'COPY the staging tables, load the star schema and refresh the aggregates'),
+        'tables': ('table_definitions', 'generate the Airflow DDL, suggest and migrate column encodings'),
+    }),
+    'datalake': ('Data Lake', {
+        'etl': (datalake_etl, 'build the parquet tables with spark or the arrow engine'),
+        'stream': ('streaming', 'structured streaming of log_data'),
+        'compare-engines': ('compare_engines', 'run both engines on the sample data and diff the outputs'),
+    }),
+    'airflow': (os.path.join('Data Pipeline Airflow', 'airflow'), {
+        'sql': (airflow_sql, 'print the statements of SqlQueries'),
+    }),
+}
+
+# commands timed by startup-benchmark, all of them run without a database, a cluster or a spark session
+STARTUP_COMMANDS = [
+    ['--help'],
+    ['postgres', 'create-tables', '--dry-run'],
+    ['postgres', 'etl', '--dry-run'],
+    ['redshift', 'create-tables', '--dry-run'],
+    ['redshift', 'etl', '--dry-run'],
+    ['datalake', 'etl', '--profile', 'local', '--dry-run'],
+    ['datalake', 'stream', '--profile', 'local', '--dry-run'],
+    ['airflow', 'sql'],
+]
+
+HEAVY_MODULES = ('pyspark', 'pandas', 'numpy', 'pyarrow', 'psycopg2', 'airflow', 'cassandra')
+
+
+def run_command(pipeline, command, argv):
+    '''
+    Description : Run a command of a pipeline in its project directory
+    Arguments :
+        - pipeline : key of PIPELINES
+        - command : command of the pipeline
+        - argv : options handed to the command
+    Returns :
+        - None
+    '''
+    directory, commands = PIPELINES[pipeline]
+    target, _ = commands[command]
+    directory = os.path.join(HERE, directory)
+    sys.path.insert(0, directory)
+    os.chdir(directory)
+    if callable(target):
+        target(argv)
+    else:
+        importlib.import_module(target).main(argv)
+
+
+def imported_modules(argv):
+    '''
+    Description : Top level packages a fresh interpreter imports to run sparkify.py with argv, from -X importtime
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(HERE, 'sparkify.py')] + argv,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return modules
+
+
+def startup_benchmark(argv):
+    '''
+    Description :
+        - Start every command of STARTUP_COMMANDS in fresh interpreters and time them until they exit
+        - Report the median and fastest wall time and the heavy packages each command imported
+    '''
+    parser = argparse.ArgumentParser(prog='sparkify.py startup-benchmark', description=startup_benchmark.__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='runs per command')
+    args = parser.parse_args(argv)
+
+    print('{:<52} {:>10} {:>10}  {}'.format('command', 'median s', 'min s', 'heavy imports'))
+    for command in STARTUP_COMMANDS:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, os.path.join(HERE, 'sparkify.py')] + command,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        heavy = sorted(imported_modules(command) & set(HEAVY_MODULES))
+        status = '' if result.returncode == 0 else ' (exit {})'.format(result.returncode)
+        print('{:<52} {:>10.3f} {:>10.3f}  {}{}'.format(' '.join(command), statistics.median(timings), min(timings),
+                                                       ', '.join(heavy) or '-', status))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    pipelines = parser.add_subparsers(dest='pipeline', metavar='pipeline')
+    pipelines.required = True
+    for pipeline, (directory, commands) in PIPELINES.items():
+        subparser = pipelines.add_parser(pipeline, help='commands of {}'.format(directory))
+        subcommands = subparser.add_subparsers(dest='command', metavar='command')
+        subcommands.required = True
+        for command, (_, help_text) in commands.items():
+            subcommands.add_parser(command, help=help_text, add_help=False)
+    benchmark = pipelines.add_parser('startup-benchmark', help='time the cold start of the commands', add_help=False)
+    benchmark.set_defaults(command=None)
+    return parser.parse_known_args(argv)
+
+
+def main(argv=None):
+    args, rest = parse_args(argv)
+    if args.pipeline == 'startup-benchmark':
+        startup_benchmark(rest)
+    else:
+        run_command(args.pipeline, args.command, rest)
+
+
+if __name__ == "__main__":
+    main()